@@ -7,6 +7,12 @@ from home.settings import *
 BASE_URL = '/geolib/'
 BASE_FILESPACE = os.path.join(STATICFILES_DIRS[0], 'geolib/')
 
+# Answer point in polygon queries on the boundary layers from an
+# in-process index (see geolib.spatialindex), checking for changes to
+# the layer tables at most this many seconds apart.
+SPATIAL_INDEX = True
+SPATIAL_INDEX_CHECK = 60
+
 # Used to identify aerial photograph frames.
 VALID_RUN_IDS = (
     'A', 'B', 'C', 'D', 'E', 'F', 'G', 'H', 'I', 'J', 'K', 'L', 'M',
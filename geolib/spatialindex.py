@@ -0,0 +1,297 @@
+"""In-process spatial indexes over the static boundary layers.
+
+Region, TerritorialAuthority, Topo50_Island, NZMSgrid, Topo50grid and
+the NZMS260 and Topo50 sheets of TopoMap change only when a layer is
+reloaded, but Record.get_region() and its kind query them every time
+a site is saved or shown. Instead, each process loads a layer the
+first time it is asked about it, and keeps its polygons as prepared
+GEOS geometries in a grid of cells over the layer's extent. A point is
+then tested only against the polygons whose bounding boxes share its
+cell.
+
+    import geolib.spatialindex as spatialindex
+    spatialindex.value('region', site.geom, distance=10000)
+    spatialindex.first('nzms260', site.geom)
+
+A layer is loaded again when it has been saved to or deleted from in
+this process, through Django's signals, or when PostgreSQL's count of
+rows inserted, updated and deleted in its table has changed. That
+count is looked at no more than once every settings.SPATIAL_INDEX_CHECK
+seconds. Set settings.SPATIAL_INDEX to False to use database queries.
+
+"""
+
+import threading
+import time
+
+from django.apps import apps
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+
+import settings
+
+
+ENABLED = settings.SPATIAL_INDEX
+
+# Cells along the longer side of a layer's extent.
+GRID = 100
+
+# Name: (model, filter, field). A field of None gives the model object.
+LAYERS = {
+    'region': ('Region', {}, 'name'),
+    'tla': ('TerritorialAuthority', {}, 'name'),
+    'island': ('Topo50_Island', {}, 'name'),
+    'nzmsgrid': ('NZMSgrid', {}, None),
+    'topo50grid': ('Topo50grid', {}, None),
+    'nzms260': ('TopoMap', {'series_id': 'NZMS260'}, None),
+    'topo50': ('TopoMap', {'series_id': 'TOPO50'}, None),
+}
+
+
+def table_version(model):
+    """Return the number of rows written to the model's table.
+
+    This is PostgreSQL's count of rows inserted, updated and deleted,
+    which changes whenever the table does. Not available on databases
+    other than PostgreSQL, where None is returned.
+
+    """
+
+    if connection.vendor != 'postgresql':
+        return None
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT n_tup_ins + n_tup_upd + n_tup_del '
+            'FROM pg_stat_user_tables WHERE relname = %s',
+            [model._meta.db_table])
+        row = cursor.fetchone()
+
+    if row:
+        return row[0]
+    return None
+
+
+class LayerIndex():
+    """A grid of prepared geometries for one layer.
+
+    The layer is the model's rows matching filters, in the model's
+    ordering, or by primary key if it has none. Where a point falls in
+    more than one polygon, they are returned in that order.
+
+    """
+
+    def __init__(self, model_name, filters=None, field=None):
+        self.model_name = model_name
+        self.filters = filters or {}
+        self.field = field
+
+        self.lock = threading.RLock()
+        self.items = None
+        self.grid = {}
+        self.origin = (0, 0)
+        self.cell = 1
+        self.srid = None
+        self.version = None
+        self.checked = 0
+        self.dirty = False
+        self.connected = False
+
+    def model(self):
+        return apps.get_model('geolib', self.model_name)
+
+    def changed(self, **kwargs):
+        """Signal receiver: the layer's table has been written to."""
+
+        self.dirty = True
+
+    def table_version(self):
+        return table_version(self.model())
+
+    def stale(self):
+        """True if the layer must be loaded, or loaded again."""
+
+        if self.items is None or self.dirty:
+            return True
+
+        now = time.time()
+        if now - self.checked < settings.SPATIAL_INDEX_CHECK:
+            return False
+
+        self.checked = now
+        return self.table_version() != self.version
+
+    def load(self):
+        """Read the layer from the database and build the grid."""
+
+        model = self.model()
+        if not self.connected:
+            post_save.connect(self.changed, sender=model, weak=False)
+            post_delete.connect(self.changed, sender=model, weak=False)
+            self.connected = True
+
+        self.dirty = False
+        self.checked = time.time()
+        self.version = self.table_version()
+
+        objs = model.objects.filter(**self.filters).exclude(geom=None)
+        if not model._meta.ordering:
+            objs = objs.order_by('pk')
+
+        items = []
+        for obj in objs:
+            geom = obj.geom
+            self.srid = geom.srid
+            items.append((obj, geom, geom.prepared, geom.extent))
+
+        self.grid = {}
+        self.items = items
+        if not items:
+            return
+
+        xmin = min([extent[0] for (o, g, p, extent) in items])
+        ymin = min([extent[1] for (o, g, p, extent) in items])
+        xmax = max([extent[2] for (o, g, p, extent) in items])
+        ymax = max([extent[3] for (o, g, p, extent) in items])
+        self.origin = (xmin, ymin)
+        self.cell = max(xmax - xmin, ymax - ymin, 1) / float(GRID)
+
+        for n, (obj, geom, prepared, extent) in enumerate(items):
+            for key in self.cells(extent):
+                self.grid.setdefault(key, []).append(n)
+
+    def cells(self, extent):
+        """Return the grid keys of the cells overlapping extent."""
+
+        (x0, y0) = self.origin
+        i0 = int((extent[0] - x0) // self.cell)
+        j0 = int((extent[1] - y0) // self.cell)
+        i1 = int((extent[2] - x0) // self.cell)
+        j1 = int((extent[3] - y0) // self.cell)
+
+        return [(i, j) for i in range(i0, i1 + 1)
+                for j in range(j0, j1 + 1)]
+
+    def candidates(self, point, distance=0):
+        """Return the item numbers of polygons in cells near point.
+
+        In layer order.
+
+        """
+
+        extent = (point.x - distance, point.y - distance,
+                  point.x + distance, point.y + distance)
+        found = set()
+        for key in self.cells(extent):
+            found.update(self.grid.get(key, ()))
+
+        return sorted(found)
+
+    def prepare(self, point):
+        """Load the layer if needed; return point in the layer's srid."""
+
+        if self.stale():
+            self.load()
+        if self.srid and point.srid and point.srid != self.srid:
+            point = point.transform(self.srid, clone=True)
+        return point
+
+    def intersecting(self, point):
+        """Return the objects whose polygons intersect point."""
+
+        with self.lock:
+            point = self.prepare(point)
+            result = []
+            for n in self.candidates(point):
+                (obj, geom, prepared, extent) = self.items[n]
+                if (extent[0] <= point.x <= extent[2] and
+                        extent[1] <= point.y <= extent[3] and
+                        prepared.intersects(point)):
+                    result.append(obj)
+
+            return result
+
+    def nearest(self, point, distance):
+        """Return the object nearest point, within distance, or None."""
+
+        with self.lock:
+            point = self.prepare(point)
+            best = None
+            best_distance = None
+            for n in self.candidates(point, distance):
+                (obj, geom, prepared, extent) = self.items[n]
+                dx = max(extent[0] - point.x, 0, point.x - extent[2])
+                dy = max(extent[1] - point.y, 0, point.y - extent[3])
+                if dx > distance or dy > distance:
+                    continue
+
+                d = geom.distance(point)
+                if d <= distance and (best is None or d < best_distance):
+                    best = obj
+                    best_distance = d
+
+            return best
+
+    def value(self, obj):
+        if obj is None or self.field is None:
+            return obj
+        return getattr(obj, self.field)
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def get_index(layer):
+    """Return the LayerIndex for a layer named in LAYERS."""
+
+    with _lock:
+        if layer not in _indexes:
+            (model_name, filters, field) = LAYERS[layer]
+            _indexes[layer] = LayerIndex(model_name, filters, field)
+        return _indexes[layer]
+
+
+def reset():
+    """Forget every loaded layer."""
+
+    with _lock:
+        _indexes.clear()
+
+
+def values(layer, point):
+    """Return the values of the polygons of layer intersecting point."""
+
+    index = get_index(layer)
+    return [index.value(obj) for obj in index.intersecting(point)]
+
+
+def first(layer, point):
+    """Return the value of the first polygon of layer holding point.
+
+    Return None if there is none.
+
+    """
+
+    index = get_index(layer)
+    found = index.intersecting(point)
+    if found:
+        return index.value(found[0])
+    return None
+
+
+def value(layer, point, distance=None):
+    """Return the value of the polygon of layer holding point.
+
+    If there is none, and distance is given, return the value of the
+    nearest polygon within distance metres, or None.
+
+    """
+
+    index = get_index(layer)
+    found = index.intersecting(point)
+    if found:
+        return index.value(found[0])
+    if distance:
+        return index.value(index.nearest(point, distance))
+    return None
@@ -7,19 +7,98 @@ assessments, etc. New methods added as needed.
 
 """
 from django.contrib.gis.db.models.functions import Distance
-from django.db.models import Q, Count
-from django.contrib.gis.geos import Point, MultiPoint
+from django.db import connection
+from django.db.models import (
+    Case, Count, DateTimeField, Func, IntegerField, Q, Value, When)
+from django.contrib.gis.geos import GEOSGeometry, Point, MultiPoint
 from django.contrib.gis.geos import Polygon, MultiPolygon
 
+import datetime
 from itertools import chain
 import markdown2 as markdown
 import textwrap
 
 import settings
 import models
+import footprint
+import gaps
 import geolib.models
 
 
+HISTOGRAM_FIELDS = ('recorded', 'updated', 'visited', 'last_change')
+HISTOGRAM_SIZES = ('month', 'year', 'decade')
+
+
+def count_if(**conditions):
+    """Return an aggregate counting the rows which meet conditions.
+
+    As in filter(). For one query of many counts, in aggregate().
+
+    """
+
+    return Count(Case(When(then=1, **conditions), output_field=IntegerField()))
+
+
+class DateTrunc(Func):
+    """PostgreSQL date_trunc(): a date or time truncated to a unit."""
+
+    function = 'date_trunc'
+
+    def __init__(self, unit, expression, **extra):
+        super(DateTrunc, self).__init__(
+            Value(unit), expression, output_field=DateTimeField(), **extra)
+
+
+def next_bin(day, size):
+    """Return the first day of the bin of size after the one at day."""
+
+    if size == 'month':
+        if day.month == 12:
+            return datetime.date(day.year + 1, 1, 1)
+        return datetime.date(day.year, day.month + 1, 1)
+    if size == 'decade':
+        return datetime.date(day.year + 10, 1, 1)
+    return datetime.date(day.year + 1, 1, 1)
+
+
+def histogram(sites, field='recorded', size='year'):
+    """Return a list of (first day, count) of sites binned by a date.
+
+    Field is one of HISTOGRAM_FIELDS, and size one of HISTOGRAM_SIZES.
+    The sites are counted with one query, grouped by the date
+    truncated to the bin size, and every bin from the earliest to the
+    latest is listed, with a count of 0 where there are no sites. The
+    first day is a date. Sites without the date are left out, and an
+    empty list returned if none have it. Times are binned in UTC.
+
+    """
+
+    if field not in HISTOGRAM_FIELDS:
+        raise ValueError("Can't make a histogram of " + field)
+    if size not in HISTOGRAM_SIZES:
+        raise ValueError("Unknown histogram bin size " + size)
+
+    rows = sites.order_by().exclude(**{field + '__isnull': True}).annotate(
+        bin=DateTrunc(size, field)).values_list('bin').annotate(
+        n=Count('pk'))
+
+    counts = {}
+    for (start, n) in rows:
+        day = datetime.date(start.year, start.month, start.day)
+        counts[day] = counts.get(day, 0) + n
+
+    if not counts:
+        return []
+
+    bins = []
+    day = min(counts)
+    while day <= max(counts):
+        bins.append((day, counts.get(day, 0)))
+        day = next_bin(day, size)
+
+    return bins
+
+
 class Normalise():
     """Analyse a Site record for normalisation.
 
@@ -41,168 +120,190 @@ class Normalise():
     first characters. Go the easy way first, and get some immediate
     results.
 
+    The rules are the module functions find_dates() and
+    find_updates(), which work on the text of a site's update0 record,
+    so that nzaa.normalise can apply them to many sites at once.
+
     """
 
-    def __init__(self, site):
+    def __init__(self, site, update0=None):
         self.site = site
+        self._update0 = update0
+
+    def update0(self):
+        """Return the site's update0 record, read once."""
+
+        if self._update0 is None:
+            self._update0 = self.site.update0()
+        return self._update0
 
     def find_dates(self):
+        return find_dates(self.update0().description)
 
-        description = self.site.update0().description
-        condition = self.site.update0().condition
+    def find_updates(self):
+        return find_updates(
+            self.update0().description, self.update0().condition)
 
-        suggestions = []
 
-        for line in description.split('\n'):
-            date = ''
-            name = ''
-            update_type = ''
-            line = line.strip()
-            if line[:6].lower() == 'update':
-                words = line.split(' ')
-                date = words[1]
-                suggestions.append([date, name, update_type])
+def find_dates(description):
+    """Return [date, name, update_type] for lines starting "update".
 
-        return suggestions
+    From the description of a site's update0 record.
 
-    def find_updates(self):
-        """Return a data structure identifying updates from the text.
+    """
 
-        Date, actor, description and condition, for each identified
-        update.
+    suggestions = []
 
-        The output is a dictionary, keyed by date, representing a
-        single update event. Each element is a dictionary containing
-        these fields:
+    for line in (description or '').split('\n'):
+        date = ''
+        name = ''
+        update_type = ''
+        line = line.strip()
+        if line[:6].lower() == 'update':
+            words = line.split(' ')
+            date = words[1]
+            suggestions.append([date, name, update_type])
 
-            {
-                '2012-01-01': [
-                    'actor': '',
-                    'description': '',
-                    'condition': '',
-                ]
+    return suggestions
 
-        """
 
-        text = (self.site.update0().description + "\n\n" +
-                self.site.update0().condition)
-
-        chunks = []
-        store = []
-
-        # separate the text into chunks. A chunk is a block of text
-        # delimited by starting with "updated". It will produce
-        # separate description and condition entries.
-        for line in text.split('\n'):
-            line = textwrap.fill(line.strip())
-
-            if 'updated' in line[:10].lower():
-                chunks.append(store)
-
-                store = []
-
-            if len(line):
-                store.append(line)
-
-        chunks.append(store)
-
-        # Drop the first one, it's always a short description.
-        chunks = chunks[1:]
-
-        updates = {}
-
-        for chunk in chunks:
-            actor = None
-            visited = False
-            visited_by = False
-
-            # Split the first paragraph into lines.
-            lines = chunk[0].split('\n')
-
-            # Find the actor.
-            if 'Updated by:' in chunk[0]:
-                discard, name = chunk[0].split('Updated by:')
-                actor = name.strip().replace('\n', ' ').strip('.')
-
-            elif 'submitted by' in lines[0].lower():
-                discard, name = lines[0].split('submitted by')
-                actor = name.strip().replace('\n', ' ').strip('.')
-
-            elif 'Inspected' in chunk[0]:
-                discard, name = chunk[0].split(' by:')
-                actor = name.strip().replace('\n', ' ').strip('.')
-                visited_by = actor
-                visited = True
-
-            # Find the visitor.
-            keep = None
-            if 'Visited:' in lines[0]:
-                discard, keep = lines[0].split('Visited: ')
-
-            elif '(Field visit)' in chunk[0]:
-                try:
-                    discard, keep = chunk[0].split('visited')
-                    keep = keep.strip()
-                except ValueError:
-                    pass
-
-            if keep:
-                bits = keep[:10].split('/')
-                if len(bits) == 3:
-                    bits.reverse()
-                    visited = '-'.join(bits)
-
-            if len(lines) > 1:
-                if 'visited' in lines[1].lower():
-                    discard, stuff = lines[1].split(' by ')
-                    visited = discard
-                    visited_by = stuff
-
-            # Get the visited by date.
-            words = discard.split(' ')
-            if words[0] == 'visited':
-                bits = words[1].split('/')
-                if len(bits) == 3:
-                    bits.reverse()
-                    visited = '-'.join(bits)
-
-            words = chunk[0].split(' ')
-            fields = words[1].strip(',').split('/')
-            if len(fields) == 3:
-                fields.reverse()
-                date = '-'.join(fields)
-
-            # Build the dictionary structre
-            if date in updates.keys():
-                updates[date]['actor'] = actor
-                updates[date]['condition'] = '\n\n'.join(chunk)
+def find_updates(description, condition):
+    """Return a data structure identifying updates from the text.
 
-            else:
-                updates[date] = {
-                    'actor': actor,
-                    'description': '\n\n'.join(chunk),
-                    'condition': '',
-                    'visited': visited,
-                    'visited_by': visited_by,
-                }
-
-        # Sort and deliver the final data structure.
-        sorted_list = []
-        index = 0
-        for item in sorted(updates.keys()):
-            line = {
-                'index': index,
-                'date': item,
-                'actor': updates[item]['actor'],
-                'description': updates[item]['description'],
-                'condition': updates[item]['condition'],
-                'visited': updates[item]['visited'],
-                'visited_by': updates[item]['visited_by'],
+    Date, actor, description and condition, for each identified
+    update.
+
+    The output is a dictionary, keyed by date, representing a
+    single update event. Each element is a dictionary containing
+    these fields:
+
+        {
+            '2012-01-01': [
+                'actor': '',
+                'description': '',
+                'condition': '',
+            ]
+
+    """
+
+    text = (description or '') + "\n\n" + (condition or '')
+
+    chunks = []
+    store = []
+
+    # separate the text into chunks. A chunk is a block of text
+    # delimited by starting with "updated". It will produce
+    # separate description and condition entries.
+    for line in text.split('\n'):
+        line = textwrap.fill(line.strip())
+
+        if 'updated' in line[:10].lower():
+            chunks.append(store)
+
+            store = []
+
+        if len(line):
+            store.append(line)
+
+    chunks.append(store)
+
+    # Drop the first one, it's always a short description.
+    chunks = chunks[1:]
+
+    updates = {}
+
+    for chunk in chunks:
+        actor = None
+        visited = False
+        visited_by = False
+
+        # Split the first paragraph into lines.
+        lines = chunk[0].split('\n')
+
+        # Find the actor.
+        if 'Updated by:' in chunk[0]:
+            discard, name = chunk[0].split('Updated by:')
+            actor = name.strip().replace('\n', ' ').strip('.')
+
+        elif 'submitted by' in lines[0].lower():
+            discard, name = lines[0].split('submitted by')
+            actor = name.strip().replace('\n', ' ').strip('.')
+
+        elif 'Inspected' in chunk[0]:
+            discard, name = chunk[0].split(' by:')
+            actor = name.strip().replace('\n', ' ').strip('.')
+            visited_by = actor
+            visited = True
+
+        # Find the visitor.
+        keep = None
+        if 'Visited:' in lines[0]:
+            discard, keep = lines[0].split('Visited: ')
+
+        elif '(Field visit)' in chunk[0]:
+            try:
+                discard, keep = chunk[0].split('visited')
+                keep = keep.strip()
+            except ValueError:
+                pass
+
+        if keep:
+            bits = keep[:10].split('/')
+            if len(bits) == 3:
+                bits.reverse()
+                visited = '-'.join(bits)
+
+        if len(lines) > 1:
+            if 'visited' in lines[1].lower():
+                discard, stuff = lines[1].split(' by ')
+                visited = discard
+                visited_by = stuff
+
+        # Get the visited by date.
+        words = discard.split(' ')
+        if words[0] == 'visited':
+            bits = words[1].split('/')
+            if len(bits) == 3:
+                bits.reverse()
+                visited = '-'.join(bits)
+
+        words = chunk[0].split(' ')
+        fields = words[1].strip(',').split('/')
+        if len(fields) == 3:
+            fields.reverse()
+            date = '-'.join(fields)
+
+        # Build the dictionary structre
+        if date in updates.keys():
+            updates[date]['actor'] = actor
+            updates[date]['condition'] = '\n\n'.join(chunk)
+
+        else:
+            updates[date] = {
+                'actor': actor,
+                'description': '\n\n'.join(chunk),
+                'condition': '',
+                'visited': visited,
+                'visited_by': visited_by,
             }
-            sorted_list.append(line)
-            index += 1
 
-        return sorted_list
+    # Sort and deliver the final data structure.
+    sorted_list = []
+    index = 0
+    for item in sorted(updates.keys()):
+        line = {
+            'index': index,
+            'date': item,
+            'actor': updates[item]['actor'],
+            'description': updates[item]['description'],
+            'condition': updates[item]['condition'],
+            'visited': updates[item]['visited'],
+            'visited_by': updates[item]['visited_by'],
+        }
+        sorted_list.append(line)
+        index += 1
+
+    return sorted_list
 
 
 class Cadastre():
@@ -215,9 +316,12 @@ class Cadastre():
     in the supplied set of Site records.
 
         point_parcels
+        poly_parcels
 
-    Done by creating a MultiPoint object,then selecting cadastre
-    which intersect with that.
+    Done by collecting the points of the sites into a MultiPoint, and
+    their footprints into one union, in a single query, then selecting
+    cadastre which intersect with those. A site without a stored
+    footprint is given one as it would be by nzaa.footprint.
 
     """
 
@@ -231,17 +335,28 @@ class Cadastre():
 
     def iterate_sites(self, sites):
 
-        points = MultiPoint(sites[0].geom)
-        polys = sites[0].geom_poly
-
-        for site in sites[1:]:
-            points = points.union(site.geom)
-            polys = polys.union(site.geom_poly)
-
-        self.point_parcels = geolib.models.Cadastre.objects.filter(
-            geom__intersects=points)
-        self.poly_parcels = geolib.models.Cadastre.objects.filter(
-            geom__intersects=polys)
+        (ids, params) = sites.order_by().values(
+            'nzaa_id').query.sql_with_params()
+
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT ST_AsEWKB(ST_Collect(s."geom")), '
+                'ST_AsEWKB(ST_Union(COALESCE(s."geom_poly", ' +
+                footprint.expression('s') + '))) '
+                'FROM ' + models.Site._meta.db_table + ' s '
+                'WHERE s."geom" IS NOT NULL AND s."nzaa_id" IN (' +
+                ids + ')', params)
+            (points, polys) = cursor.fetchone()
+
+        parcels = geolib.models.Cadastre.objects
+        self.point_parcels = parcels.none()
+        self.poly_parcels = parcels.none()
+        if points:
+            self.point_parcels = parcels.filter(
+                geom__intersects=GEOSGeometry(points))
+        if polys:
+            self.poly_parcels = parcels.filter(
+                geom__intersects=GEOSGeometry(polys))
 
 
 class MapSite():
@@ -325,65 +440,53 @@ class Site():
         return self.store_site_assessment
 
     def assessment(self):
-        """Provide a summary of quality assessments. """
-
-        total = self.sitelist.count()
-        if not total:
-            return None
-
-        assessed = self.sitelist.exclude(record_quality=None)
-        count_assd = float(assessed.count())
-        pc_assd = int((count_assd / total) * 100)
+        """Provide a summary of quality assessments.
 
-        comp = None
-        pc_comp = None
-        adequate = None
-        pc_adequate = None
-        thin = None
-        pc_thin = None
-        sparse = None
-        pc_sparse = None
-        trivial = None
-        pc_trivial = None
+        Counted with one query, by conditional aggregates.
 
-        if count_assd:
-            comp = assessed.filter(record_quality='comprehensive').count()
-            pc_comp = int((float(comp) / count_assd) * 100)
-
-            adequate = assessed.filter(record_quality='adequate').count()
-            pc_adequate = int((float(adequate) / count_assd) * 100)
+        """
 
-            thin = assessed.filter(record_quality='thin').count()
-            pc_thin = int((float(thin) / count_assd) * 100)
+        counts = self.sitelist.aggregate(
+            total=Count('pk'),
+            assessed=count_if(record_quality__isnull=False),
+            comp=count_if(record_quality='comprehensive'),
+            adequate=count_if(record_quality='adequate'),
+            thin=count_if(record_quality='thin'),
+            sparse=count_if(record_quality='sparse'),
+            trivial=count_if(record_quality='trivial'))
 
-            sparse = assessed.filter(record_quality='sparse').count()
-            pc_sparse = int((float(sparse) / count_assd) * 100)
+        total = counts['total']
+        if not total:
+            return None
 
-            trivial = assessed.filter(record_quality='trivial').count()
-            pc_trivial = int((float(trivial) / count_assd) * 100)
+        count_assd = float(counts['assessed'])
+        pc_assd = int((count_assd / total) * 100)
 
         assessment = {
             "total": total,
             "assessed": int(count_assd),
             "remaining": total - int(count_assd),
             "pc_assd": pc_assd,
-            "adequate": adequate,
-            "pc_adequate": pc_adequate,
-            "comp": comp,
-            "pc_comp": pc_comp,
-            "thin": thin,
-            "pc_thin": pc_thin,
-            "sparse": sparse,
-            "pc_sparse": pc_sparse,
-            "trivial": trivial,
-            "pc_trivial": pc_trivial,
         }
 
+        for key in ('comp', 'adequate', 'thin', 'sparse', 'trivial'):
+            assessment[key] = None
+            assessment['pc_' + key] = None
+            if count_assd:
+                assessment[key] = counts[key]
+                assessment['pc_' + key] = int(
+                    (float(counts[key]) / count_assd) * 100)
+
         return assessment
 
     def count(self):
         return self.sitelist.count()
 
+    def histogram(self, field='recorded', size='year'):
+        """Return counts of the sites by a date field. See histogram()."""
+
+        return histogram(self.sitelist, field, size)
+
     def count_by_type(self):
         """Return a dictionary of site types with a count of each type."""
 
@@ -416,38 +519,14 @@ class Site():
 
         """Return a tuple containing year, count values from date recorded.
 
-        Acting on a subset of the sitelist which contains recorded
-        data values, determine the earliest and latest records, then
-        interate through each year, providing a count of records for
-        each one.
+        A list of (year, count) for each year from the earliest record
+        to the latest, and a list of (decade, count), from histogram().
 
         """
 
-        years = []
-        decade = {}
-        decades = []
-
-        dated = self.sitelist.exclude(
-            recorded__isnull=True).order_by('recorded')
-
-        firstyear = dated[0].recorded.year
-        lastyear = dated.reverse()[0].recorded.year
-
-        dcount = 0
-        for y in range(firstyear, lastyear + 1):
-            r = dated.filter(recorded__year=y).count()
-            years.append((y, r))
-
-            dec = str(y)[0:3] + '0'
-            dec = int(dec)
-
-            if dec in decade.keys():
-                decade[dec] += r
-            else:
-                decade[dec] = r
-
-        for key in sorted(decade.keys()):
-            decades.append((key, decade[key]))
+        years = [(d.year, n) for (d, n) in self.histogram('recorded', 'year')]
+        decades = [
+            (d.year, n) for (d, n) in self.histogram('recorded', 'decade')]
 
         return years, decades
 
@@ -457,40 +536,32 @@ class Site():
         earliest
         latest
 
+        The counts are made with one query, by conditional aggregates,
+        and the earliest and latest dated records read with one each.
+
         """
 
-        not_updated_by = []
-        not_visited_by = []
-        not_updated = []
-        not_visited = []
+        counts = self.sitelist.aggregate(
+            total=Count('pk'),
+            no_recorded=count_if(recorded__isnull=True),
+            no_recorded_by=count_if(recorded_by__isnull=True),
+            no_updated=count_if(updated__isnull=True),
+            no_updated_by=count_if(updated_by__isnull=True),
+            no_visited=count_if(visited__isnull=True),
+            no_visited_by=count_if(visited_by__isnull=True),
+            no_quality=count_if(record_quality__isnull=True),
+            not_updated=count_if(updated_by='Not updated'),
+            not_visited=count_if(visited_by='Not visited'))
 
         dated = self.sitelist.exclude(
             recorded__isnull=True).order_by('recorded')
 
-        dates = {
-            'dated': dated.count(),
-            'undated': self.count() - dated.count(),
-            'earliest': dated[0],
-            'latest': dated.reverse()[0],
-            'no_recorded': self.sitelist.filter(
-                recorded__isnull=True).count(),
-            'no_recorded_by': self.sitelist.filter(
-                recorded_by__isnull=True).count(),
-            'no_updated': self.sitelist.filter(
-                updated__isnull=True).count(),
-            'no_updated_by': self.sitelist.filter(
-                updated_by__isnull=True).count(),
-            'no_visited': self.sitelist.filter(
-                visited__isnull=True).count(),
-            'no_visited_by': self.sitelist.filter(
-                visited_by__isnull=True).count(),
-            'no_quality': self.sitelist.filter(
-                record_quality=None).count(),
-            'not_updated': self.sitelist.filter(
-                updated_by='Not updated').count(),
-            'not_visited': self.sitelist.filter(
-                visited_by='Not visited').count()
-        }
+        dates = dict(counts)
+        del dates['total']
+        dates['dated'] = counts['total'] - counts['no_recorded']
+        dates['undated'] = counts['no_recorded']
+        dates['earliest'] = dated.first()
+        dates['latest'] = dated.last()
 
         return dates
 
@@ -498,52 +569,72 @@ class Site():
         """Provide a table of site types and counts.
 
         This is returned as a list of (count, site_type) tuples,
-        sorted with the most frequent type at the top.
+        sorted with the most frequent type at the top. Counted with
+        one grouped query.
 
         """
 
-        types = []
-        sites = self.sitelist.distinct('site_type').order_by('site_type')
-
-        for site in sites:
-            count = self.sitelist.filter(site_type=site.site_type).count()
-            types.append((count, site.site_type))
+        counts = self.sitelist.order_by().values_list(
+            'site_type').annotate(n=Count('pk'))
+        types = [(n, site_type) for (site_type, n) in counts]
 
-        types = sorted(types, reverse=True)
-
-        return types
+        return sorted(types, reverse=True)
 
     def find_skipped_numbers(self):
         """Intended for use with NZMS sheet values.
 
-        Determine the unique set of sheet values. For each one of
-        these, find the highest ordinal number. Iterate through an
-        integer count from 1 to that number, recording all the numbers
-        which are missing from the set.
+        Determine the unique set of sheet values, and for each one the
+        ordinals missing below its highest ordinal number. Return a
+        dictionary of sheet: list of (first, last) ranges of missing
+        ordinals, found with one query. See nzaa.gaps.
 
         """
 
-        skipped = []
-        earliest = 1
-
-        sheets = self.sitelist.distinct('nzms_sheet')
-        for sheet in sheets:
-            sites_on_sheet = self.sitelist.filter(
-                nzms_sheet=sheet.nzms_sheet).order_by('-ordinal')
-            latest = sites_on_sheet[0].ordinal
-
-            for i in range(earliest, latest):
-                try:
-                    r = self.sitelist.get(ordinal=i)
-                except:
-                    skipped.append(sheet.nzms_sheet + '/' + str(i))
+        sheets = self.sitelist.order_by().values_list(
+            'nzms_sheet', flat=True).distinct()
 
-        return skipped
+        return gaps.missing(list(sheets))
 
     def find_primary_waterways(self):
         """Return a dictionary listing nzaa_id, waterway, distance.
 
-        The dictionary is keyed by nzaa_id"""
+        The dictionary is keyed by nzaa_id, and each value is
+        (distance, base_name) of the waterway nearest the site, the
+        closer by name if two are as near. Found for all the sites with
+        one query, by a nearest neighbour search on the spatial index of
+        the waterways. Sites without a location are left out.
+
+        """
+
+        (sites, params) = self.sitelist.order_by().values(
+            'nzaa_id').query.sql_with_params()
+
+        sql = (
+            'SELECT s."nzaa_id", w.distance, w.name '
+            'FROM ' + models.Site._meta.db_table + ' s '
+            'CROSS JOIN LATERAL ('
+            'SELECT ST_Distance(o."geom", s."geom") AS distance, '
+            'o."base_name" AS name '
+            'FROM ' + geolib.models.Waterways._meta.db_table + ' o '
+            'WHERE o."geom" IS NOT NULL '
+            'ORDER BY o."geom" <-> s."geom", o."base_name" NULLS FIRST '
+            'LIMIT 1) w '
+            'WHERE s."geom" IS NOT NULL AND s."nzaa_id" IN (' + sites + ')')
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            rows = cursor.fetchall()
+
+        return dict([(row[0], (row[1], row[2])) for row in rows])
+
+    def find_primary_waterways_legacy(self):
+        """Return find_primary_waterways(), site by site, in Python.
+
+        Measures the distance to every waterway from every site. Kept
+        to check find_primary_waterways() against, with ./manage.py
+        benchmark_waterways.
+
+        """
 
         output = {}
         waterways = geolib.models.Waterways.objects.all()
@@ -579,33 +670,20 @@ class Site():
         self.store_site_assessment = assessment
 
     def missing_numbers(self):
-        """Return a list of identifiers which don't have records.
+        """Return a list of ranges of identifiers which don't have records.
 
         This should only work on sets where number of distinct values
-        for nzms_sheet = 1.
-
-        This is costly. It hits the DB once for every ordinal number
-        on a sheet. That can be up to several thousand individual
-        queries.
+        for nzms_sheet = 1. Each range is (first, last) ordinal, as
+        from gaps.missing().
 
         """
 
-        if self.sitelist.distinct('nzms_sheet').count() != 1:
+        sheets = list(self.sitelist.order_by().values_list(
+            'nzms_sheet', flat=True).distinct())
+        if len(sheets) != 1:
             return None
 
-        p = self.sitelist.order_by('-ordinal')
-        sheet = self.sitelist[0].nzms_sheet
-        top = p[0].ordinal
-        missing = []
-
-        for ordinal in range(1, top):
-            id = sheet + '/' + str(ordinal)
-            try:
-                s = models.Site.objects.get(nzaa_id=id)
-            except models.Site.DoesNotExist:
-                missing.append(id)
-
-        return missing
+        return gaps.missing(sheets).get(sheets[0], [])
 
     def waterway_distances(self):
         """Generate a dictionary with distance statistics.
@@ -0,0 +1,234 @@
+"""Convert site coordinates between NZTM, NZMG and WGS84 in batches.
+
+Sites are located in NZTM (EPSG:2193). Their pages also show WGS84
+longitude and latitude, and old NZMG (EPSG:27200) coordinates, which
+were made by building a Point for every value shown and transforming
+it. Here a whole list of coordinates is transformed with one GDAL
+call, as a multipoint:
+
+    coords.convert([(1766351, 5917458), (1766500, 5917600)])
+    [(lon, lat, nzmg_easting, nzmg_northing), ...]
+
+Site records keep these values in their wgs84_lon, wgs84_lat,
+nzmg_easting and nzmg_northing fields, set by fill() when the site is
+stamped for saving. backfill() fills the fields of sites saved before
+they existed, or ./manage.py fillcoords.
+
+Legacy grid references, six figures on an NZMS 260 sheet, are
+converted to NZTM in bulk by gridrefs_to_nztm().
+
+"""
+
+import re
+
+from django.contrib.gis.gdal import (
+    CoordTransform, OGRGeometry, SpatialReference)
+
+import geolib.models
+import models
+import utils
+
+
+NZTM = 2193
+NZMG = 27200
+WGS84 = 4326
+
+FIELDS = ('wgs84_lon', 'wgs84_lat', 'nzmg_easting', 'nzmg_northing')
+
+RE_GRIDREF = re.compile(r'([A-Za-z]\d{2})\D*(\d{3})\D*(\d{3})$')
+
+_transforms = {}
+
+
+def get_transform(source, target):
+    """Return a CoordTransform from one srid to another, made once."""
+
+    key = (source, target)
+    if key not in _transforms:
+        _transforms[key] = CoordTransform(
+            SpatialReference(source), SpatialReference(target))
+    return _transforms[key]
+
+
+def transform(points, source, target):
+    """Transform a list of (x, y) from source to target srid.
+
+    Return a list of (x, y). All the points are transformed together,
+    as one multipoint geometry.
+
+    """
+
+    if not points:
+        return []
+
+    wkt = 'MULTIPOINT (' + ', '.join(
+        [repr(float(x)) + ' ' + repr(float(y)) for (x, y) in points]) + ')'
+    geom = OGRGeometry(wkt, SpatialReference(source))
+    geom.transform(get_transform(source, target))
+
+    return [point[:2] for point in geom.coords]
+
+
+def convert(points):
+    """Return (lon, lat, nzmg_easting, nzmg_northing) for NZTM points."""
+
+    wgs84 = transform(points, NZTM, WGS84)
+    nzmg = transform(points, NZTM, NZMG)
+
+    return [wgs84[n] + nzmg[n] for n in range(len(points))]
+
+
+def fill(records):
+    """Set the FIELDS of records from their geometries.
+
+    Records without a geometry are left alone.
+
+    """
+
+    records = [r for r in records if r.geom]
+    values = convert([(r.geom.x, r.geom.y) for r in records])
+    for (record, row) in zip(records, values):
+        (record.wgs84_lon, record.wgs84_lat,
+         record.nzmg_easting, record.nzmg_northing) = row
+
+
+def of(record):
+    """Return (lon, lat, nzmg_easting, nzmg_northing) for a record.
+
+    The stored values of a site, or else converted, and kept on the
+    record while its geometry is unchanged.
+
+    """
+
+    stored = tuple([getattr(record, field, None) for field in FIELDS])
+    if None not in stored:
+        return stored
+
+    key = (record.geom.x, record.geom.y)
+    cached = getattr(record, '_coords', None)
+    if cached and cached[0] == key:
+        return cached[1]
+
+    values = convert([key])[0]
+    record._coords = (key, values)
+    return values
+
+
+def is_gridref(nzmg_easting, nzmg_northing):
+    """True if NZMG coordinates resolve to a 100 m grid reference.
+
+    A grid reference is given as eastings and northings to 100m, the
+    south west corner of a 100m square. The conversion from NZTM can
+    be a metre out either way, so the last digit is dropped before
+    testing for divisibility by 100.
+
+    """
+
+    x = str(int(nzmg_easting))[:-1]
+    y = str(int(nzmg_northing) + 1)[:-1]
+
+    return int(x) % 10 == 0 and int(y) % 10 == 0
+
+
+def nzmg_display(nzmg_easting, nzmg_northing):
+    """Return a display string for NZMG coordinates.
+
+    A grid reference is shown as "NZMG Grid ref eee nnn".
+
+    """
+
+    if is_gridref(nzmg_easting, nzmg_northing):
+        x = str(int(nzmg_easting))[2:-2]
+        y = str(int(nzmg_northing))[2:-2]
+        return "NZMG Grid ref " + x + " " + y
+
+    return str(int(nzmg_easting)) + " " + str(int(nzmg_northing))
+
+
+def gridref_to_nzmg(bounds, eee, nnn):
+    """Return NZMG (easting, northing) for a grid reference on a sheet.
+
+    Bounds is the sheet's (xmin, ymin, xmax, ymax), and eee and nnn
+    the easting and northing in hundreds of metres, within 100 km.
+    Return None if the reference is not on the sheet.
+
+    """
+
+    (xmin, ymin, xmax, ymax) = bounds
+
+    easting = xmin // 100000 * 100000 + eee * 100
+    if easting < xmin:
+        easting += 100000
+    northing = ymin // 100000 * 100000 + nnn * 100
+    if northing < ymin:
+        northing += 100000
+
+    if easting > xmax or northing > ymax:
+        return None
+    return (easting, northing)
+
+
+def gridrefs_to_nztm(gridrefs):
+    """Convert legacy grid references to NZTM.
+
+    Each grid reference is an NZMS 260 sheet and six figures, as
+    "S14 123456", "S14/123/456" or "S14:123-456". The sheets are
+    looked up in geolib.NZMSgrid with one query, and all the points
+    transformed together. Return a list of (easting, northing), or
+    None where a reference can't be read or isn't on its sheet.
+
+    """
+
+    parsed = []
+    for gridref in gridrefs:
+        m = RE_GRIDREF.match((gridref or '').strip())
+        if m:
+            parsed.append(
+                (m.group(1).upper(), int(m.group(2)), int(m.group(3))))
+        else:
+            parsed.append(None)
+
+    sheets = set([p[0] for p in parsed if p])
+    bounds = {}
+    for row in geolib.models.NZMSgrid.objects.filter(
+            identifier__in=sheets).values_list(
+            'identifier', 'nzms_xmin', 'nzms_ymin', 'nzms_xmax', 'nzms_ymax'):
+        bounds[row[0]] = row[1:]
+
+    nzmg = []
+    for p in parsed:
+        if p and p[0] in bounds:
+            nzmg.append(gridref_to_nzmg(bounds[p[0]], p[1], p[2]))
+        else:
+            nzmg.append(None)
+
+    nztm = iter(transform([p for p in nzmg if p], NZMG, NZTM))
+
+    return [p and next(nztm) for p in nzmg]
+
+
+def backfill(batch_size=2000, verbose=False):
+    """Fill the FIELDS of sites which have a geometry but no values.
+
+    Return the number of sites filled.
+
+    """
+
+    filled = 0
+    while True:
+        rows = list(models.Site.objects.filter(
+            wgs84_lat=None).exclude(geom=None).values_list(
+            'nzaa_id', 'geom')[:batch_size])
+        if not rows:
+            break
+
+        sites = [models.Site(nzaa_id=nzaa_id, geom=geom)
+                 for (nzaa_id, geom) in rows]
+        fill(sites)
+        utils.bulk_update(models.Site, sites, FIELDS)
+
+        filled += len(sites)
+        if verbose:
+            print "Coordinates filled for " + str(filled) + " sites"
+
+    return filled
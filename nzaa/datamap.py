@@ -20,8 +20,18 @@ The returns from each of the functions are:
     period_map           period
     type_map             (site_type, site_subtype)
 
+Where a vocabulary is searched for in short_desc, every key found
+counts, and of those the last in sorted order wins. The vocabularies
+are compiled once, at import, into Vocabulary objects, which find all
+the keys in a string with one regular expression search. The original
+functions, which test each key in turn, are kept as map_type_legacy(),
+map_period_legacy() and map_ethnicity_legacy(), to check the compiled
+ones against; see ./manage.py benchmark_datamap.
+
 """
 
+import re
+
 ethnicity_map = {
     'Combination': "",
     'Maori': "Maori",
@@ -388,7 +398,200 @@ overides = {
 }
 
 
+class Vocabulary():
+    """Find which keys of a mapping occur in a string.
+
+    The keys are compiled into a single regular expression: a trie of
+    the keys, looked for at every position of the string. At each
+    position the alternatives are tried in reverse sorted order, so the
+    key matched there is the last, in sorted order, of the keys which
+    start there. Every other key which starts there is a prefix of it,
+    and is found from the prefixes list.
+
+    """
+
+    def __init__(self, mapping):
+        self.mapping = mapping
+        self.keys = sorted(mapping.keys())
+
+        self.prefixes = {}
+        for key in self.keys:
+            self.prefixes[key] = [k for k in self.keys
+                                  if k != key and key.startswith(k)]
+
+        self.pattern = re.compile(
+            '(?=(' + self.trie_pattern(self.keys) + '))')
+
+    def trie_pattern(self, keys):
+        """Return a regular expression matching any of keys.
+
+        Alternatives are in reverse sorted order, and the empty string,
+        where one key ends inside another, is tried last.
+
+        """
+
+        branches = {}
+        ends = False
+        for key in keys:
+            if key:
+                branches.setdefault(key[0], []).append(key[1:])
+            else:
+                ends = True
+
+        alternatives = []
+        for char in sorted(branches.keys(), reverse=True):
+            rest = branches[char]
+            if rest == ['']:
+                alternatives.append(re.escape(char))
+            else:
+                alternatives.append(
+                    re.escape(char) + self.trie_pattern(rest))
+
+        if len(alternatives) == 1 and not ends:
+            return alternatives[0]
+        pattern = '(?:' + '|'.join(alternatives) + ')'
+        if ends:
+            pattern += '?'
+        return pattern
+
+    def find(self, text):
+        """Return the set of keys which occur in text."""
+
+        found = set()
+        for match in self.pattern.finditer(text):
+            key = match.group(1)
+            if key not in found:
+                found.add(key)
+                found.update(self.prefixes[key])
+        return found
+
+    def last(self, text, test=None):
+        """Return the last key in sorted order which occurs in text.
+
+        With test, only keys whose value passes test count. Return None
+        if there is no such key.
+
+        """
+
+        found = self.find(text)
+        if test:
+            found = [key for key in found if test(self.mapping[key])]
+        if not found:
+            return None
+        return max(found)
+
+
+subtype_vocabulary = Vocabulary(subtype_map['short_desc'])
+burial_vocabulary = Vocabulary(subtype_burial)
+health_vocabulary = Vocabulary(subtype_health)
+horticulture_vocabulary = Vocabulary(subtype_horticulture)
+pa_vocabulary = Vocabulary(subtype_pa)
+unclass_vocabulary = Vocabulary(subtype_unclass)
+overide_vocabulary = Vocabulary(overides)
+period_vocabulary = Vocabulary(period_map['short_desc'])
+ethnicity_vocabulary = Vocabulary(ethnicity_map)
+
+
 def map_type(data):
+    """Return (site_type, site_subtype) for the extract data.
+
+    First, look up the type_map. In cases where a subtype is not given,
+    search short_desc for the subtype_map keys. Then process
+    exceptions, which are input values for site_type which have their
+    own vocabularies. Finally, apply the overides.
+
+    """
+
+    site_type = None
+    subtype = None
+
+    if data['type'] in type_map:
+        (site_type, subtype) = type_map[data['type']]
+
+    short_desc = data['short_desc'].lower()
+
+    if not subtype:
+        item = subtype_vocabulary.last(short_desc)
+        if item:
+            subtype = subtype_map['short_desc'][item][1]
+        item = subtype_vocabulary.last(short_desc, lambda v: v[0])
+        if item:
+            site_type = subtype_map['short_desc'][item][0]
+
+    # Exceptions
+    if 'Burial' in data['type']:
+        site_type = 'Burial'
+        item = burial_vocabulary.last(short_desc)
+        if item:
+            subtype = subtype_burial[item]
+
+    # The legacy version sets a local "type", not site_type, here, so
+    # only the subtype is taken from subtype_health.
+    if "Health care" in data['type']:
+        item = health_vocabulary.last(short_desc)
+        if item:
+            subtype = subtype_health[item][1]
+
+    if 'Maori horticulture' in data['type']:
+        site_type = 'Maori horticulture'
+        item = horticulture_vocabulary.last(short_desc)
+        if item:
+            subtype = subtype_horticulture[item]
+
+    if 'Pa' in data['type']:
+        site_type = 'Pa'
+        item = pa_vocabulary.last(short_desc)
+        if item:
+            subtype = subtype_pa[item]
+
+    if ('Unclassified' in data['type'] or not data['type']):
+        site_type = 'Unclassified'
+        subtype = None
+        item = unclass_vocabulary.last(short_desc)
+        if item:
+            (site_type, subtype) = subtype_unclass[item]
+
+    # Overides
+    item = overide_vocabulary.last(short_desc)
+    if item:
+        site_type = overides[item][0]
+    item = overide_vocabulary.last(short_desc, lambda v: v[1])
+    if item:
+        subtype = overides[item][1]
+
+    return (site_type, subtype)
+
+
+def map_period(data):
+    """Trap all comma-separated values from period input. """
+
+    output = []
+
+    for period in data['period'].split(', '):
+        if period in period_map['period']:
+            output.append(period_map['period'][period])
+
+    for keyword in sorted(
+            period_vocabulary.find(data['short_desc'].lower())):
+        output.append(period_map['short_desc'][keyword])
+
+    return ", ".join(output)
+
+
+def map_ethnicity(data):
+    result = data['ethnicity']
+
+    if data['ethnicity'] in ethnicity_map:
+        result = ethnicity_map[data['ethnicity']]
+
+    group = ethnicity_vocabulary.last(data['short_desc'].lower())
+    if group:
+        result = ethnicity_map[group]
+
+    return result
+
+
+def map_type_legacy(data):
     """Traverse the type_map dictionary and return (site_type site_subtype).
 
     First, search the type_map. In cases where a subtype is not given,
@@ -457,7 +660,7 @@ def map_type(data):
     return (site_type, subtype)
 
 
-def map_period(data):
+def map_period_legacy(data):
     """Trap all comma-separated values from period input. """
 
     result = data['period']
@@ -476,7 +679,7 @@ def map_period(data):
     return result
 
 
-def map_ethnicity(data):
+def map_ethnicity_legacy(data):
     result = data['ethnicity']
 
     if data['ethnicity'] in ethnicity_map.keys():
@@ -0,0 +1,171 @@
+"""The number of sites in grid cells, kept in the SiteDensity table.
+
+Maps and reports asking how many sites there are in an area read them
+from SiteDensity rather than counting sites near a point. Each site
+with a geometry is binned into square NZTM cells of each of SIZES
+metres, the cell of a site at x, y being floor(x / size), floor(y /
+size). SiteDensity holds the number of sites of each type in each
+cell, and cells() adds them up for a bounding box:
+
+    import nzaa.density as density
+    density.cells((1740000, 5900000, 1770000, 5930000))
+    density.cells((1740000, 5900000, 1770000, 5930000), 250, 'Pa')
+
+or /density/?bbox=1740000,5900000,1770000,5930000 for JSON.
+
+As in sitestats, every row is of one sheet, so a sheet's rows can be
+counted again on their own. update_sheets() does so: when a site is
+deleted, or saved with a new geom, site_type or nzms_sheet, once the
+transaction commits; by scrapes for the sheets of each batch; and by
+reclassify for the sheets it changes. A change made any other way
+needs update_sheets() or rebuild(), or ./manage.py density.
+
+"""
+
+import math
+
+from django.db import connection, transaction
+from django.db.models import Sum
+
+import models
+
+
+# Sides of the cells, in metres.
+SIZES = (250, 1000, 5000, 25000)
+
+# The most cells cells() will choose a size to give.
+MAX_CELLS = 10000
+
+
+def count_query(where=''):
+    """Return the SQL counting sites into the SiteDensity table."""
+
+    columns = '"size", "cell_x", "cell_y", "nzms_sheet", "site_type"'
+
+    return (
+        'INSERT INTO ' + models.SiteDensity._meta.db_table + ' (' +
+        columns + ', "count") '
+        'SELECT z.size, floor(ST_X(s."geom") / z.size)::integer, '
+        'floor(ST_Y(s."geom") / z.size)::integer, '
+        's."nzms_sheet", s."site_type", count(*) '
+        'FROM ' + models.Site._meta.db_table + ' s, '
+        'unnest(ARRAY[' + ', '.join([str(size) for size in SIZES]) + ']) '
+        'AS z(size) '
+        'WHERE s."geom" IS NOT NULL' + where + ' '
+        'GROUP BY 1, 2, 3, 4, 5')
+
+
+def rebuild():
+    """Count every site again. Return the number of rows made."""
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            'LOCK TABLE ' + models.SiteDensity._meta.db_table +
+            ' IN EXCLUSIVE MODE')
+        cursor.execute('DELETE FROM ' + models.SiteDensity._meta.db_table)
+        cursor.execute(count_query())
+        return cursor.rowcount
+
+
+def update_sheets(sheets):
+    """Count the sites on the sheets again.
+
+    Each sheet is locked while it is counted, as in
+    sitestats.update_sheets().
+
+    """
+
+    sheets = sorted(set([sheet for sheet in sheets if sheet]))
+    if not sheets:
+        return
+
+    table = models.SiteDensity._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        for sheet in sheets:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                ['density ' + sheet])
+        cursor.execute(
+            'DELETE FROM ' + table + ' WHERE "nzms_sheet" = ANY(%s)',
+            [sheets])
+        cursor.execute(
+            count_query(' AND s."nzms_sheet" = ANY(%s)'), [sheets])
+
+
+def update_sheets_on_commit(sheets):
+    """Count the sites on the sheets again once the transaction commits."""
+
+    sheets = list(sheets)
+    transaction.on_commit(lambda: update_sheets(sheets))
+
+
+def span(bounds, size):
+    """Return (x0, y0, x1, y1), the first and last cells of bounds."""
+
+    (xmin, ymin, xmax, ymax) = bounds
+    return (int(math.floor(xmin / float(size))),
+            int(math.floor(ymin / float(size))),
+            int(math.floor(xmax / float(size))),
+            int(math.floor(ymax / float(size))))
+
+
+def resolution(bounds, limit=MAX_CELLS):
+    """Return the smallest of SIZES giving at most limit cells in bounds.
+
+    Or the largest, if none does.
+
+    """
+
+    for size in SIZES:
+        (x0, y0, x1, y1) = span(bounds, size)
+        if (x1 - x0 + 1) * (y1 - y0 + 1) <= limit:
+            return size
+
+    return SIZES[-1]
+
+
+def cells(bounds, size=None, site_type=None):
+    """Return a list of the cells in bounds which have sites.
+
+    Bounds is (xmin, ymin, xmax, ymax) in NZTM. Size is one of SIZES,
+    or by default the resolution() of bounds. With site_type, only
+    sites of that type are counted.
+
+    Each cell is a dictionary of its south west corner x and y, its
+    size, the count of sites in it, their density per square km, and
+    types, a dictionary of site type: count. Cells are in order of y,
+    then x.
+
+    """
+
+    if size is None:
+        size = resolution(bounds)
+    if size not in SIZES:
+        raise ValueError("Cell size must be one of " + str(SIZES))
+
+    (x0, y0, x1, y1) = span(bounds, size)
+    rows = models.SiteDensity.objects.filter(
+        size=size, cell_x__gte=x0, cell_x__lte=x1,
+        cell_y__gte=y0, cell_y__lte=y1)
+    if site_type is not None:
+        rows = rows.filter(site_type=site_type)
+    rows = rows.order_by().values_list(
+        'cell_x', 'cell_y', 'site_type').annotate(n=Sum('count'))
+
+    area = (size / 1000.0) ** 2
+    found = {}
+    for (x, y, site_type, n) in rows:
+        cell = found.setdefault((y, x), {
+            'x': x * size,
+            'y': y * size,
+            'size': size,
+            'count': 0,
+            'types': {},
+        })
+        cell['count'] += n
+        cell['types'][site_type] = cell['types'].get(site_type, 0) + n
+
+    for cell in found.values():
+        cell['density'] = cell['count'] / area
+
+    return [found[key] for key in sorted(found.keys())]
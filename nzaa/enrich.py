@@ -0,0 +1,94 @@
+"""Fill the region, TLA and island of site records in bulk.
+
+Without geolib.spatialindex, Record.get_region(), get_tla() and
+get_island() each make a point in polygon query, and a nearest polygon
+query within 10 km if the first finds nothing. For a batch of new
+sites that is up to six round trips a site. enrich() does the same for
+any number of sites with one UPDATE a field, without loading a layer
+into the process:
+
+    UPDATE nzaa_site SET region = COALESCE(
+        (SELECT name FROM geolib_region
+         WHERE ST_Intersects(geom, nzaa_site.geom)
+         ORDER BY id LIMIT 1),
+        (SELECT name FROM geolib_region
+         WHERE ST_DWithin(geom, nzaa_site.geom, 10000)
+         ORDER BY ST_Distance(geom, nzaa_site.geom) LIMIT 1))
+    WHERE nzaa_id = ANY(...) AND region IS NULL
+
+Both subqueries use the spatial index on the layer, and the second is
+only run for sites the first leaves empty. Where a site falls on a
+boundary, the polygon with the lowest id is taken.
+
+Use it from the shell to fill sites missing these fields:
+
+    import nzaa.enrich as enrich
+    enrich.enrich()
+
+"""
+
+from django.db import connection
+
+import geolib.models
+import models
+
+
+# Site field, and the layer whose name fills it.
+LAYERS = (
+    ('region', geolib.models.Region),
+    ('tla', geolib.models.TerritorialAuthority),
+    ('island', geolib.models.Topo50_Island),
+)
+
+
+def enrich(nzaa_ids=None, fields=None, distance=10000, overwrite=False):
+    """Fill spatial fields of sites from the geolib layers.
+
+    Given a list of nzaa_ids, only those sites are changed; otherwise
+    all. Fields is a list of field names from LAYERS, all by default.
+    A site's field is only filled if it is empty, unless overwrite is
+    set. A site further than distance metres from every polygon keeps
+    an empty field.
+
+    Return a dictionary of field: number of sites updated.
+
+    """
+
+    updated = {}
+    if nzaa_ids is not None and not len(nzaa_ids):
+        return updated
+
+    site_table = models.Site._meta.db_table
+
+    for (field, layer) in LAYERS:
+        if fields and field not in fields:
+            continue
+
+        table = layer._meta.db_table
+        query = (
+            'UPDATE ' + site_table + ' SET "' + field + '" = COALESCE('
+            '(SELECT "name" FROM ' + table + ' '
+            'WHERE ST_Intersects(' + table + '."geom", ' +
+            site_table + '."geom") '
+            'ORDER BY ' + table + '."id" LIMIT 1), '
+            '(SELECT "name" FROM ' + table + ' '
+            'WHERE ST_DWithin(' + table + '."geom", ' +
+            site_table + '."geom", %s) '
+            'ORDER BY ST_Distance(' + table + '."geom", ' +
+            site_table + '."geom") LIMIT 1)) '
+            'WHERE TRUE'
+        )
+        params = [distance]
+
+        if nzaa_ids is not None:
+            query += ' AND "nzaa_id" = ANY(%s)'
+            params.append(list(nzaa_ids))
+
+        if not overwrite:
+            query += ' AND "' + field + '" IS NULL'
+
+        with connection.cursor() as cursor:
+            cursor.execute(query, params)
+            updated[field] = cursor.rowcount
+
+    return updated
@@ -0,0 +1,113 @@
+"""The footprints of sites, kept in Site.geom_poly.
+
+A site's footprint is the area taken to be the site, where all that is
+known of it is a point. If the point resolves to an NZMS 260 grid
+reference, the footprint is the 100 m grid square with its south west
+corner on the point. Otherwise it is a circle of RADIUS metres centred
+on the point.
+
+The corner of the square is found by rounding down, with floor(), in
+Python and SQL alike. The northing is taken a metre up first, as in
+coords.is_gridref(), since a grid reference converted from NZTM can
+come out a metre short.
+
+Record.compute_footprint() works out the footprint of one record.
+generate() fills the geom_poly of every site without one, or of a list
+of sites, with one UPDATE, the same footprint being written out as SQL
+by expression():
+
+    import nzaa.footprint as footprint
+    footprint.generate()
+
+or ./manage.py footprints.
+
+"""
+
+import math
+
+from django.contrib.gis.geos import MultiPolygon, Polygon
+from django.db import connection
+
+import coords
+import models
+
+
+# Side of a grid reference square, and radius of any other footprint.
+SIDE = 100
+RADIUS = 50
+
+
+def polygon(record):
+    """Return the footprint of a record as a MultiPolygon.
+
+    None if the record has no geometry.
+
+    """
+
+    if not record.geom:
+        return None
+
+    (lon, lat, x, y) = coords.of(record)
+    if coords.is_gridref(x, y):
+        x0 = math.floor(x / float(SIDE)) * SIDE
+        y0 = math.floor((y + 1) / float(SIDE)) * SIDE
+        ring = [(x0, y0), (x0, y0 + SIDE), (x0 + SIDE, y0 + SIDE),
+                (x0 + SIDE, y0), (x0, y0)]
+        poly = Polygon(coords.transform(ring, coords.NZMG, coords.NZTM),
+                       srid=coords.NZTM)
+    else:
+        poly = record.geom.buffer(RADIUS)
+
+    return MultiPolygon(poly, srid=coords.NZTM)
+
+
+def expression(alias='s'):
+    """Return SQL for the footprint of a row of the site table.
+
+    Alias is the name the table has in the query. The NZMG coordinates
+    are the stored ones, or transformed from the geometry if there are
+    none. See polygon() and coords.is_gridref().
+
+    """
+
+    geom = alias + '."geom"'
+    x = ('COALESCE(' + alias + '."nzmg_easting", ST_X(ST_Transform(' +
+         geom + ', ' + str(coords.NZMG) + ')))')
+    y = ('COALESCE(' + alias + '."nzmg_northing", ST_Y(ST_Transform(' +
+         geom + ', ' + str(coords.NZMG) + ')))')
+    x0 = 'floor(' + x + ' / ' + str(SIDE) + ') * ' + str(SIDE)
+    y0 = 'floor((' + y + ' + 1) / ' + str(SIDE) + ') * ' + str(SIDE)
+
+    return (
+        'ST_Multi(CASE WHEN '
+        'mod(trunc(' + x + ')::bigint / 10, 10) = 0 AND '
+        'mod((trunc(' + y + ')::bigint + 1) / 10, 10) = 0 '
+        'THEN ST_Transform(ST_MakeEnvelope(' +
+        x0 + ', ' + y0 + ', ' +
+        x0 + ' + ' + str(SIDE) + ', ' + y0 + ' + ' + str(SIDE) + ', ' +
+        str(coords.NZMG) + '), ' + str(coords.NZTM) + ') '
+        'ELSE ST_Buffer(' + geom + ', ' + str(RADIUS) + ') END)')
+
+
+def generate(nzaa_ids=None, replace=False):
+    """Fill the geom_poly of sites with their footprints.
+
+    Of the sites of nzaa_ids, or all sites, which have a geometry but
+    no footprint; with replace, of those with a footprint too. Return
+    the number of sites filled.
+
+    """
+
+    sql = ('UPDATE ' + models.Site._meta.db_table + ' s '
+           'SET "geom_poly" = ' + expression('s') + ' '
+           'WHERE s."geom" IS NOT NULL')
+    params = []
+    if not replace:
+        sql += ' AND s."geom_poly" IS NULL'
+    if nzaa_ids is not None:
+        sql += ' AND s."nzaa_id" = ANY(%s)'
+        params.append(list(nzaa_ids))
+
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.rowcount
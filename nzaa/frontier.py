@@ -0,0 +1,229 @@
+"""Choose which ordinals on an NZMS260 sheet to fetch from ArchSite.
+
+Scrape.find_sheet_members() lists every ordinal from 1 to the highest
+ordinal held plus 50. On a sheet which hasn't changed much, most of
+those requests are for records fetched recently, or for records which
+don't exist. A SheetFrontier makes fewer requests:
+
+  - Known sites are only fetched when they are due; that is, when they
+    were last extracted more than settings.SCRAPE_REFRESH_DAYS ago.
+
+  - Gaps in the numbering below the highest known ordinal (see
+    nzaa.gaps) are fetched at the same cadence, when the page cache
+    holds no fetch of them in the last SCRAPE_REFRESH_DAYS.
+
+  - New sites are found by probing past the highest known ordinal,
+    one ordinal at a time, until settings.SCRAPE_FRONTIER_MISSES miss
+    in a row. The probes then gallop, doubling their step (2, 4, 8
+    ...), out to plus (50) past the last site found, and stop there.
+    A gallop probe which finds a site fetches the ordinals between it
+    and the probe before, and probing starts again from it.
+
+For example, with six misses allowed, the highest known ordinal at
+200, and new sites at 201, 202 and 230:
+
+    probe 201 hit, 202 hit, 203 to 208 miss; gallop 210, 214, 222,
+    238, 252 miss: stop, after 13 requests.
+
+The site at 230 lies between two gallop probes, and is not found,
+where the full schedule would have made 249 requests to find it. With
+a new site at 222 as well, the gallop hits it and 215 to 221 are
+fetched. Probing goes on from 223, and the first gallop probe after
+223 to 228 miss finds 230.
+
+A request which fails, and might succeed later, is not counted as a
+miss, and is kept in the frontier's failed list. Probing stops early
+after SCRAPE_FRONTIER_MISSES errors in a row.
+
+Each frontier counts its requests, and the number saved against the
+full schedule of find_sheet_members().
+
+"""
+
+import datetime
+import pytz
+
+import settings
+import models
+import gaps
+import pagecache
+
+
+# A failed request, as returned by SheetFrontier.attempt().
+ERROR = object()
+
+
+class SheetFrontier():
+    """The fetch schedule for one sheet.
+
+    Initialise with a sheet identifier. The number of days before a
+    site or gap is due, and the number of misses in a row which end
+    probing, default to settings.SCRAPE_REFRESH_DAYS and
+    settings.SCRAPE_FRONTIER_MISSES. Plus is the margin above the
+    highest ordinal used by the full schedule, and the reach of the
+    probes past the last site found. Cache is the PageCache telling
+    when each gap was last fetched.
+
+    """
+
+    def __init__(self, sheet, refresh_days=None, misses=None, plus=50,
+                 cache=None):
+        self.sheet = sheet
+        self.refresh_days = refresh_days
+        if self.refresh_days is None:
+            self.refresh_days = settings.SCRAPE_REFRESH_DAYS
+        self.misses = misses or settings.SCRAPE_FRONTIER_MISSES
+        self.plus = plus
+        self.cache = cache or pagecache.PageCache()
+
+        self.requests = 0
+        self.hits = 0
+        self.failed = set()
+
+        cutoff = (datetime.datetime.now(pytz.utc) -
+                  datetime.timedelta(days=self.refresh_days))
+
+        self.highest = 0
+        self.due = []
+        sites = models.Site.objects.filter(nzms_sheet=sheet)
+        for (ordinal, extracted) in sites.values_list('ordinal', 'extracted'):
+            self.highest = max(self.highest, ordinal)
+            if not extracted or extracted < cutoff:
+                self.due.append(ordinal)
+        self.due.sort()
+        self.start = self.highest
+
+        # The page cache index holds UTC times as text, which sort.
+        since = unicode(cutoff.replace(microsecond=0))
+        self.holes = []
+        for (first, last) in gaps.missing([sheet]).get(sheet, []):
+            for ordinal in range(first, last + 1):
+                history = self.cache.history(self.nzaa_id(ordinal))
+                if not history or history[-1][0] < since:
+                    self.holes.append(ordinal)
+
+    def nzaa_id(self, ordinal):
+        return self.sheet + '/' + str(ordinal)
+
+    def targets(self):
+        """Return a list of the known sites and gaps due for a fetch.
+
+        These are counted as requests.
+
+        """
+
+        ordinals = sorted(self.due + self.holes)
+        self.requests += len(ordinals)
+        return [self.nzaa_id(ordinal) for ordinal in ordinals]
+
+    def attempt(self, fetch, ordinal):
+        """Fetch one ordinal. Return its extract, None, or ERROR.
+
+        None is a missing site. A failed request is ERROR, unless the
+        exception says it is not transient, as for a FetchError.
+
+        """
+
+        nzaa_id = self.nzaa_id(ordinal)
+        self.requests += 1
+        try:
+            extract = fetch(nzaa_id)
+        except Exception as e:
+            if getattr(e, 'transient', True):
+                self.failed.add(nzaa_id)
+                return ERROR
+            extract = None
+
+        self.failed.discard(nzaa_id)
+        return extract
+
+    def probe(self, fetch):
+        """Probe past the highest known ordinal for new sites.
+
+        Fetch is a function taking an nzaa_id and returning an extract,
+        or None for a missing site. It raises an exception if the
+        request fails. Yield (nzaa_id, extract) for each site found.
+
+        """
+
+        last = self.highest
+        ordinal = last
+        errors = 0
+
+        while errors < self.misses:
+            # One at a time, until misses in a row.
+            misses = 0
+            while misses < self.misses and errors < self.misses:
+                ordinal += 1
+                extract = self.attempt(fetch, ordinal)
+                if extract is ERROR:
+                    errors += 1
+                    continue
+                errors = 0
+
+                if extract:
+                    self.hits += 1
+                    yield (self.nzaa_id(ordinal), extract)
+                    last = ordinal
+                    misses = 0
+                else:
+                    misses += 1
+
+            # Gallop out to plus past the last site found. Below is the
+            # last ordinal found missing.
+            below = ordinal
+            reach = last + self.plus
+            step = 1
+            extract = None
+            while not extract and ordinal < reach and errors < self.misses:
+                step *= 2
+                ordinal = min(ordinal + step, reach)
+                extract = self.attempt(fetch, ordinal)
+                if extract is ERROR:
+                    errors += 1
+                    extract = None
+                    continue
+                errors = 0
+                if not extract:
+                    below = ordinal
+
+            if not extract:
+                break
+
+            # Fetch the ordinals between the hit and the miss before it.
+            for skipped in range(below + 1, ordinal):
+                found = self.attempt(fetch, skipped)
+                if found and found is not ERROR:
+                    self.hits += 1
+                    yield (self.nzaa_id(skipped), found)
+
+            self.hits += 1
+            yield (self.nzaa_id(ordinal), extract)
+            last = ordinal
+
+        self.highest = last
+
+    def full_schedule(self):
+        """The number of requests find_sheet_members() would make."""
+
+        if self.start:
+            return self.start + self.plus - 1
+        return self.plus - 1
+
+    def saved(self):
+        return self.full_schedule() - self.requests
+
+    def summary(self):
+        """One line describing the schedule for this sheet."""
+
+        line = "Sheet " + self.sheet + ": "
+        line += str(len(self.due)) + " due, "
+        if self.holes:
+            line += str(len(self.holes)) + " gaps, "
+        line += str(self.hits) + " new, "
+        if self.failed:
+            line += str(len(self.failed)) + " failed, "
+        line += str(self.requests) + " requests, "
+        line += str(self.saved()) + " saved"
+
+        return line
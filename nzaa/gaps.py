@@ -0,0 +1,80 @@
+"""Gaps in the numbering of the sites on NZMS 260 sheets.
+
+Sites on a sheet are numbered from 1. An identifier below the highest
+on its sheet with no site is missing: never used, or its site deleted.
+missing() finds the missing identifiers of any number of sheets with
+one query, comparing each site's ordinal with the one before it, and
+gives them as ranges of ordinals:
+
+    import nzaa.gaps as gaps
+    gaps.missing(['S14'])
+    {'S14': [(3, 3), (17, 21)]}
+    gaps.display('S14', [(3, 3), (17, 21)])
+    'S14/3, S14/17-21'
+
+"""
+
+from django.db import connection
+
+import models
+
+
+def missing(sheets=None):
+    """Return a dictionary of sheet: list of (first, last) missing.
+
+    For the sheets, or every sheet. Each range is of ordinals with no
+    site, in order. A sheet with none missing is left out.
+
+    """
+
+    where = 'WHERE "ordinal" IS NOT NULL'
+    params = []
+    if sheets is not None:
+        where += ' AND "nzms_sheet" = ANY(%s)'
+        params.append(list(sheets))
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT sheet, previous + 1, ordinal - 1 FROM ('
+            'SELECT "nzms_sheet" AS sheet, "ordinal" AS ordinal, '
+            'lag("ordinal", 1, 0) OVER ('
+            'PARTITION BY "nzms_sheet" ORDER BY "ordinal") AS previous '
+            'FROM ' + models.Site._meta.db_table + ' ' + where + ') t '
+            'WHERE ordinal > previous + 1 ORDER BY sheet, ordinal', params)
+        rows = cursor.fetchall()
+
+    ranges = {}
+    for (sheet, first, last) in rows:
+        ranges.setdefault(sheet, []).append((first, last))
+
+    return ranges
+
+
+def count(ranges):
+    """Return the number of ordinals in a list of ranges."""
+
+    return sum([last - first + 1 for (first, last) in ranges])
+
+
+def identifiers(sheet, ranges):
+    """Return the list of nzaa_ids in a sheet's ranges."""
+
+    ids = []
+    for (first, last) in ranges:
+        for ordinal in range(first, last + 1):
+            ids.append(sheet + '/' + str(ordinal))
+
+    return ids
+
+
+def display(sheet, ranges):
+    """Return a sheet's ranges as text, such as "S14/3, S14/17-21"."""
+
+    items = []
+    for (first, last) in ranges:
+        item = sheet + '/' + str(first)
+        if last > first:
+            item += '-' + str(last)
+        items.append(item)
+
+    return ', '.join(items)
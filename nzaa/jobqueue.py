@@ -0,0 +1,283 @@
+"""A database queue of sites to scrape from ArchSite.
+
+Each target is a row in the ScrapeJob table, so a run can be stopped
+at any point and picked up again, and the state of every target, with
+its last error, can be seen in the database. Several scrape processes
+can work on one queue: jobs are claimed with SELECT ... FOR UPDATE SKIP
+LOCKED, so no two workers ever hold the same job. A worker renews its
+claims before each fetch, and leaves a job whose claim has lapsed and
+been taken by another worker.
+
+Fill the queue with sked.enqueue(), and work it with JobQueue.run(),
+or from the command line:
+
+    ./manage.py scrapequeue add S14 S15/22
+    ./manage.py scrapequeue run
+    ./manage.py scrapequeue status
+
+"""
+
+import datetime
+import os
+import socket
+
+from django.db import DatabaseError, connection, transaction
+from django.db.models import Count, F, Q
+from django.utils import timezone
+
+import settings
+import models
+import scrape
+
+
+class JobQueue():
+    """Claim jobs from the ScrapeJob table, and record their outcomes.
+
+    The worker name defaults to the host name and process id. The
+    lease, backoff and number of attempts default to
+    settings.SCRAPE_JOB_LEASE, SCRAPE_JOB_BACKOFF and
+    SCRAPE_JOB_ATTEMPTS.
+
+    """
+
+    metrics = None
+
+    def __init__(self, worker=None, lease=None, backoff=None, attempts=None,
+                 verbose=False):
+
+        self.worker = worker
+        if not self.worker:
+            self.worker = socket.gethostname() + ':' + str(os.getpid())
+
+        self.lease = lease or settings.SCRAPE_JOB_LEASE
+        self.backoff = backoff or settings.SCRAPE_JOB_BACKOFF
+        self.attempts = attempts or settings.SCRAPE_JOB_ATTEMPTS
+        self.VERBOSE = verbose
+
+        self.counts = {
+            'claimed': 0,
+            'done': 0,
+            'missing': 0,
+            'retried': 0,
+            'failed': 0,
+            'lost': 0,
+        }
+
+    def claim(self, n=1):
+        """Claim up to n jobs which are due. Return their nzaa_ids.
+
+        A job is due if it is queued and its next_eligible time has
+        passed, or if it was claimed longer ago than the lease. Rows
+        locked by another worker's claim are skipped, not waited on.
+
+        """
+
+        now = timezone.now()
+        expired = now - datetime.timedelta(seconds=self.lease)
+
+        with transaction.atomic():
+            jobs = models.ScrapeJob.objects.select_for_update(
+                skip_locked=True).filter(
+                Q(state='queued', next_eligible__lte=now) |
+                Q(state='claimed', claimed_at__lt=expired)
+            ).order_by('next_eligible', 'nzaa_id')
+            nzaa_ids = list(jobs.values_list('nzaa_id', flat=True)[:n])
+
+            models.ScrapeJob.objects.filter(nzaa_id__in=nzaa_ids).update(
+                state='claimed', claimed_by=self.worker, claimed_at=now,
+                attempts=F('attempts') + 1)
+
+        self.counts['claimed'] += len(nzaa_ids)
+        return nzaa_ids
+
+    def renew(self, nzaa_ids):
+        """Renew the claims this worker still holds on jobs.
+
+        Return the nzaa_ids of those it still holds, in order. A job
+        claimed longer ago than the lease may have been claimed by
+        another worker, and is left to it.
+
+        """
+
+        jobs = models.ScrapeJob.objects.filter(
+            nzaa_id__in=nzaa_ids, state='claimed', claimed_by=self.worker)
+
+        with transaction.atomic():
+            jobs.update(claimed_at=timezone.now())
+            held = set(jobs.values_list('nzaa_id', flat=True))
+
+        return [nzaa_id for nzaa_id in nzaa_ids if nzaa_id in held]
+
+    def finish(self, nzaa_ids, state='done'):
+        """Mark claimed jobs done or missing.
+
+        Only jobs still held by this worker are changed. Return the
+        number changed.
+
+        """
+
+        n = models.ScrapeJob.objects.filter(
+            nzaa_id__in=nzaa_ids, state='claimed', claimed_by=self.worker
+        ).update(state=state, finished=timezone.now(), last_error=None)
+
+        self.counts[state] += n
+        return n
+
+    def fail(self, nzaa_id, error, transient=True):
+        """Record a failed attempt at a claimed job.
+
+        A transient failure puts the job back in the queue, to wait
+        backoff * 2 ** (attempts - 1) seconds. A job which has used up
+        its attempts, or has failed permanently, is marked failed.
+
+        """
+
+        try:
+            job = models.ScrapeJob.objects.get(
+                nzaa_id=nzaa_id, state='claimed', claimed_by=self.worker)
+        except models.ScrapeJob.DoesNotExist:
+            return None
+
+        job.last_error = error
+        job.claimed_by = None
+        job.claimed_at = None
+
+        if transient and job.attempts < self.attempts:
+            wait = self.backoff * 2 ** max(job.attempts - 1, 0)
+            job.state = 'queued'
+            job.next_eligible = (
+                timezone.now() + datetime.timedelta(seconds=wait))
+            self.counts['retried'] += 1
+        else:
+            job.state = 'failed'
+            job.finished = timezone.now()
+            self.counts['failed'] += 1
+
+        job.save()
+        return job.state
+
+    def release(self, worker=None):
+        """Put back the jobs claimed by worker, or by any worker.
+
+        For use after a run has been killed, so its jobs needn't wait
+        for their lease to expire. Return the number of jobs released.
+
+        """
+
+        jobs = models.ScrapeJob.objects.filter(state='claimed')
+        if worker:
+            jobs = jobs.filter(claimed_by=worker)
+
+        return jobs.update(
+            state='queued', claimed_by=None, claimed_at=None,
+            attempts=F('attempts') - 1)
+
+    def run(self, batch=None, limit=None):
+        """Claim, fetch and save jobs until the queue has none due.
+
+        Jobs are claimed batch at a time (settings.SCRAPE_BATCH by
+        default). The claims still to be fetched are renewed before
+        each fetch, and a job whose claim has been lost is skipped. The
+        extracts of each batch are saved with Scrape.save_batch(), and
+        the jobs marked done, in one transaction. A database error in
+        saving is transient, and the jobs are retried. Stop after limit
+        jobs, if given.
+
+        Return the dictionary of counts.
+
+        """
+
+        batch = batch or settings.SCRAPE_BATCH
+        s = scrape.Scrape(verbose=self.VERBOSE)
+        s.f = open(s.LOGFILENAME, 'a')
+
+        while True:
+            n = batch
+            if limit:
+                n = min(batch, limit - self.counts['claimed'])
+                if n <= 0:
+                    break
+
+            nzaa_ids = self.claim(n)
+            if not nzaa_ids:
+                break
+
+            extracts = []
+            missing = []
+            for (n, nzaa_id) in enumerate(nzaa_ids):
+                if nzaa_id not in self.renew(nzaa_ids[n:]):
+                    s.logging("Lost the claim on " + nzaa_id)
+                    self.counts['lost'] += 1
+                    continue
+
+                try:
+                    html = s.fetch_page(nzaa_id)
+                except scrape.Scrape.FetchError as e:
+                    s.logging("Failed to fetch " + nzaa_id + ": " + str(e))
+                    self.fail(nzaa_id, str(e), e.transient)
+                    continue
+
+                try:
+                    extract = s.extract_values(html)
+                except Exception as e:
+                    self.fail(nzaa_id, "Parse failed: " + str(e), False)
+                    continue
+
+                if extract:
+                    extracts.append((nzaa_id, extract))
+                else:
+                    missing.append(nzaa_id)
+
+            self.finish(missing, 'missing')
+
+            try:
+                with transaction.atomic():
+                    s.save_batch(extracts)
+                    self.finish([nzaa_id for (nzaa_id, e) in extracts])
+            except Exception as e:
+                # A deadlock, serialization failure or lost connection
+                # may pass; drop the connection if it is broken.
+                transient = isinstance(e, DatabaseError)
+                connection.close_if_unusable_or_obsolete()
+                for (nzaa_id, extract) in extracts:
+                    self.fail(nzaa_id, "Save failed: " + str(e), transient)
+
+            if self.VERBOSE:
+                print self.summary()
+
+        s.logging(self.summary())
+        for line in s.metrics.report().split('\n'):
+            s.logging(line)
+        s.metrics.close()
+        s.f.close()
+        self.metrics = s.metrics
+
+        return self.counts
+
+    def status(self):
+        """Return a dictionary of state: number of jobs."""
+
+        status = {}
+        for (state, label) in models.ScrapeJob.STATE:
+            status[state] = 0
+
+        rows = models.ScrapeJob.objects.values_list('state').annotate(
+            n=Count('nzaa_id')).order_by()
+        for (state, n) in rows:
+            status[state] = n
+
+        return status
+
+    def summary(self):
+        """One line describing this worker's run."""
+
+        line = "Job queue " + self.worker + ": "
+        line += str(self.counts['claimed']) + " claimed, "
+        line += str(self.counts['done']) + " done, "
+        line += str(self.counts['missing']) + " missing, "
+        line += str(self.counts['retried']) + " to retry, "
+        line += str(self.counts['failed']) + " failed"
+        if self.counts['lost']:
+            line += ", " + str(self.counts['lost']) + " lost"
+
+        return line
@@ -0,0 +1,62 @@
+"""Count the queries made by the analyse.Site summaries.
+
+    ./manage.py benchmark_analyse S14
+    ./manage.py benchmark_analyse S14 S15 R11
+
+Run assessment(), by_date(), by_decade() and by_type() on the sites
+of the NZMS 260 sheets (all sites by default), and report the number
+of queries and the time each took. The command fails if a summary
+makes more queries than it should, as given in QUERIES. The same
+limits are checked on a small set of sites by AnalyseSiteTest in
+nzaa/tests.py.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+import nzaa.analyse as analyse
+import nzaa.models as models
+
+
+# Summary: the most queries it should make.
+QUERIES = (
+    ('assessment', 1),
+    ('by_date', 3),
+    ('by_decade', 2),
+    ('by_type', 1),
+)
+
+
+class Command(BaseCommand):
+    help = 'Count the queries made by the site list summaries.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+
+    def handle(self, *args, **options):
+        sites = models.Site.objects.all()
+        if options['sheets']:
+            sites = sites.filter(nzms_sheet__in=options['sheets'])
+
+        failed = []
+        for (name, most) in QUERIES:
+            analysis = analyse.Site(sites)
+            start = time.time()
+            with CaptureQueriesContext(connection) as queries:
+                getattr(analysis, name)()
+            elapsed = time.time() - start
+
+            n = len(queries.captured_queries)
+            self.stdout.write("%-12s %4d queries %8.3f s" % (name, n, elapsed))
+            if n > most:
+                failed.append(name)
+
+        if failed:
+            raise CommandError(
+                "Too many queries made by " + ", ".join(failed) + ".")
+
+        self.stdout.write("All summaries within their query counts.")
@@ -0,0 +1,160 @@
+"""Check and time the compiled datamap classifier against the legacy one.
+
+    ./manage.py benchmark_datamap
+    ./manage.py benchmark_datamap S14 S15 --limit 5000 --generate 20000
+
+Classify a sample of extracts with map_type(), map_period() and
+map_ethnicity(), and with their _legacy versions, report
+classifications per second for each, and check that every extract is
+classified the same way by both. Mismatched extracts are listed, and
+the command fails if there are any.
+
+The sample is the extracts of the latest cached pages for the sheets
+(all sheets by default), and --generate more made up from the datamap
+vocabularies, with a fixed seed, so the keys are met in every case,
+overlap and combination.
+
+"""
+
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+import nzaa.datamap as datamap
+import nzaa.pagecache as pagecache
+import nzaa.scrape as scrape
+from nzaa.metrics import Metrics
+
+
+FILLER = ('the', 'on', 'a', 'ridge', 'near', 'Site', 'of', 'and', 'with')
+
+
+class Command(BaseCommand):
+    help = 'Check and time the compiled datamap classifier.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Take at most this many cached pages.')
+        parser.add_argument(
+            '--generate', type=int, default=20000,
+            help='Number of made up extracts to add.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        extracts = self.cached(options['sheets'], options['limit'])
+        cached = len(extracts)
+        extracts += self.generate(options['generate'], options['seed'])
+
+        if not extracts:
+            raise CommandError("No extracts to classify.")
+
+        (legacy, legacy_time) = self.classify('_legacy', extracts)
+        (current, current_time) = self.classify('', extracts)
+
+        mismatches = []
+        for n, extract in enumerate(extracts):
+            if legacy[n] != current[n]:
+                mismatches.append((extract, legacy[n], current[n]))
+
+        self.stdout.write(str(len(extracts)) + " extracts, " + str(cached) +
+                          " from the page cache")
+        self.stdout.write(self.rate("legacy", extracts, legacy_time))
+        self.stdout.write(self.rate("compiled", extracts, current_time))
+        if current_time:
+            self.stdout.write(
+                "Speed up: %.1fx" % (legacy_time / current_time))
+
+        if mismatches:
+            for (extract, a, b) in mismatches:
+                self.stdout.write("Mismatch: " + repr(extract))
+                self.stdout.write("  legacy   " + repr(a))
+                self.stdout.write("  compiled " + repr(b))
+            raise CommandError(
+                str(len(mismatches)) + " extracts classified differently.")
+
+        self.stdout.write("All classifications match.")
+
+    def cached(self, sheets, limit):
+        """Return the extracts of the latest cached pages."""
+
+        cache = pagecache.PageCache()
+        identifiers = cache.identifiers(sheets or None)
+        if limit:
+            identifiers = identifiers[:limit]
+
+        s = scrape.Scrape(metrics=Metrics(directory=False))
+        extracts = []
+        for nzaa_id in identifiers:
+            html = cache.latest(nzaa_id)
+            if not html:
+                continue
+            try:
+                extract = s.extract_values(html)
+            except Exception:
+                continue
+            if extract:
+                extracts.append(extract)
+
+        return extracts
+
+    def generate(self, n, seed):
+        """Return n made up extracts, built from the vocabularies."""
+
+        words = set()
+        for mapping in (datamap.subtype_map['short_desc'],
+                        datamap.subtype_burial, datamap.subtype_health,
+                        datamap.subtype_horticulture, datamap.subtype_pa,
+                        datamap.subtype_unclass, datamap.overides,
+                        datamap.period_map['short_desc'],
+                        datamap.ethnicity_map):
+            words.update(mapping.keys())
+        words = sorted(words) + list(FILLER)
+
+        types = sorted(datamap.type_map.keys()) + ['', 'Other']
+        periods = sorted(datamap.period_map['period'].keys()) + ['Unknown']
+        ethnicities = sorted(datamap.ethnicity_map.keys()) + ['', 'Other']
+
+        r = random.Random(seed)
+        extracts = []
+        for i in range(n):
+            short_desc = ' '.join(
+                [r.choice(words) for j in range(r.randint(0, 8))])
+            if r.random() < 0.3:
+                short_desc = short_desc.title()
+            extracts.append({
+                'type': r.choice(types),
+                'short_desc': short_desc,
+                'period': ', '.join(r.sample(periods, r.randint(0, 2))),
+                'ethnicity': r.choice(ethnicities),
+            })
+
+        return extracts
+
+    def classify(self, suffix, extracts):
+        """Classify extracts with the map functions named with suffix.
+
+        Return a list of (type, period, ethnicity), and the time taken.
+
+        """
+
+        map_type = getattr(datamap, 'map_type' + suffix)
+        map_period = getattr(datamap, 'map_period' + suffix)
+        map_ethnicity = getattr(datamap, 'map_ethnicity' + suffix)
+
+        results = []
+        start = time.time()
+        for extract in extracts:
+            results.append((map_type(extract), map_period(extract),
+                            map_ethnicity(extract)))
+
+        return (results, time.time() - start)
+
+    def rate(self, name, extracts, elapsed):
+        rate = 0
+        if elapsed:
+            rate = len(extracts) / elapsed
+        return "%-10s %8.2f s %10.1f classifications/s" % (
+            name, elapsed, rate)
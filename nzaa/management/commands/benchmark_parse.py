@@ -0,0 +1,101 @@
+"""Time and check the ArchSite page parser against the page cache.
+
+    ./manage.py benchmark_parse
+    ./manage.py benchmark_parse S14 S15 --limit 500
+
+Parse the latest cached page for each site with extract_values_legacy()
+and with extract_values(), report pages per second for each, and check
+that both give the same record, and so the same digest, for every page.
+Mismatched sites are listed, and the command fails if there are any.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+import nzaa.pagecache as pagecache
+import nzaa.scrape as scrape
+from nzaa.metrics import Metrics
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the ArchSite page parser over cached pages.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Parse at most this many pages.')
+
+    def handle(self, *args, **options):
+        cache = pagecache.PageCache()
+        identifiers = cache.identifiers(options['sheets'] or None)
+        if options['limit']:
+            identifiers = identifiers[:options['limit']]
+
+        pages = []
+        for nzaa_id in identifiers:
+            html = cache.latest(nzaa_id)
+            if html:
+                pages.append((nzaa_id, html))
+
+        if not pages:
+            raise CommandError("No pages in the cache at " + cache.root)
+
+        s = scrape.Scrape(metrics=Metrics(directory=False))
+
+        (legacy, legacy_time) = self.parse(s.extract_values_legacy, pages)
+        (current, current_time) = self.parse(s.extract_values, pages)
+
+        mismatches = []
+        for (nzaa_id, html) in pages:
+            a = legacy[nzaa_id]
+            b = current[nzaa_id]
+            if a != b:
+                mismatches.append(nzaa_id)
+            elif isinstance(a, dict) and (
+                    s.digest_extract(nzaa_id, a) !=
+                    s.digest_extract(nzaa_id, b)):
+                mismatches.append(nzaa_id)
+
+        self.stdout.write(str(len(pages)) + " pages, parser " + scrape.PARSER)
+        self.stdout.write(self.rate("extract_values_legacy", pages,
+                                    legacy_time))
+        self.stdout.write(self.rate("extract_values", pages, current_time))
+        if current_time:
+            self.stdout.write(
+                "Speed up: %.1fx" % (legacy_time / current_time))
+
+        if mismatches:
+            for nzaa_id in mismatches:
+                self.stdout.write("Mismatch: " + nzaa_id)
+            raise CommandError(
+                str(len(mismatches)) + " pages parsed differently.")
+
+        self.stdout.write("All records and digests match.")
+
+    def parse(self, method, pages):
+        """Return a dictionary of nzaa_id: result, and the time taken.
+
+        A page which raises an exception has the exception's class
+        name as its result, so the two parsers can be compared on
+        failures too.
+
+        """
+
+        results = {}
+        start = time.time()
+        for (nzaa_id, html) in pages:
+            try:
+                results[nzaa_id] = method(html)
+            except Exception as e:
+                results[nzaa_id] = e.__class__.__name__
+
+        return (results, time.time() - start)
+
+    def rate(self, name, pages, elapsed):
+        rate = 0
+        if elapsed:
+            rate = len(pages) / elapsed
+        return "%-24s %8.2f s %8.1f pages/s" % (name, elapsed, rate)
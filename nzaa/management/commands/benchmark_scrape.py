@@ -0,0 +1,86 @@
+"""Time the scraper against a local stand-in for ArchSite.
+
+    ./manage.py benchmark_scrape --sheet S14 --sites 200 \\
+        --workers 1,2,4,8 --latency 0.2 --errors 0.05 --missing 0.1
+
+Start a stand-in server (see nzaa.standin) on a free port, and scrape
+ordinals 1 to sites on the sheet from it with a ScrapePool, once for
+each number of workers. No request leaves the machine. Report pages
+per second, and how many pages were missing or failed, for each run.
+
+With the same seed, the stand-in gives each run the same latencies and
+failures, so runs can be compared from one change to the next.
+Extracts are not written to the database unless --save is given. The
+session cookie files of each run, which are named for the stand-in's
+port, are removed after it.
+
+"""
+
+import glob
+import os
+import urlparse
+
+from django.core.management.base import BaseCommand
+
+import nzaa.scrape as scrape
+import nzaa.scrapepool as scrapepool
+import nzaa.standin as standin
+from nzaa.metrics import Metrics
+from nzaa.management.commands.standin import (
+    add_standin_arguments, make_standin)
+
+
+class Command(BaseCommand):
+    help = 'Time the scraper against a local stand-in for ArchSite.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sheet', default='S14')
+        parser.add_argument(
+            '--sites', type=int, default=100,
+            help='Scrape ordinals 1 to this number.')
+        parser.add_argument(
+            '--workers', default='1,2,4,8',
+            help='Comma-separated numbers of workers to time.')
+        parser.add_argument(
+            '--save', action='store_true',
+            help='Write the extracts to the database.')
+        add_standin_arguments(parser)
+
+    def handle(self, *args, **options):
+        identifiers = [options['sheet'] + '/' + str(n)
+                       for n in range(1, options['sites'] + 1)]
+
+        self.stdout.write("%8s %8s %8s %8s %8s %10s" % (
+            'Workers', 'Sites', 'Missing', 'Errors', 'Seconds', 'Pages/s'))
+
+        for workers in [int(n) for n in options['workers'].split(',')]:
+            server = standin.Server(make_standin(options), port=0)
+            base = server.start()
+
+            try:
+                p = scrapepool.ScrapePool(
+                    workers=workers, rate=0, archsite=base,
+                    save=options['save'], metrics=Metrics(directory=False))
+                p.run(identifiers)
+            finally:
+                server.stop()
+                self.remove_cookies(base)
+
+            rate = 0
+            if p.elapsed:
+                rate = p.counts['fetched'] / p.elapsed
+            self.stdout.write("%8d %8d %8d %8d %8.2f %10.1f" % (
+                workers, p.counts['targets'], p.counts['missing'],
+                p.metrics.counts['errors'], p.elapsed, rate))
+
+            if options['verbosity'] > 1:
+                self.stdout.write(p.metrics.table())
+
+    def remove_cookies(self, base):
+        """Remove the cookie files of sessions with the server at base."""
+
+        host = urlparse.urlparse(base).netloc.replace(':', '_')
+        for pattern in (host + '.cookies', host + '_*.cookies'):
+            for path in glob.glob(os.path.join(
+                    scrape.Scrape.LOCALOG, 'archsite_*_' + pattern)):
+                os.remove(path)
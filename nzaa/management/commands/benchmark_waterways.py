@@ -0,0 +1,74 @@
+"""Check and time the nearest waterway query against the legacy loop.
+
+    ./manage.py benchmark_waterways S14
+    ./manage.py benchmark_waterways S14 S15 --limit 200
+
+Find the nearest waterway to each site on the sheets with
+analyse.Site.find_primary_waterways(), and to the first --limit of
+them with find_primary_waterways_legacy(), which measures the distance
+to every waterway in Python. Report the time taken per site by each,
+and check that both find the same waterway at the same distance. The
+command fails if any site differs.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+import nzaa.analyse as analyse
+import nzaa.models as models
+
+
+class Command(BaseCommand):
+    help = 'Check and time the nearest waterway query.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='+')
+        parser.add_argument(
+            '--limit', type=int, default=100,
+            help='Sites to find with the legacy loop.')
+
+    def handle(self, *args, **options):
+        sites = models.Site.objects.filter(
+            nzms_sheet__in=options['sheets']).exclude(
+            geom=None).order_by('nzaa_id')
+        if not sites.exists():
+            raise CommandError("No sites with a location on those sheets.")
+
+        start = time.time()
+        current = analyse.Site(sites).find_primary_waterways()
+        current_time = time.time() - start
+
+        sample = sites.filter(
+            nzaa_id__in=[s.nzaa_id for s in sites[:options['limit']]])
+        start = time.time()
+        legacy = analyse.Site(sample).find_primary_waterways_legacy()
+        legacy_time = time.time() - start
+
+        self.stdout.write(self.rate("query", len(current), current_time))
+        self.stdout.write(self.rate("legacy", len(legacy), legacy_time))
+
+        mismatches = 0
+        for nzaa_id in sorted(legacy):
+            (distance, name) = legacy[nzaa_id]
+            found = current.get(nzaa_id)
+            if (not found or round(found[0], 3) != round(distance, 3) or
+                    found[1] != name):
+                mismatches += 1
+                self.stdout.write("Mismatch: " + nzaa_id)
+                self.stdout.write("  legacy " + repr(legacy[nzaa_id]))
+                self.stdout.write("  query  " + repr(found))
+
+        if mismatches:
+            raise CommandError(
+                str(mismatches) + " sites have a different nearest waterway.")
+
+        self.stdout.write(str(len(legacy)) + " sites checked, all match.")
+
+    def rate(self, name, n, elapsed):
+        per_site = 0
+        if n:
+            per_site = elapsed * 1000 / n
+        return "%-8s %6d sites %8.2f s %10.2f ms/site" % (
+            name, n, elapsed, per_site)
@@ -0,0 +1,40 @@
+"""Count the sites into the SiteDensity grid again.
+
+    ./manage.py density
+    ./manage.py density S14 S15
+
+Run after sites have been changed other than by saving them, a scrape
+or reclassify. With sheets, only those are counted. See nzaa.density.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+import nzaa.density as density
+import nzaa.models as models
+
+
+class Command(BaseCommand):
+    help = 'Count the sites into the site density grid again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        if options['sheets']:
+            density.update_sheets(options['sheets'])
+            message = str(len(options['sheets'])) + " sheets counted"
+        else:
+            message = str(density.rebuild()) + " rows counted"
+
+        for size in density.SIZES:
+            cells = models.SiteDensity.objects.filter(size=size)
+            n = cells.aggregate(n=Sum('count'))['n'] or 0
+            self.stdout.write("%6d m: %7d cells, %d sites" % (
+                size, cells.values('cell_x', 'cell_y').distinct().count(), n))
+
+        self.stdout.write(message + " in %.1f s" % (time.time() - start))
@@ -0,0 +1,55 @@
+"""Fill region, TLA and island for site records in bulk.
+
+    ./manage.py enrich
+    ./manage.py enrich S14 S15 --overwrite --fields region,tla
+
+By default only empty fields are filled. The site counts of the
+sheets are made again after. See nzaa.enrich and nzaa.sitestats.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.enrich as enrich
+import nzaa.models as models
+import nzaa.sitestats as sitestats
+
+
+class Command(BaseCommand):
+    help = 'Fill region, TLA and island for site records.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+        parser.add_argument(
+            '--fields', default=None,
+            help='Comma-separated fields to fill: region, tla, island.')
+        parser.add_argument(
+            '--overwrite', action='store_true',
+            help='Refill fields which already have a value.')
+
+    def handle(self, *args, **options):
+        nzaa_ids = None
+        if options['sheets']:
+            nzaa_ids = list(models.Site.objects.filter(
+                nzms_sheet__in=options['sheets']).values_list(
+                'nzaa_id', flat=True))
+
+        fields = None
+        if options['fields']:
+            fields = options['fields'].split(',')
+
+        start = time.time()
+        updated = enrich.enrich(
+            nzaa_ids, fields=fields, overwrite=options['overwrite'])
+
+        if any(updated.values()):
+            if options['sheets']:
+                sitestats.update_sheets(options['sheets'])
+            else:
+                sitestats.rebuild()
+
+        for (field, n) in sorted(updated.items()):
+            self.stdout.write(field + ": " + str(n) + " sites")
+        self.stdout.write("%.1f s" % (time.time() - start))
@@ -0,0 +1,45 @@
+"""Fill the WGS84 and NZMG coordinates of sites which have none.
+
+    ./manage.py fillcoords
+    ./manage.py fillcoords --gridref "S14 123456" --gridref "R11/455/672"
+
+Sites saved since the fields were added have them already. With
+--gridref, convert legacy grid references to NZTM instead. See
+nzaa.coords.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.coords as coords
+
+
+class Command(BaseCommand):
+    help = 'Fill the WGS84 and NZMG coordinates of sites.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch', type=int, default=2000,
+            help='Sites to convert together.')
+        parser.add_argument(
+            '--gridref', action='append', default=[],
+            help='Convert a legacy grid reference to NZTM.')
+
+    def handle(self, *args, **options):
+        if options['gridref']:
+            points = coords.gridrefs_to_nztm(options['gridref'])
+            for (gridref, point) in zip(options['gridref'], points):
+                if point:
+                    self.stdout.write("%-16s %d %d" % (
+                        gridref, round(point[0]), round(point[1])))
+                else:
+                    self.stdout.write("%-16s not found" % gridref)
+            return
+
+        start = time.time()
+        n = coords.backfill(
+            options['batch'], verbose=options['verbosity'] > 1)
+        self.stdout.write(
+            str(n) + " sites filled in %.1f s" % (time.time() - start))
@@ -0,0 +1,35 @@
+"""Fill the footprints of sites which have none.
+
+    ./manage.py footprints
+    ./manage.py footprints --replace
+    ./manage.py footprints S14/22 S14/23
+
+A footprint is a 100 m grid square for a site given as a grid
+reference, or otherwise a circle around the site. All are written with
+one query. With --replace, existing footprints are written again. See
+nzaa.footprint.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.footprint as footprint
+
+
+class Command(BaseCommand):
+    help = 'Fill the footprints of sites.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('nzaa_ids', nargs='*')
+        parser.add_argument(
+            '--replace', action='store_true',
+            help='Write footprints of sites which have one too.')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        n = footprint.generate(
+            options['nzaa_ids'] or None, replace=options['replace'])
+        self.stdout.write(
+            str(n) + " footprints filled in %.1f s" % (time.time() - start))
@@ -0,0 +1,120 @@
+"""Find the nearest sites to every site, and report on them by sheet.
+
+    ./manage.py neighbours
+    ./manage.py neighbours S14 S15 --count 5 --distance 20000
+    ./manage.py neighbours --check 500
+
+Build the k-d tree of site locations, find the nearest sites to each
+site on the sheets (all sheets by default), and show how long each
+took, and for each sheet the number of sites and the mean and median
+distance to the nearest other site.
+
+With --check, that many sites chosen at random, with a fixed seed, are
+also looked up with a PostGIS distance query, and the command fails if
+the distances found differ. See nzaa.neighbours.
+
+"""
+
+import random
+import time
+
+import numpy
+from django.contrib.gis.db.models.functions import Distance
+from django.contrib.gis.measure import D
+from django.core.management.base import BaseCommand, CommandError
+
+import nzaa.models as models
+import nzaa.neighbours as neighbours
+
+
+class Command(BaseCommand):
+    help = 'Find the nearest sites to every site.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+        parser.add_argument(
+            '--count', type=int, default=neighbours.COUNT,
+            help='Nearest sites to find for each site.')
+        parser.add_argument(
+            '--distance', type=float, default=neighbours.DISTANCE,
+            help='Furthest distance in metres.')
+        parser.add_argument(
+            '--check', type=int, default=0,
+            help='Sites to check against PostGIS.')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        count = options['count']
+        distance = options['distance']
+
+        start = time.time()
+        tree = neighbours.load()
+        built = time.time() - start
+        if not len(tree):
+            raise CommandError("No sites with a location.")
+
+        nzaa_ids = None
+        if options['sheets']:
+            nzaa_ids = []
+            for sheet in options['sheets']:
+                nzaa_ids += tree.sheet(sheet)
+
+        start = time.time()
+        found = tree.nearest_all(nzaa_ids, count, distance)
+        elapsed = time.time() - start
+
+        self.stdout.write(
+            "%d sites loaded and built in %.2f s" % (len(tree), built))
+        rate = 0
+        if elapsed:
+            rate = len(found) / elapsed
+        self.stdout.write("%d sites searched in %.2f s, %.1f sites/s" % (
+            len(found), elapsed, rate))
+
+        self.stdout.write("%-8s %8s %12s %12s" % (
+            "Sheet", "Sites", "Mean (m)", "Median (m)"))
+        by_sheet = {}
+        for (nzaa_id, sites) in found.items():
+            sheet = tree.sheets[tree.position[nzaa_id]]
+            by_sheet.setdefault(sheet, [])
+            if sites:
+                by_sheet[sheet].append(sites[0][1])
+        for sheet in sorted(by_sheet, key=lambda s: s or ''):
+            nearest = by_sheet[sheet]
+            mean = median = 0
+            if nearest:
+                mean = numpy.mean(nearest)
+                median = numpy.median(nearest)
+            self.stdout.write("%-8s %8d %12.1f %12.1f" % (
+                sheet, len(nearest), mean, median))
+
+        if options['check']:
+            self.check_sites(found, count, distance, options['check'],
+                             options['seed'])
+
+    def check_sites(self, found, count, distance, n, seed):
+        """Compare found with PostGIS for n sites chosen at random."""
+
+        r = random.Random(seed)
+        nzaa_ids = r.sample(sorted(found), min(n, len(found)))
+
+        mismatches = 0
+        for nzaa_id in nzaa_ids:
+            site = models.Site.objects.get(nzaa_id=nzaa_id)
+            sites = models.Site.objects.filter(
+                geom__distance_lte=(site.geom, D(m=distance))).exclude(
+                nzaa_id=nzaa_id).annotate(
+                distance=Distance('geom', site.geom)).order_by('distance')
+            expected = [round(s.distance.m, 3) for s in sites[:count]]
+            got = [round(d, 3) for (other, d) in found[nzaa_id]]
+            if expected != got:
+                mismatches += 1
+                self.stdout.write("Mismatch: " + nzaa_id)
+                self.stdout.write("  PostGIS " + repr(expected))
+                self.stdout.write("  tree    " + repr(got))
+
+        if mismatches:
+            raise CommandError(
+                str(mismatches) + " sites have different nearest sites.")
+
+        self.stdout.write(str(len(nzaa_ids)) + " sites checked, all match.")
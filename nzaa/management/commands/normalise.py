@@ -0,0 +1,61 @@
+"""Fill sites' updated and visited fields from their update0 text.
+
+    ./manage.py normalise
+    ./manage.py normalise S14 S15 --workers 4 --dry-run
+    ./manage.py normalise --overwrite
+
+Find the updates described in each site's ArchSite text, and set the
+site's updated and visited dates and names from the latest of them,
+where the site has none, or for all sites with --overwrite. With
+--dry-run, the changes are listed but not written. See
+nzaa.normalise.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.normalise as normalise
+
+
+class Command(BaseCommand):
+    help = 'Fill updated and visited fields from the ArchSite text.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Worker processes. One per CPU by default.')
+        parser.add_argument(
+            '--overwrite', action='store_true',
+            help='Replace values the sites already have.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='List the changes, but write nothing.')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        (counts, changes) = normalise.normalise(
+            options['sheets'] or None, workers=options['workers'],
+            overwrite=options['overwrite'], save=not options['dry_run'],
+            verbose=options['verbosity'] > 1)
+        elapsed = time.time() - start
+
+        if options['dry_run']:
+            for (nzaa_id, field, before, after) in changes:
+                self.stdout.write("%-10s %-10s %s -> %s" % (
+                    nzaa_id, field, before, after))
+
+        for field in normalise.FIELDS:
+            self.stdout.write("%-10s %6d changed" % (
+                field, counts.get(field, 0)))
+
+        rate = 0
+        if elapsed:
+            rate = counts.get('sites', 0) / elapsed
+        verb = "would change" if options['dry_run'] else "changed"
+        self.stdout.write(
+            "%d sites in %.1f s, %.1f sites/s; %d %s, %d unreadable" % (
+                counts.get('sites', 0), elapsed, rate,
+                counts.get('changed', 0), verb, counts.get('errors', 0)))
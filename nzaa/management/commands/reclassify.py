@@ -0,0 +1,55 @@
+"""Set site type, subtype, period and ethnicity again with datamap.
+
+    ./manage.py reclassify
+    ./manage.py reclassify S14 S15 --workers 4 --dry-run
+    ./manage.py reclassify --sites
+
+Reclassify every site from its stored ArchSite values, after a change
+to the datamap vocabularies, and list how many records had each value
+before and after, where that has changed. See nzaa.reclassify.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.reclassify as reclassify
+
+
+class Command(BaseCommand):
+    help = 'Reclassify sites with the current datamap vocabularies.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+        parser.add_argument(
+            '--workers', type=int, default=None,
+            help='Number of processes. Default one per CPU.')
+        parser.add_argument(
+            '--sites', action='store_true',
+            help='Write site records too, not only update0 records.')
+        parser.add_argument(
+            '--dry-run', action='store_true',
+            help='Show the changes without writing them.')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        (before, after, changed) = reclassify.reclassify(
+            options['sheets'], workers=options['workers'],
+            sites=options['sites'], save=not options['dry_run'])
+
+        rows = reclassify.diff(before, after)
+        if rows:
+            self.stdout.write("%-8s %-10s %-44s %8s %8s %8s" % (
+                'Record', 'Field', 'Value', 'Before', 'After', 'Change'))
+        for (record, field, value, a, b) in rows:
+            self.stdout.write("%-8s %-10s %-44s %8d %8d %+8d" % (
+                record, field, value[:44], a, b, b - a))
+
+        verb = "changed"
+        if options['dry_run']:
+            verb = "would change"
+        self.stdout.write(
+            str(changed['update0']) + " update0 records and " +
+            str(changed['site']) + " site records " + verb +
+            " in %.1f s" % (time.time() - start))
@@ -0,0 +1,95 @@
+"""Scrape site records from ArchSite.
+
+    ./manage.py scrape S14/22 S15
+    ./manage.py scrape --file targets.txt --workers 4 --rate 2
+    ./manage.py scrape --replay
+    ./manage.py scrape S14/1 S14/2 --archsite http://localhost:8001
+
+Identifiers are NZAA ids or NZMS260 sheet ids. With one worker, this
+runs nzaa.scrape.Scrape; with more, nzaa.scrapepool.ScrapePool.
+
+With --replay, pages are read from the page cache (nzaa.pagecache)
+instead of ArchSite. Given no identifiers, every cached page is
+replayed.
+
+With --archsite, another server is scraped in place of ArchSite, such
+as the stand-in run by ./manage.py standin.
+
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+import nzaa.pagecache as pagecache
+import nzaa.scrape as scrape
+import nzaa.scrapepool as scrapepool
+import nzaa.settings as settings
+
+
+class Command(BaseCommand):
+    help = 'Scrape site records from ArchSite.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('identifiers', nargs='*')
+        parser.add_argument(
+            '--file', dest='listfile',
+            help='Read identifiers from a list file (see nzaa.sked).')
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help='Number of concurrent fetch workers.')
+        parser.add_argument(
+            '--rate', type=float, default=None,
+            help='Most requests per second, across all workers.')
+        parser.add_argument(
+            '--accounts', default=None,
+            help='Comma-separated keys into LOGIN_ARCHSITE.')
+        parser.add_argument(
+            '--replay', action='store_true',
+            help='Re-run extract, process and save from cached pages.')
+        parser.add_argument(
+            '--archsite', default=None,
+            help='Base URL of a server to scrape in place of ArchSite.')
+
+    def handle(self, *args, **options):
+        verbose = options['verbosity'] > 1
+        identifiers = list(options['identifiers'])
+
+        if options['listfile']:
+            s = scrape.Scrape()
+            listed = s.parse_listfile(options['listfile'])
+            if listed is None:
+                raise CommandError("No such file " + options['listfile'])
+            identifiers.extend(listed)
+
+        if options['replay']:
+            if not identifiers:
+                identifiers = pagecache.PageCache().identifiers()
+            s = scrape.Scrape(identifiers, verbose=verbose, replay=True)
+            self.stdout.write(s.metrics.table())
+            return
+
+        if not identifiers:
+            raise CommandError("Nothing to scrape.")
+
+        accounts = None
+        if options['accounts']:
+            accounts = options['accounts'].split(',')
+            for account in accounts:
+                if account not in settings.LOGIN_ARCHSITE.keys():
+                    raise CommandError("No such account " + account)
+
+        if options['workers'] > 1:
+            p = scrapepool.ScrapePool(
+                workers=options['workers'], rate=options['rate'],
+                accounts=accounts, verbose=verbose,
+                archsite=options['archsite'])
+            p.run(identifiers)
+            self.stdout.write(p.summary())
+            self.stdout.write(p.metrics.table())
+
+        else:
+            account = 'default'
+            if accounts:
+                account = accounts[0]
+            s = scrape.Scrape(identifiers, verbose=verbose, account=account,
+                              archsite=options['archsite'])
+            self.stdout.write(s.metrics.table())
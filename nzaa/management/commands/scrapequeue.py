@@ -0,0 +1,86 @@
+"""Fill and work the scrape job queue.
+
+    ./manage.py scrapequeue add S14 S15/22 --file targets.txt
+    ./manage.py scrapequeue run --batch 50
+    ./manage.py scrapequeue status
+    ./manage.py scrapequeue release
+
+Add takes NZAA ids or NZMS260 sheets; a sheet is expanded to every
+ordinal from 1 to its highest known ordinal plus 50. Run claims and
+scrapes jobs until none are due; start as many runs as you like on one
+queue. Release puts back jobs claimed by runs which were killed,
+without waiting for their lease to expire.
+
+"""
+
+from django.core.management.base import BaseCommand, CommandError
+
+import nzaa.jobqueue as jobqueue
+import nzaa.models as models
+import nzaa.scrape as scrape
+import nzaa.settings as settings
+import nzaa.sked as sked
+
+
+class Command(BaseCommand):
+    help = 'Fill and work the scrape job queue.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'action', choices=['add', 'run', 'status', 'release'])
+        parser.add_argument('identifiers', nargs='*')
+        parser.add_argument(
+            '--file', dest='listfile',
+            help='Add identifiers from a list file (see nzaa.sked).')
+        parser.add_argument(
+            '--requeue', action='store_true',
+            help='Queue again identifiers which have finished or failed.')
+        parser.add_argument(
+            '--batch', type=int, default=None,
+            help='Number of jobs claimed at a time.')
+        parser.add_argument(
+            '--limit', type=int, default=None,
+            help='Stop after this many jobs.')
+        parser.add_argument(
+            '--worker', default=None,
+            help='Worker name; release only this worker\'s jobs.')
+
+    def handle(self, *args, **options):
+        verbose = options['verbosity'] > 1
+        queue = jobqueue.JobQueue(worker=options['worker'], verbose=verbose)
+
+        if options['action'] == 'add':
+            s = scrape.Scrape()
+            identifiers = list(options['identifiers'])
+            if options['listfile']:
+                listed = s.parse_listfile(options['listfile'])
+                if listed is None:
+                    raise CommandError("No such file " + options['listfile'])
+                identifiers.extend(listed)
+
+            targets = []
+            for item in identifiers:
+                if item in settings.NZMS260:
+                    targets.extend(s.find_sheet_members(item))
+                else:
+                    targets.extend(s.scrape_this([item]))
+
+            if not targets:
+                raise CommandError("Nothing to add.")
+
+            added = sked.enqueue(targets, requeue=options['requeue'])
+            self.stdout.write(str(added) + " jobs queued.")
+
+        elif options['action'] == 'run':
+            queue.run(batch=options['batch'], limit=options['limit'])
+            self.stdout.write(queue.summary())
+            self.stdout.write(queue.metrics.table())
+
+        elif options['action'] == 'release':
+            released = queue.release(options['worker'])
+            self.stdout.write(str(released) + " jobs released.")
+
+        status = queue.status()
+        self.stdout.write(", ".join(
+            [str(status[state]) + " " + state
+             for (state, label) in models.ScrapeJob.STATE]))
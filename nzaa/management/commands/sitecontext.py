@@ -0,0 +1,38 @@
+"""Bring the stored geographic context of sites up to date.
+
+    ./manage.py sitecontext
+    ./manage.py sitecontext S14/22 S14/23
+
+Run after sites have been added or moved, or a geolib layer reloaded.
+With site ids, only those sites are looked at. See nzaa.sitecontext.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.sitecontext as sitecontext
+
+
+class Command(BaseCommand):
+    help = 'Store the geographic context of new, moved or stale sites.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('nzaa_ids', nargs='*')
+        parser.add_argument(
+            '--batch', type=int, default=500,
+            help='Sites to work out with each query.')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        counts = sitecontext.refresh(
+            options['nzaa_ids'] or None, batch_size=options['batch'],
+            verbose=options['verbosity'] > 1)
+
+        self.stdout.write(
+            str(counts['layers']) + " layers changed, " +
+            str(counts['neighbours']) + " neighbours marked stale, " +
+            str(counts['removed']) + " removed, " +
+            str(counts['stored']) + " stored in %.1f s" % (
+                time.time() - start))
@@ -0,0 +1,35 @@
+"""Count the sites into the SiteStatistic table again.
+
+    ./manage.py sitestats
+    ./manage.py sitestats S14 S15
+
+Run after sites have been changed other than by saving them, a scrape,
+reclassify or enrich. With sheets, only those are counted. See
+nzaa.sitestats.
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.sitestats as sitestats
+
+
+class Command(BaseCommand):
+    help = 'Count the sites into the site statistics table again.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sheets', nargs='*')
+
+    def handle(self, *args, **options):
+        start = time.time()
+        if options['sheets']:
+            sitestats.update_sheets(options['sheets'])
+            message = str(len(options['sheets'])) + " sheets counted"
+        else:
+            message = str(sitestats.rebuild()) + " rows counted"
+
+        self.stdout.write(
+            message + ", %d sites, in %.1f s" % (
+                sitestats.total(), time.time() - start))
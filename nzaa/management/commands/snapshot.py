@@ -0,0 +1,49 @@
+"""Write a columnar snapshot of the site records.
+
+    ./manage.py snapshot
+    ./manage.py snapshot --chunk 20000 --directory /tmp/snapshots
+    ./manage.py snapshot --list
+
+Sites, updates, actors, features and periods, with their links to
+sites, are written as compressed NumPy arrays to a new version under
+settings.SNAPSHOT_DIR. Load them with nzaa.snapshot.load().
+
+"""
+
+import time
+
+from django.core.management.base import BaseCommand
+
+import nzaa.snapshot as snapshot
+
+
+class Command(BaseCommand):
+    help = 'Write a columnar snapshot of the site records.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk', type=int, default=snapshot.CHUNK,
+            help='Rows to write to each file.')
+        parser.add_argument(
+            '--directory', default=None,
+            help='Write under this directory instead.')
+        parser.add_argument(
+            '--list', action='store_true',
+            help='List the versions written.')
+
+    def handle(self, *args, **options):
+        if options['list']:
+            for version in snapshot.versions(options['directory']):
+                self.stdout.write(version)
+            return
+
+        start = time.time()
+        path = snapshot.write(
+            options['directory'], chunk_size=options['chunk'],
+            verbose=options['verbosity'] > 1)
+
+        snap = snapshot.Snapshot(path)
+        for name in snap.names():
+            self.stdout.write("%-14s %9d rows" % (name, snap.rows(name)))
+        self.stdout.write(
+            path + " written in %.1f s" % (time.time() - start))
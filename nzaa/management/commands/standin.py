@@ -0,0 +1,66 @@
+"""Run a local stand-in for ArchSite. See nzaa.standin.
+
+    ./manage.py standin --port 8001 --latency 0.2 --jitter 0.1 \\
+        --errors 0.05 --missing 0.1 --seed 1
+
+"""
+
+from django.core.management.base import BaseCommand
+
+import nzaa.standin as standin
+
+
+def add_standin_arguments(parser):
+    """Add the options shared with benchmark_scrape."""
+
+    parser.add_argument(
+        '--latency', type=float, default=0,
+        help='Mean seconds before each site page is answered.')
+    parser.add_argument(
+        '--jitter', type=float, default=0,
+        help='Latency varies by up to this many seconds.')
+    parser.add_argument(
+        '--errors', type=float, default=0,
+        help='Fraction of site requests answered with a 503.')
+    parser.add_argument(
+        '--missing', type=float, default=0,
+        help='Fraction of sites answered with "No data was found".')
+    parser.add_argument(
+        '--expire', type=float, default=0,
+        help='Fraction of site requests answered with the login page.')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Seed for latencies and failures.')
+    parser.add_argument(
+        '--no-cache', action='store_true',
+        help='Make every page from the template; ignore the page cache.')
+
+
+def make_standin(options):
+    return standin.StandIn(
+        latency=options['latency'], jitter=options['jitter'],
+        errors=options['errors'], missing=options['missing'],
+        expire=options['expire'], seed=options['seed'],
+        use_cache=not options['no_cache'])
+
+
+class Command(BaseCommand):
+    help = 'Run a local stand-in for ArchSite.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='localhost')
+        parser.add_argument('--port', type=int, default=8001)
+        add_standin_arguments(parser)
+
+    def handle(self, *args, **options):
+        server = standin.Server(
+            make_standin(options), host=options['host'],
+            port=options['port'], verbose=options['verbosity'] > 1)
+
+        self.stdout.write("Stand-in for ArchSite at " + server.base_url())
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        server.server_close()
+        self.stdout.write(str(server.standin.counts))
@@ -0,0 +1,305 @@
+"""Timings and counts for scrape runs.
+
+A Metrics object is shared by the Scrape objects taking part in a run
+(one, or several in a ScrapePool). It keeps a histogram of the time
+spent in each phase:
+
+    login       Logging in to ArchSite through the login form.
+    fetch       Requesting a site page.
+    parse       Scrape.extract_values().
+    digest      Scrape.digest_fields().
+    classify    Scrape.process_extract(), including the datamap calls.
+    save        Writing a batch to the database.
+    enrich      Filling region, TLA and island for a batch of new sites,
+                within save.
+
+and counts of records unchanged, updated, created and missing, fetch
+errors, and bytes fetched.
+
+Each timing is appended to a JSON lines file as it is made, and a
+summary line is added at the end of the run. The file is opened at
+the first timing, and closed by close(), or at the end of a with
+block. The end of the run also writes a snapshot in the Prometheus
+text format, which can be picked up by the node exporter's textfile
+collector. Both files are in
+settings.SCRAPE_METRICS:
+
+    scrape.jsonl
+    scrape.prom
+
+"""
+
+import datetime
+import functools
+import json
+import os
+import threading
+import time
+
+import pytz
+
+import settings
+
+
+# Upper bounds of the histogram buckets, in seconds.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PHASES = ('login', 'fetch', 'parse', 'digest', 'classify', 'save', 'enrich')
+
+# Phases timed within another, as phase: outer phase. They are left out
+# of the total in table().
+NESTED = {'enrich': 'save'}
+
+COUNTERS = (
+    'unchanged', 'updated', 'created', 'missing', 'errors', 'bytes')
+
+
+def timed(phase):
+    """Decorate a method of an object with a metrics attribute.
+
+    Time each call to the method as phase.
+
+    """
+
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(phase):
+                return method(self, *args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+class Timer():
+    """Context manager timing a phase for Metrics.timer()."""
+
+    def __init__(self, metrics, phase):
+        self.metrics = metrics
+        self.phase = phase
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.phase, time.time() - self.start)
+        return False
+
+
+class Metrics():
+    """Histograms of phase timings, and counters, for one run.
+
+    With a directory (settings.SCRAPE_METRICS by default), timings are
+    written there as they are made. A directory of False keeps
+    everything in memory. The file is kept open until close(), which
+    a with statement calls:
+
+        with Metrics() as metrics:
+            ...
+
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        if directory is None:
+            self.directory = settings.SCRAPE_METRICS
+
+        self.started = time.time()
+        self.run = (datetime.datetime.now(pytz.utc).strftime('%Y%m%dT%H%M%S')
+                    + '-' + str(os.getpid()))
+        self.lock = threading.Lock()
+
+        self.histograms = {}
+        for phase in PHASES:
+            self.histograms[phase] = self.new_histogram()
+
+        self.counts = dict([(name, 0) for name in COUNTERS])
+
+        self.jsonl = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, record):
+        """Append a record to the JSON lines file, opening it if need be.
+
+        Called with the lock held.
+
+        """
+
+        if not self.directory:
+            return
+
+        if not self.jsonl:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            self.jsonl = open(
+                os.path.join(self.directory, 'scrape.jsonl'), 'a')
+
+        self.jsonl.write(json.dumps(record) + '\n')
+
+    def close(self):
+        """Close the JSON lines file. A later timing opens it again."""
+
+        with self.lock:
+            if self.jsonl:
+                self.jsonl.close()
+                self.jsonl = None
+
+    def new_histogram(self):
+        return {
+            'buckets': [0] * len(BUCKETS),
+            'count': 0,
+            'sum': 0.0,
+            'max': 0.0,
+        }
+
+    def timer(self, phase):
+        """Return a context manager which times its block as phase."""
+
+        return Timer(self, phase)
+
+    def observe(self, phase, seconds):
+        """Add a timing to the histogram for phase."""
+
+        with self.lock:
+            h = self.histograms.setdefault(phase, self.new_histogram())
+            for n, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    h['buckets'][n] += 1
+            h['count'] += 1
+            h['sum'] += seconds
+            h['max'] = max(h['max'], seconds)
+
+            self.write({
+                'run': self.run,
+                'time': round(time.time(), 3),
+                'phase': phase,
+                'seconds': round(seconds, 6),
+            })
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def elapsed(self):
+        return time.time() - self.started
+
+    def prometheus(self):
+        """Return the metrics in the Prometheus text format."""
+
+        lines = [
+            '# HELP nzaa_scrape_phase_seconds Time spent in each phase.',
+            '# TYPE nzaa_scrape_phase_seconds histogram',
+        ]
+        for phase in sorted(self.histograms.keys()):
+            h = self.histograms[phase]
+            label = 'phase="' + phase + '"'
+            for n, bound in enumerate(BUCKETS):
+                lines.append(
+                    'nzaa_scrape_phase_seconds_bucket{' + label +
+                    ',le="' + str(bound) + '"} ' + str(h['buckets'][n]))
+            lines.append(
+                'nzaa_scrape_phase_seconds_bucket{' + label +
+                ',le="+Inf"} ' + str(h['count']))
+            lines.append(
+                'nzaa_scrape_phase_seconds_sum{' + label + '} ' +
+                repr(h['sum']))
+            lines.append(
+                'nzaa_scrape_phase_seconds_count{' + label + '} ' +
+                str(h['count']))
+
+        lines.append('# HELP nzaa_scrape_records Records by outcome.')
+        lines.append('# TYPE nzaa_scrape_records counter')
+        for name in ('unchanged', 'updated', 'created', 'missing', 'errors'):
+            lines.append('nzaa_scrape_records{outcome="' + name + '"} ' +
+                         str(self.counts.get(name, 0)))
+
+        lines.append('# HELP nzaa_scrape_fetched_bytes Bytes fetched.')
+        lines.append('# TYPE nzaa_scrape_fetched_bytes counter')
+        lines.append('nzaa_scrape_fetched_bytes ' +
+                     str(self.counts.get('bytes', 0)))
+
+        lines.append('# HELP nzaa_scrape_run_seconds Length of the run.')
+        lines.append('# TYPE nzaa_scrape_run_seconds gauge')
+        lines.append('nzaa_scrape_run_seconds ' + repr(self.elapsed()))
+
+        return '\n'.join(lines) + '\n'
+
+    def table(self):
+        """Return a summary table of the run, as text.
+
+        Each phase's share of the run is given as a percentage. A phase
+        timed within another is indented under it, and left out of the
+        total, as its time is already counted in the outer phase.
+
+        """
+
+        row = "%-10s %8s %10.2f %9s %9s %7.1f"
+        lines = ["%-10s %8s %10s %9s %9s %7s" % (
+            'Phase', 'Calls', 'Total s', 'Mean ms', 'Max ms', '%')]
+
+        elapsed = self.elapsed()
+        total = 0.0
+        for phase in PHASES + tuple(
+                sorted(set(self.histograms.keys()) - set(PHASES))):
+            h = self.histograms[phase]
+            if not h['count']:
+                continue
+            mean = h['sum'] / h['count'] * 1000
+            share = 0
+            if elapsed:
+                share = h['sum'] / elapsed * 100
+            name = phase
+            if phase in NESTED:
+                name = '  ' + phase
+            else:
+                total += h['sum']
+            lines.append(row % (
+                name, h['count'], h['sum'], '%.1f' % mean,
+                '%.1f' % (h['max'] * 1000), share))
+
+        share = 0
+        if elapsed:
+            share = total / elapsed * 100
+        lines.append(row % ('Total', '', total, '', '', share))
+
+        lines.append('')
+        lines.append(', '.join(
+            [str(self.counts.get(name, 0)) + ' ' + name
+             for name in COUNTERS]) + ' in ' + str(int(elapsed)) + ' s')
+
+        return '\n'.join(lines)
+
+    def report(self):
+        """Finish the run: write the summary and snapshot files.
+
+        Return the summary table.
+
+        """
+
+        if self.directory:
+            with self.lock:
+                summary = {
+                    'run': self.run,
+                    'time': round(time.time(), 3),
+                    'elapsed': round(self.elapsed(), 3),
+                    'counts': self.counts,
+                    'phases': self.histograms,
+                }
+                self.write({'summary': summary})
+                self.jsonl.flush()
+
+            path = os.path.join(self.directory, 'scrape.prom')
+            tmp = path + '.' + str(os.getpid()) + '.tmp'
+            f = open(tmp, 'w')
+            f.write(self.prometheus())
+            f.close()
+            os.rename(tmp, path)
+
+        return self.table()
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 10:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nzaa', '0005_auto_20191021_1136'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='changed_fields',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='field_digests',
+            field=models.TextField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 14:02
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nzaa', '0006_site_field_digests'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScrapeJob',
+            fields=[
+                ('nzaa_id', models.CharField(max_length=20, primary_key=True, serialize=False)),
+                ('state', models.CharField(choices=[('queued', 'queued'), ('claimed', 'claimed'), ('done', 'done'), ('missing', 'missing'), ('failed', 'failed')], db_index=True, default='queued', max_length=16)),
+                ('attempts', models.IntegerField(default=0)),
+                ('last_error', models.TextField(blank=True, null=True)),
+                ('next_eligible', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('claimed_by', models.CharField(blank=True, max_length=255, null=True)),
+                ('claimed_at', models.DateTimeField(blank=True, null=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('finished', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['next_eligible', 'nzaa_id'],
+            },
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 15:37
+from __future__ import unicode_literals
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nzaa', '0007_scrapejob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerVersion',
+            fields=[
+                ('table', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('version', models.BigIntegerField(blank=True, null=True)),
+                ('checked', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='SiteContext',
+            fields=[
+                ('nzaa_id', models.CharField(max_length=10, primary_key=True, serialize=False)),
+                ('geom', django.contrib.gis.db.models.fields.PointField(srid=2193)),
+                ('context', models.TextField()),
+                ('sites_radius', models.FloatField()),
+                ('stale', models.BooleanField(db_index=True, default=False)),
+                ('refreshed', models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 16:21
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nzaa', '0008_sitecontext'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='site',
+            name='nzmg_easting',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='nzmg_northing',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='wgs84_lat',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='site',
+            name='wgs84_lon',
+            field=models.FloatField(blank=True, editable=False, null=True),
+        ),
+    ]
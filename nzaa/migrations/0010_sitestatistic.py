@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 19:12
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+KEY = ('"nzms_sheet", "region", "tla", "site_type", "lgcy_type", '
+       '"period", "record_quality"')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nzaa', '0009_site_coordinates'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('nzms_sheet', models.CharField(db_index=True, max_length=10)),
+                ('region', models.CharField(blank=True, max_length=255, null=True)),
+                ('tla', models.TextField(blank=True, null=True)),
+                ('site_type', models.CharField(blank=True, max_length=255, null=True)),
+                ('lgcy_type', models.TextField(blank=True, null=True)),
+                ('period', models.CharField(blank=True, max_length=255, null=True)),
+                ('record_quality', models.CharField(blank=True, max_length=255, null=True)),
+                ('count', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.RunSQL(
+            'INSERT INTO nzaa_sitestatistic (' + KEY + ', "count") '
+            'SELECT ' + KEY + ', count(*) FROM nzaa_site GROUP BY ' + KEY,
+            'DELETE FROM nzaa_sitestatistic'),
+    ]
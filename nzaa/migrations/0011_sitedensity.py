@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 21:04
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nzaa', '0010_sitestatistic'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SiteDensity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('size', models.PositiveIntegerField()),
+                ('cell_x', models.IntegerField()),
+                ('cell_y', models.IntegerField()),
+                ('nzms_sheet', models.CharField(db_index=True, max_length=10)),
+                ('site_type', models.CharField(blank=True, max_length=255, null=True)),
+                ('count', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='sitedensity',
+            index_together=set([('size', 'cell_x', 'cell_y')]),
+        ),
+        migrations.RunSQL(
+            'INSERT INTO nzaa_sitedensity ("size", "cell_x", "cell_y", '
+            '"nzms_sheet", "site_type", "count") '
+            'SELECT z.size, floor(ST_X(s."geom") / z.size)::integer, '
+            'floor(ST_Y(s."geom") / z.size)::integer, '
+            's."nzms_sheet", s."site_type", count(*) '
+            'FROM nzaa_site s, unnest(ARRAY[250, 1000, 5000, 25000]) '
+            'AS z(size) WHERE s."geom" IS NOT NULL '
+            'GROUP BY 1, 2, 3, 4, 5',
+            'DELETE FROM nzaa_sitedensity'),
+    ]
@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.17 on 2026-10-18 22:10
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def merge_terms(table, field):
+    """Return SQL moving the sites of duplicate terms to the oldest."""
+
+    owner = table[len('nzaa_'):] + '_id'
+    duplicates = (
+        '(SELECT "id", min("id") OVER (PARTITION BY "' + field + '") '
+        'AS "keep" FROM ' + table + ')')
+
+    return [
+        'INSERT INTO ' + table + '_sites ("' + owner + '", "site_id") '
+        'SELECT DISTINCT d."keep", l."site_id" '
+        'FROM ' + table + '_sites l JOIN ' + duplicates + ' d '
+        'ON l."' + owner + '" = d."id" WHERE d."id" <> d."keep" '
+        'ON CONFLICT DO NOTHING',
+        'DELETE FROM ' + table + '_sites WHERE "' + owner + '" IN '
+        '(SELECT "id" FROM ' + duplicates + ' d WHERE "id" <> "keep")',
+        'DELETE FROM ' + table + ' WHERE "id" IN '
+        '(SELECT "id" FROM ' + duplicates + ' d WHERE "id" <> "keep")',
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('nzaa', '0011_sitedensity'),
+    ]
+
+    operations = [
+        migrations.RunSQL(
+            merge_terms('nzaa_actor', 'sourcename'), migrations.RunSQL.noop),
+        migrations.RunSQL(
+            merge_terms('nzaa_feature', 'name'), migrations.RunSQL.noop),
+        migrations.RunSQL(
+            merge_terms('nzaa_periods', 'name'), migrations.RunSQL.noop),
+        migrations.AlterField(
+            model_name='actor',
+            name='sourcename',
+            field=models.CharField(max_length=1024, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='feature',
+            name='name',
+            field=models.CharField(max_length=1024, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='periods',
+            name='name',
+            field=models.CharField(max_length=1024, unique=True),
+        ),
+    ]
@@ -22,6 +22,7 @@ from __future__ import unicode_literals
 import os
 import re
 import datetime
+import json
 from textwrap import TextWrapper, wrap
 import pytz
 from markdown2 import markdown
@@ -34,8 +35,15 @@ from django.contrib.gis.measure import D
 from django.contrib.gis.db.models.functions import Distance
 
 import geolib
+import geolib.spatialindex
 import members
+import neighbours
+import coords
+import density
+import footprint
 import settings
+import sitecontext
+import sitestats
 import utils
 import webnote
 import webnote.settings
@@ -185,17 +193,25 @@ class Record(models.Model):
     def save(self, log=None, *args, **kwargs):
         """Overide save() to provide logging facilities."""
 
+        self.stamp(log=log)
+        super(Record, self).save(*args, **kwargs)
+
+    def stamp(self, log=None):
+        """Do the work save() does before writing to the database.
+
+        Set the geometry from the easting and northing, make sure the
+        filespace exists, and append a line to the record's log field
+        and its log file. Bulk writes, which don't call save(), call
+        this on each record first.
+
+        """
+
         now = datetime.datetime.now(pytz.timezone('NZ'))
         timestamp = unicode(now.replace(microsecond=0))
         ipno = '127.0.0.1'
         user = 'machine'
         comment = 'Saving from unlogged command.'
 
-        self.geom = Point(int(self.easting), int(self.northing), srid=2193)
-
-        if not os.path.isdir(self.filespace_path()):
-            os.makedirs(self.filespace_path())
-
         if log:
             ipno = log[0]
             user = log[1]
@@ -226,8 +242,6 @@ class Record(models.Model):
         f.write(line)
         f.close()
 
-        super(Record, self).save(*args, **kwargs)
-
     def airphotos(self):
         """List the objects in geolb.AerialFrame intersecting with this object.
 
@@ -290,25 +304,31 @@ class Record(models.Model):
         return None
 
     def closest_sites(self):
-        """Return (nzaa_id, distance) for the n closest sites to this site. """
+        """Return (nzaa_id, distance) for the n closest sites to this site.
 
-        n = 3 + 1
-        i1 = Site.objects.filter(
-            geom__distance_lte=(self.geom, D(m=100000)))
-        i2 = i1.annotate(
-            distance=Distance('geom', self.geom)).order_by('distance')
+        From the k-d tree of site locations. See nzaa.neighbours.
 
-        if len(i2) < n:
-            n = len(i2)
+        """
 
-        sites = []
+        if not self.geom:
+            return []
 
-        for i in range(0, n):
-            if not i2[i].nzaa_id == self.nzaa_id:
-                line = (i2[i].nzaa_id, self.geom.distance(i2[i].geom))
-                sites.append(line)
+        return neighbours.get_tree().nearest_point(
+            self.geom.x, self.geom.y, exclude=getattr(self, 'nzaa_id', None))
 
-        return sites
+    def compute_footprint(self):
+        """Return a polygon geometry describing the extent of the site.
+
+        If the MZTM coords resolve to an NZMS260 grid reference (of
+        six digits), then the geometry is a square, 100 m on a side,
+        with the south west corner sitting on the coords.
+
+        Otherwise, the geometry is a circle 50 m, centred on the
+        coords. See nzaa.footprint.
+
+        """
+
+        return footprint.polygon(self)
 
     def display_assoc_sites(self):
         return self.associated_sites
@@ -432,6 +452,17 @@ class Record(models.Model):
     def footprint(self):
         return self.geom_poly
 
+    def geo_context(self):
+        """Return the geographic context of the record, for display.
+
+        A dictionary of the closest places, road and sites, and the map
+        sheets, parcel, aerial photographs and orthophoto tiles at the
+        record's location. See nzaa.sitecontext.
+
+        """
+
+        return sitecontext.live_context(self)
+
     def get_aerialframes(self):
         """Historic photos on which this site may be visible.
 
@@ -468,6 +499,9 @@ class Record(models.Model):
 
         """
 
+        if geolib.spatialindex.ENABLED:
+            return geolib.spatialindex.value('island', self.geom, 10000)
+
         try:
             i = geolib.models.Topo50_Island.objects.get(
                 geom__intersects=self.geom)
@@ -489,6 +523,10 @@ class Record(models.Model):
     def get_nzms_sheet(self):
         """Return the NZMS260 map object the site is found on."""
 
+        if geolib.spatialindex.ENABLED:
+            return (geolib.spatialindex.first('nzms260', self.geom) or
+                    geolib.spatialindex.first('nzmsgrid', self.geom))
+
         r = geolib.models.TopoMap.objects.filter(
             series_id='NZMS260', geom__intersects=self.geom)
         if r.count():
@@ -515,7 +553,7 @@ class Record(models.Model):
 
         """
 
-        if not self.footprint:
+        if not self.geom_poly:
             self.geom_poly = self.compute_footprint()
 
         p = geolib.models.Cadastre.objects.filter(
@@ -526,6 +564,9 @@ class Record(models.Model):
     def get_region(self):
         """Return the name of the region the site is found in."""
 
+        if geolib.spatialindex.ENABLED:
+            return geolib.spatialindex.value('region', self.geom, 10000)
+
         try:
             r = geolib.models.Region.objects.get(geom__intersects=self.geom)
             return r.name
@@ -541,6 +582,9 @@ class Record(models.Model):
     def get_tla(self):
         """Return the name of the territorial authority the site is in."""
 
+        if geolib.spatialindex.ENABLED:
+            return geolib.spatialindex.value('tla', self.geom, 10000)
+
         try:
             ta = geolib.models.TerritorialAuthority.objects.get(
                 geom__intersects=self.geom)
@@ -561,6 +605,9 @@ class Record(models.Model):
         This is from a geographic calculation, not from the nzaa_id.
         """
 
+        if geolib.spatialindex.ENABLED:
+            return geolib.spatialindex.values('topo50', self.geom)[0]
+
         r = geolib.models.TopoMap.objects.filter(
             series_id='TOPO50', geom__intersects=self.geom)
         return r[0]
@@ -569,9 +616,7 @@ class Record(models.Model):
         return str(self.lgcy_easting) + " " + str(self.lgcy_northing)
 
     def latitude(self):
-        p = Point(self.geom.x, self.geom.y, srid=2193)
-        p.transform(4326)
-        return p.y
+        return coords.of(self)[1]
 
     def lidar_tiles(self):
         """List the objects from IndesLidar intersecting with this object.
@@ -615,11 +660,6 @@ class Record(models.Model):
 
         """
 
-        p = Point(self.geom.x, self.geom.y, srid=2193)
-        p.transform(27200)
-        x = str(int(p.x))[:-1]
-        y = str(int(p.y) + 1)[:-1]
-
         sourcenames = []
         if self.visited_by:
             names = self.visited_by.split(';')
@@ -707,9 +747,7 @@ class Record(models.Model):
         return text
 
     def longitude(self):
-        p = Point(self.geom.x, self.geom.y, srid=2193)
-        p.transform(4326)
-        return p.x
+        return coords.of(self)[0]
 
     def mapfile(self):
         """Return a dictionary structure cpntaining variables for a mapfile.
@@ -767,21 +805,12 @@ class Record(models.Model):
         common enough occurrance to need some sort of solution.
 
         That solution was to truncate the last digit, then find the
-        modulus of 10.
+        modulus of 10. See coords.nzmg_display().
 
         """
 
-        p = Point(self.geom.x, self.geom.y, srid=2193)
-        p.transform(27200)
-        x = str(int(p.x))[:-1]
-        y = str(int(p.y) + 1)[:-1]
-
-        if int(x) % 10 == 0 and int(y) % 10 == 0:
-            x = str(int(p.x))[2:-2]
-            y = str(int(p.y))[2:-2]
-            return "NZMG Grid ref " + x + " " + y
-
-        return str(int(p.x)) + " " + str(int(p.y))
+        (lon, lat, x, y) = coords.of(self)
+        return coords.nzmg_display(x, y)
 
     def nzmg_gridref(self):
         """Return True if the geometry resolves to a grid reference.
@@ -794,16 +823,9 @@ class Record(models.Model):
         back to NZMG, and testing for divisibility by 100.
 
         """
-        p = Point(self.geom.x, self.geom.y, srid=2193)
-        p.transform(27200)
 
-        x = str(int(p.x))[:-1]
-        y = str(int(p.y) + 1)[:-1]
-
-        if int(x) % 10 == 0 and int(y) % 10 == 0:
-            return True
-
-        return False
+        (lon, lat, x, y) = coords.of(self)
+        return coords.is_gridref(x, y)
 
     def nztm_coords(self):
         coords = str(self.easting) + '&nbsp;' + str(self.northing)
@@ -960,6 +982,13 @@ class Site(Record):
     island = models.TextField(
         verbose_name='Island', blank=True, null=True)
 
+#   The location in other coordinate systems, set from geom by
+#   stamp(). See nzaa.coords.
+    wgs84_lon = models.FloatField(editable=False, blank=True, null=True)
+    wgs84_lat = models.FloatField(editable=False, blank=True, null=True)
+    nzmg_easting = models.FloatField(editable=False, blank=True, null=True)
+    nzmg_northing = models.FloatField(editable=False, blank=True, null=True)
+
 #   Record metadata
     record_quality = models.CharField(
         max_length=255, choices=RECORD_QUALITY,
@@ -1060,6 +1089,12 @@ class Site(Record):
     )
     last_change = models.DateTimeField(editable=False, blank=True, null=True)
 
+#   MD5 digests of each scraped value, as a JSON object, and a comma
+#   separated list of the values which differed at the last change.
+#   See scrape.Scrape.digest_fields.
+    field_digests = models.TextField(editable=False, blank=True, null=True)
+    changed_fields = models.TextField(editable=False, blank=True, null=True)
+
     class Meta:
         ordering = ['nzms_sheet', 'ordinal']
         get_latest_by = 'recorded'
@@ -1084,18 +1119,6 @@ class Site(Record):
 
         return False
 
-    def compute_footprint(self):
-        """Return a polygon geometry describing the extent of the site.
-
-        If the MZTM coords resolve to an NZMS260 grid reference (of
-        six digits), then the geometry is a square, 100 m on a side,
-        with the south west corner sitting on the coords.
-
-        Otherwise, the geometry is a circle 50 m, centred on the
-        coords.
-
-        """
-
     def count_files(self):
         """Number of files in a filespace."""
 
@@ -1105,6 +1128,24 @@ class Site(Record):
 
         return count
 
+    def delete(self, *args, **kwargs):
+        """Delete the site, and count the sites on the sheet again.
+
+        The sites and density cells on its old and new sheets are
+        counted, and the sites near it have their contexts refreshed,
+        once the transaction commits. See
+        nzaa.sitestats, nzaa.density and nzaa.sitecontext.
+
+        """
+
+        result = super(Site, self).delete(*args, **kwargs)
+        sheets = [self.nzms_sheet, self.loaded('nzms_sheet')]
+        sitestats.update_sheets_on_commit(sheets)
+        density.update_sheets_on_commit(sheets)
+        if self.geom is not None:
+            sitecontext.refresh_on_commit([self.nzaa_id])
+        return result
+
     def display_associated_sites(self):
         sites = self.replace_temp_ids(self.associated_sites)
         sites = self.link_site_ids(sites)
@@ -1141,6 +1182,11 @@ class Site(Record):
 
         return result
 
+    def display_changed_fields(self):
+        if self.changed_fields is None:
+            return "All"
+        return ", ".join(self.list_changed_fields())
+
     def display_finder_aid(self):
         """Replace the superclass description with this method.
 
@@ -1224,6 +1270,25 @@ class Site(Record):
         documents = Document.objects.filter(id__in=doc_ids)
         return documents
 
+    def edited(self, *fields):
+        """True if any of fields differs from its value when loaded.
+
+        Always true of a site not loaded from the database, or loaded
+        without one of the fields.
+
+        """
+
+        loaded = getattr(self, '_loaded', None)
+        if loaded is None:
+            return True
+
+        for field in fields:
+            if field not in loaded or not loaded[field] == getattr(
+                    self, field):
+                return True
+
+        return False
+
     def filespace_path(self):
         """Return a string filepath to the object's filespace.
 
@@ -1253,11 +1318,44 @@ class Site(Record):
 
         return d
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        """Load a site, keeping its values for edited()."""
+
+        site = super(Site, cls).from_db(db, field_names, values)
+        site._loaded = dict(zip(field_names, values))
+        return site
+
+    def geo_context(self):
+        """Return the geographic context, from the SiteContext table."""
+
+        return sitecontext.context(self)
+
+    def get_field_digests(self):
+        """Return the dictionary of scraped value digests, or {}."""
+
+        if not self.field_digests:
+            return {}
+        return json.loads(self.field_digests)
+
     def get_siteLists(self):
         """return a queryset of sitelist objects this site belongs to.
         """
         return self.sitelist_set.all()
 
+    def has_changed(self, field):
+        """True if the scraped value field changed at the last change.
+
+        Field is a key of the extract (see scrape.Scrape.extract_values).
+        A new site, or one scraped before field digests were kept, is
+        taken to have changed in every field.
+
+        """
+
+        if self.changed_fields is None:
+            return True
+        return field in self.list_changed_fields()
+
     def latest_review(self):
         """Return one review record, the latest for this site record.
         """
@@ -1269,6 +1367,16 @@ class Site(Record):
         coords += str(self.lgcy_easting) + ' ' + str(self.lgcy_northing)
         return coords
 
+    def list_changed_fields(self):
+        if not self.changed_fields:
+            return []
+        return self.changed_fields.split(',')
+
+    def loaded(self, field):
+        """The value of field when the site was loaded, or None."""
+
+        return (getattr(self, '_loaded', None) or {}).get(field)
+
     def next_update(self):
         """Return an integer ordinal for the next update record."""
         return self.updates[0].ordinal + 1
@@ -1309,6 +1417,31 @@ class Site(Record):
         """Return a queryset of updates with opstatus != None."""
         return self.updates().exclude(opstatus=None)
 
+    def save(self, log=None, *args, **kwargs):
+        """Record.save(), and count the sites on the sheet again.
+
+        If the site is new, or one of the sitestats.KEY fields has
+        changed, the sites on its old and new sheets are counted again
+        once the transaction commits, and their density cells if its
+        geom, site_type or nzms_sheet has. If the site is new or has
+        moved, the context of the site, and of the sites near it, is
+        refreshed then too. See nzaa.sitestats, nzaa.density and
+        nzaa.sitecontext.
+
+        """
+
+        super(Site, self).save(log, *args, **kwargs)
+        sheets = [self.nzms_sheet, self.loaded('nzms_sheet')]
+        if self.edited(*sitestats.KEY):
+            sitestats.update_sheets_on_commit(sheets)
+        if self.edited('geom', 'site_type', 'nzms_sheet'):
+            density.update_sheets_on_commit(sheets)
+        if self.edited('geom'):
+            sitecontext.refresh_on_commit([self.nzaa_id])
+
+        self._loaded = dict([(f.attname, getattr(self, f.attname))
+                             for f in self._meta.concrete_fields])
+
     def set_update(self, update_id):
         """When calling a specific update.
 
@@ -1334,6 +1467,18 @@ class Site(Record):
 
         return self.lgcy_shortdesc
 
+    def stamp(self, log=None, coordinates=True):
+        """Record.stamp(), and set the WGS84 and NZMG coordinates.
+
+        A bulk write of many sites passes coordinates=False, and sets
+        them for all the sites at once with coords.fill().
+
+        """
+
+        super(Site, self).stamp(log=log)
+        if coordinates:
+            coords.fill([self])
+
     def title(self):
         """Compute a string value for the site title.
 
@@ -1567,7 +1712,7 @@ class Actor(models.Model):
     """
 
     sites = models.ManyToManyField(Site)
-    sourcename = models.CharField(max_length=1024)
+    sourcename = models.CharField(max_length=1024, unique=True)
     fullname = models.CharField(max_length=255, blank=True, null=True)
 
     class Meta:
@@ -1593,7 +1738,7 @@ class Feature(models.Model):
     """
 
     sites = models.ManyToManyField(Site)
-    name = models.CharField(max_length=1024)
+    name = models.CharField(max_length=1024, unique=True)
 
     class Meta:
         ordering = ['name']
@@ -1617,7 +1762,7 @@ class Periods(models.Model):
     """
 
     sites = models.ManyToManyField(Site)
-    name = models.CharField(max_length=1024)
+    name = models.CharField(max_length=1024, unique=True)
 
     class Meta:
         ordering = ['name']
@@ -2885,3 +3030,126 @@ class SiteReview(models.Model):
         }
 
         return old_values
+
+
+class ScrapeJob(models.Model):
+    """One site to be fetched from ArchSite. See nzaa.jobqueue.
+
+    A job is queued, then claimed by a worker, which marks it done
+    (saved), missing (no such site) or, after too many failed
+    attempts, failed. A transient failure puts the job back in the
+    queue, not to be claimed again before next_eligible.
+
+    A claim expires after settings.SCRAPE_JOB_LEASE seconds, so the
+    jobs held by a worker which was killed are claimed again.
+
+    """
+
+    STATE = (
+        ('queued', 'queued'),
+        ('claimed', 'claimed'),
+        ('done', 'done'),
+        ('missing', 'missing'),
+        ('failed', 'failed'),
+    )
+
+    nzaa_id = models.CharField(max_length=20, primary_key=True)
+    state = models.CharField(
+        max_length=16, choices=STATE, default='queued', db_index=True)
+    attempts = models.IntegerField(default=0)
+    last_error = models.TextField(blank=True, null=True)
+    next_eligible = models.DateTimeField(default=timezone.now, db_index=True)
+    claimed_by = models.CharField(max_length=255, blank=True, null=True)
+    claimed_at = models.DateTimeField(blank=True, null=True)
+    created = models.DateTimeField(auto_now_add=True, editable=False)
+    finished = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['next_eligible', 'nzaa_id']
+
+    def __unicode__(self):
+        return self.nzaa_id + ' ' + self.state
+
+
+class SiteContext(models.Model):
+    """The geographic context of a site, stored for the site page.
+
+    Context is the JSON of the dictionary made by
+    sitecontext.make_context(). Geom is the site's location when it was
+    made, and sites_radius the distance of the furthest of its closest
+    sites. See nzaa.sitecontext.
+
+    """
+
+    nzaa_id = models.CharField(max_length=10, primary_key=True)
+    geom = models.PointField(srid=2193)
+    context = models.TextField()
+    sites_radius = models.FloatField()
+    stale = models.BooleanField(default=False, db_index=True)
+    refreshed = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.nzaa_id
+
+    def get_context(self):
+        return json.loads(self.context)
+
+
+class LayerVersion(models.Model):
+    """The last seen row count of a geolib layer's table.
+
+    See nzaa.sitecontext.check_layers().
+
+    """
+
+    table = models.CharField(max_length=255, primary_key=True)
+    version = models.BigIntegerField(blank=True, null=True)
+    checked = models.DateTimeField()
+
+    def __unicode__(self):
+        return self.table + ' ' + unicode(self.version)
+
+
+class SiteStatistic(models.Model):
+    """The number of sites sharing a sheet, region, TLA, type and so on.
+
+    One row for each combination of the sitestats.KEY fields found in
+    the site table. See nzaa.sitestats.
+
+    """
+
+    nzms_sheet = models.CharField(max_length=10, db_index=True)
+    region = models.CharField(max_length=255, blank=True, null=True)
+    tla = models.TextField(blank=True, null=True)
+    site_type = models.CharField(max_length=255, blank=True, null=True)
+    lgcy_type = models.TextField(blank=True, null=True)
+    period = models.CharField(max_length=255, blank=True, null=True)
+    record_quality = models.CharField(max_length=255, blank=True, null=True)
+    count = models.PositiveIntegerField()
+
+    def __unicode__(self):
+        return self.nzms_sheet + ' ' + unicode(self.count)
+
+
+class SiteDensity(models.Model):
+    """The number of sites of a sheet and type in a grid cell.
+
+    Cells are squares of size metres, cell_x and cell_y being the NZTM
+    easting and northing of the south west corner over size. See
+    nzaa.density.
+
+    """
+
+    size = models.PositiveIntegerField()
+    cell_x = models.IntegerField()
+    cell_y = models.IntegerField()
+    nzms_sheet = models.CharField(max_length=10, db_index=True)
+    site_type = models.CharField(max_length=255, blank=True, null=True)
+    count = models.PositiveIntegerField()
+
+    class Meta:
+        index_together = [('size', 'cell_x', 'cell_y')]
+
+    def __unicode__(self):
+        return (unicode(self.size) + ' ' + unicode(self.cell_x) + ' ' +
+                unicode(self.cell_y) + ' ' + unicode(self.count))
@@ -0,0 +1,340 @@
+"""The nearest sites to a site, from a k-d tree of every site's location.
+
+Record.closest_sites() used to ask PostGIS for the sites within 100 km
+of a site, ordered by distance, and then read the first few one query
+at a time. Instead, the NZTM eastings and northings of all the sites
+are read once into NumPy arrays and split into a k-d tree, which
+answers nearest neighbour queries for one site, a sheet or every site
+at once:
+
+    import nzaa.neighbours as neighbours
+    tree = neighbours.get_tree()
+    tree.nearest('S14/12')
+    [('S14/13', 84.2), ('S14/9', 310.0), ('S14/31', 402.5)]
+    tree.nearest_all(tree.sheet('S14'))
+    {'S14/12': [...], 'S14/13': [...], ...}
+
+Every answer is a list of (nzaa_id, distance) in order of distance,
+leaving out the site itself, and any site further away than distance.
+
+The tree is kept by each process and built again when a site has been
+saved or deleted in the process, or when PostgreSQL's count of rows
+written to the site table has changed, looked at no more than once
+every settings.NEIGHBOURS_CHECK seconds.
+
+"""
+
+import threading
+import time
+
+import numpy
+from django.db.models.signals import post_delete, post_save
+
+import geolib.spatialindex
+import models
+import settings
+
+
+COUNT = 3
+DISTANCE = 100000
+
+# Most sites in a leaf of the tree.
+LEAF_SIZE = 32
+
+
+def squared_distances(points, others):
+    """Return the squared distances between two arrays of (x, y).
+
+    As an array with a row for each of points.
+
+    """
+
+    dx = points[:, 0, None] - others[None, :, 0]
+    dy = points[:, 1, None] - others[None, :, 1]
+    return dx * dx + dy * dy
+
+
+class SiteTree():
+    """A k-d tree of site locations.
+
+    Ids, sheets and points are sequences of the same length: the
+    nzaa_id, NZMS 260 sheet and NZTM (easting, northing) of each site.
+    The tree is split at the median of the wider of its two axes until
+    a node holds no more than leaf_size sites. The sites are kept in
+    tree order, so each node's sites are a slice of the arrays.
+
+    """
+
+    def __init__(self, ids, sheets, points, leaf_size=LEAF_SIZE):
+        self.leaf_size = leaf_size
+        points = numpy.array(points, dtype=float).reshape(-1, 2)
+
+        # For each node: (xmin, ymin, xmax, ymax), the slice of sites
+        # beneath it, and its two children, or None for a leaf.
+        self.boxes = []
+        self.ranges = []
+        self.children = []
+
+        order = numpy.arange(len(points))
+        self.leaf_of = numpy.zeros(len(points), dtype=int)
+        if len(points):
+            self.split(points, order, 0, len(points))
+
+        self.points = points[order]
+        self.ids = numpy.array(ids, dtype=object)[order]
+        self.sheets = numpy.array(sheets, dtype=object)[order]
+        self.position = dict(
+            [(nzaa_id, n) for n, nzaa_id in enumerate(self.ids)])
+
+    def __len__(self):
+        return len(self.points)
+
+    def split(self, points, order, lo, hi):
+        """Make the node for the sites order[lo:hi]; return its number."""
+
+        node = len(self.boxes)
+        pts = points[order[lo:hi]]
+        box = (pts[:, 0].min(), pts[:, 1].min(),
+               pts[:, 0].max(), pts[:, 1].max())
+        self.boxes.append(box)
+        self.ranges.append((lo, hi))
+        self.children.append(None)
+
+        if hi - lo <= self.leaf_size:
+            self.leaf_of[lo:hi] = node
+            return node
+
+        axis = 0
+        if box[3] - box[1] > box[2] - box[0]:
+            axis = 1
+        mid = (lo + hi) // 2
+        part = numpy.argpartition(pts[:, axis], mid - lo)
+        order[lo:hi] = order[lo:hi][part]
+
+        left = self.split(points, order, lo, mid)
+        right = self.split(points, order, mid, hi)
+        self.children[node] = (left, right)
+        return node
+
+    def box_distance(self, node, box):
+        """Return the squared distance between a node's box and box."""
+
+        b = self.boxes[node]
+        dx = max(b[0] - box[2], 0, box[0] - b[2])
+        dy = max(b[1] - box[3], 0, box[1] - b[3])
+        return dx * dx + dy * dy
+
+    def leaf(self, x, y):
+        """Return the leaf nearest (x, y)."""
+
+        box = (x, y, x, y)
+        node = 0
+        while self.children[node]:
+            (left, right) = self.children[node]
+            if self.box_distance(left, box) <= self.box_distance(right, box):
+                node = left
+            else:
+                node = right
+        return node
+
+    def gather(self, box, radius2):
+        """Return the positions of the sites in leaves near box.
+
+        Those leaves no further than the square root of radius2 from
+        box.
+
+        """
+
+        found = []
+        stack = [0]
+        while stack:
+            node = stack.pop()
+            if self.box_distance(node, box) > radius2:
+                continue
+            if self.children[node]:
+                stack.extend(self.children[node])
+            else:
+                (lo, hi) = self.ranges[node]
+                found.append(numpy.arange(lo, hi))
+
+        if not found:
+            return numpy.zeros(0, dtype=int)
+        return numpy.concatenate(found)
+
+    def search(self, points, skip, home, count, distance):
+        """Return the nearest sites to points, close to one another.
+
+        Points is an array of (x, y), and skip the position of a site
+        to leave out for each, or -1. The k nearest sites of home, a
+        leaf near the points, bound how far away the others may be.
+
+        """
+
+        limit = float(distance) ** 2
+        radius2 = limit
+        (lo, hi) = self.ranges[home]
+        if hi - lo > count:
+            d2 = squared_distances(points, self.points[lo:hi])
+            d2[numpy.arange(lo, hi)[None, :] == skip[:, None]] = numpy.inf
+            kth = numpy.partition(d2, count - 1, axis=1)[:, count - 1]
+            radius2 = min(kth.max(), limit)
+
+        box = (points[:, 0].min(), points[:, 1].min(),
+               points[:, 0].max(), points[:, 1].max())
+        candidates = self.gather(box, radius2)
+        k = min(count, len(candidates))
+        if not k:
+            return [[] for point in points]
+
+        d2 = squared_distances(points, self.points[candidates])
+        d2[candidates[None, :] == skip[:, None]] = numpy.inf
+        d2[d2 > limit] = numpy.inf
+
+        rows = numpy.arange(len(points))[:, None]
+        nearest = numpy.argpartition(d2, k - 1, axis=1)[:, :k]
+        order = numpy.argsort(d2[rows, nearest], axis=1, kind='mergesort')
+        nearest = nearest[rows, order]
+
+        results = []
+        for (n, row) in enumerate(nearest):
+            result = []
+            for c in row:
+                if d2[n, c] == numpy.inf:
+                    break
+                result.append(
+                    (self.ids[candidates[c]], float(numpy.sqrt(d2[n, c]))))
+            results.append(result)
+
+        return results
+
+    def nearest(self, nzaa_id, count=COUNT, distance=DISTANCE):
+        """Return the nearest sites to a site in the tree.
+
+        An empty list if the site is not in the tree.
+
+        """
+
+        if nzaa_id not in self.position:
+            return []
+        return self.nearest_all([nzaa_id], count, distance)[nzaa_id]
+
+    def nearest_point(self, x, y, count=COUNT, distance=DISTANCE,
+                      exclude=None):
+        """Return the nearest sites to (x, y), leaving out exclude."""
+
+        if not len(self.points):
+            return []
+
+        skip = numpy.array([self.position.get(exclude, -1)])
+        return self.search(numpy.array([[x, y]], dtype=float), skip,
+                           self.leaf(x, y), count, distance)[0]
+
+    def nearest_all(self, nzaa_ids=None, count=COUNT, distance=DISTANCE):
+        """Return a dictionary of nzaa_id: nearest sites.
+
+        For the sites of nzaa_ids in the tree, or every site. The
+        sites are searched for a leaf at a time.
+
+        """
+
+        if nzaa_ids is None:
+            positions = numpy.arange(len(self.points))
+        else:
+            positions = numpy.array(
+                [self.position[i] for i in nzaa_ids if i in self.position],
+                dtype=int)
+
+        result = {}
+        if not len(positions):
+            return result
+
+        positions = positions[numpy.argsort(
+            self.leaf_of[positions], kind='mergesort')]
+        leaves = self.leaf_of[positions]
+        starts = numpy.flatnonzero(numpy.diff(leaves)) + 1
+        for group in numpy.split(positions, starts):
+            found = self.search(self.points[group], group,
+                                self.leaf_of[group[0]], count, distance)
+            for (position, sites) in zip(group, found):
+                result[self.ids[position]] = sites
+
+        return result
+
+    def sheet(self, sheet):
+        """Return the nzaa_ids of the sites on an NZMS 260 sheet."""
+
+        return list(self.ids[self.sheets == sheet])
+
+
+def load():
+    """Return a SiteTree of the sites with a location."""
+
+    rows = list(models.Site.objects.exclude(geom=None).values_list(
+        'nzaa_id', 'nzms_sheet', 'easting', 'northing'))
+
+    return SiteTree([row[0] for row in rows], [row[1] for row in rows],
+                    [row[2:] for row in rows])
+
+
+_lock = threading.Lock()
+_state = {
+    'tree': None,
+    'version': None,
+    'checked': 0,
+    'dirty': False,
+    'connected': False,
+}
+
+
+def changed(**kwargs):
+    """Signal receiver: a site has been saved or deleted."""
+
+    _state['dirty'] = True
+
+
+def stale(check=False):
+    """True if the tree must be built, or built again.
+
+    With check, the site table is looked at however recently it was.
+
+    """
+
+    if _state['tree'] is None or _state['dirty']:
+        return True
+
+    now = time.time()
+    if not check and now - _state['checked'] < settings.NEIGHBOURS_CHECK:
+        return False
+
+    _state['checked'] = now
+    return geolib.spatialindex.table_version(models.Site) != _state['version']
+
+
+def get_tree(check=False):
+    """Return the SiteTree of this process, built if out of date.
+
+    With check, look for changes to the site table now, as for work
+    which must see sites saved by other processes.
+
+    """
+
+    with _lock:
+        if not _state['connected']:
+            post_save.connect(changed, sender=models.Site, weak=False)
+            post_delete.connect(changed, sender=models.Site, weak=False)
+            _state['connected'] = True
+
+        if stale(check):
+            _state['dirty'] = False
+            _state['checked'] = time.time()
+            _state['version'] = geolib.spatialindex.table_version(models.Site)
+            _state['tree'] = load()
+
+        return _state['tree']
+
+
+def reset():
+    """Forget the tree."""
+
+    with _lock:
+        _state['tree'] = None
@@ -0,0 +1,185 @@
+"""Fill sites' updated and visited fields from their update0 text.
+
+The description and condition ArchSite gives a site, kept in its
+update0 record, often hold the history of the record as paragraphs
+beginning "Updated 09/04/2015 by ..." or "Inspected ... by: ...".
+analyse.find_updates() picks these out. normalise() runs it over
+every site, and sets a site's updated and updated_by from the latest
+update found, and its visited and visited_by from the latest visit,
+where the site has none:
+
+    import nzaa.normalise as normalise
+    normalise.normalise(save=False)
+
+or ./manage.py normalise.
+
+As with reclassify, the work is split by NZMS 260 sheet over a pool of
+processes. Each reads its sheet's sites with their update0 text in
+one query, joining the two tables, and writes only the sites which
+change, with utils.bulk_update().
+
+"""
+
+import datetime
+import multiprocessing
+
+from django import db
+from django.db.models import Count
+
+import analyse
+import models
+import utils
+
+
+FIELDS = ('updated', 'updated_by', 'visited', 'visited_by')
+
+
+def to_date(value):
+    """Return a date for a 'YYYY-MM-DD' string, or None."""
+
+    if not value or value is True:
+        return None
+    try:
+        return datetime.datetime.strptime(value.strip(), '%Y-%m-%d').date()
+    except (AttributeError, ValueError):
+        return None
+
+
+def to_name(value):
+    """Return a name for a CharField, or None."""
+
+    if not value or value is True:
+        return None
+    return value.strip()[:255] or None
+
+
+def suggest(updates):
+    """Return a dictionary of FIELDS values from find_updates() output.
+
+    From the latest update with a date, and the latest visit. Fields
+    which can't be found are left out.
+
+    """
+
+    values = {}
+    for update in updates:
+        updated = to_date(update['date'])
+        if updated and updated >= values.get('updated', updated):
+            values['updated'] = updated
+            values['updated_by'] = to_name(update['actor'])
+
+        visited = to_date(update['visited'])
+        if visited and visited >= values.get('visited', visited):
+            values['visited'] = visited
+            values['visited_by'] = to_name(update['visited_by'])
+
+    return dict([(k, v) for (k, v) in values.items() if v is not None])
+
+
+def normalise_sheet(sheet, overwrite=False, save=True):
+    """Normalise the sites on one sheet.
+
+    Only empty fields are filled, unless overwrite is set.
+
+    Return (counts, changes): a dictionary of counts of sites, sites
+    changed, sites whose text could not be read, and changes by
+    field; and a list of (nzaa_id, field, before, after).
+
+    """
+
+    counts = {'sites': 0, 'changed': 0, 'errors': 0}
+    for field in FIELDS:
+        counts[field] = 0
+    changes = []
+    site_objs = []
+
+    rows = models.Update.objects.filter(
+        site__nzms_sheet=sheet, ordinal=0).values_list(
+        'site', 'description', 'condition',
+        *['site__' + field for field in FIELDS])
+
+    for row in rows.iterator():
+        nzaa_id = row[0]
+        current = dict(zip(FIELDS, row[3:]))
+        counts['sites'] += 1
+
+        try:
+            updates = analyse.find_updates(row[1], row[2])
+        except Exception:
+            counts['errors'] += 1
+            continue
+
+        values = dict(current)
+        for (field, value) in suggest(updates).items():
+            if overwrite or not current[field]:
+                values[field] = value
+
+        changed = [field for field in FIELDS
+                   if values[field] != current[field]]
+        if not changed:
+            continue
+
+        counts['changed'] += 1
+        for field in changed:
+            counts[field] += 1
+            changes.append((nzaa_id, field, current[field], values[field]))
+        site_objs.append(models.Site(nzaa_id=nzaa_id, **values))
+
+    if save:
+        utils.bulk_update(models.Site, site_objs, FIELDS)
+
+    return (counts, changes)
+
+
+def _normalise_sheet(args):
+    """normalise_sheet() for Pool.imap_unordered()."""
+
+    return normalise_sheet(*args)
+
+
+def normalise(sheets=None, workers=None, overwrite=False, save=True,
+              verbose=False):
+    """Normalise the sites on sheets, or on all sheets.
+
+    Sheets are shared among workers processes, one per CPU by default,
+    largest first. Without save, nothing is written.
+
+    Return (counts, changes), summed over the sheets, as for
+    normalise_sheet().
+
+    """
+
+    sizes = models.Site.objects.all()
+    if sheets:
+        sizes = sizes.filter(nzms_sheet__in=sheets)
+    sizes = sizes.values_list('nzms_sheet').annotate(
+        n=Count('nzaa_id')).order_by('-n')
+    tasks = [(sheet, overwrite, save) for (sheet, n) in sizes]
+
+    counts = {}
+    changes = []
+
+    def add(result):
+        for (key, n) in result[0].items():
+            counts[key] = counts.get(key, 0) + n
+        changes.extend(result[1])
+        if verbose:
+            print ("Normalised " + str(counts['sites']) + " sites, " +
+                   str(counts['changed']) + " changed")
+
+    if workers == 1:
+        for task in tasks:
+            add(_normalise_sheet(task))
+        return (counts, sorted(changes))
+
+    # The workers are forked, and must each open their own connection.
+    db.connections.close_all()
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    try:
+        for result in pool.imap_unordered(_normalise_sheet, tasks):
+            add(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return (counts, sorted(changes))
@@ -0,0 +1,161 @@
+"""A store of the raw pages fetched from ArchSite.
+
+Every site page fetched by the scraper is kept here, so that changes
+to extract_values(), datamap or process_extract() can be re-run over
+the whole collection without going back to ArchSite. See the replay
+option on Scrape.
+
+Pages are kept gzip-compressed in a content-addressed store: the file
+name is the SHA-1 digest of the page, so a page which has not changed
+between fetches is only stored once. An index file for each nzaa_id
+lists the fetch times and digests, oldest first, one to a line:
+
+    PAGE_CACHE/objects/3f/3f2a...c1.gz
+    PAGE_CACHE/index/S14/22.idx
+
+    2019-10-21 11:36:02+00:00<tab>3f2a...c1
+
+"""
+
+import datetime
+import gzip
+import hashlib
+import os
+import pytz
+import threading
+
+import settings
+
+
+class PageCache():
+    """Read and write pages in the store at root.
+
+    The root defaults to settings.PAGE_CACHE.
+
+    """
+
+    lock = threading.Lock()
+
+    def __init__(self, root=None):
+        self.root = root
+        if not self.root:
+            self.root = settings.PAGE_CACHE
+
+    def index_path(self, nzaa_id):
+        sheet, ordinal = nzaa_id.split('/')
+        return os.path.join(self.root, 'index', sheet, ordinal + '.idx')
+
+    def object_path(self, digest):
+        return os.path.join(self.root, 'objects', digest[:2], digest + '.gz')
+
+    def store(self, nzaa_id, html, fetched=None):
+        """Keep a page fetched for nzaa_id. Return its digest.
+
+        The object file is written under a temporary name and renamed
+        into place, so a reader never sees half a page.
+
+        """
+
+        if not fetched:
+            fetched = datetime.datetime.now(pytz.utc)
+
+        digest = hashlib.sha1(html).hexdigest()
+        path = self.object_path(digest)
+
+        if not os.path.isfile(path):
+            directory = os.path.dirname(path)
+            if not os.path.isdir(directory):
+                try:
+                    os.makedirs(directory)
+                except OSError:
+                    pass
+
+            tmp = path + '.' + str(os.getpid()) + '.tmp'
+            f = gzip.open(tmp, 'wb')
+            f.write(html)
+            f.close()
+            os.rename(tmp, path)
+
+        index = self.index_path(nzaa_id)
+        with self.lock:
+            if not os.path.isdir(os.path.dirname(index)):
+                os.makedirs(os.path.dirname(index))
+            f = open(index, 'a')
+            f.write(unicode(fetched.replace(microsecond=0)) +
+                    '\t' + digest + '\n')
+            f.close()
+
+        return digest
+
+    def history(self, nzaa_id):
+        """Return a list of (fetched, digest) strings, oldest first."""
+
+        index = self.index_path(nzaa_id)
+        if not os.path.isfile(index):
+            return []
+
+        history = []
+        f = open(index, 'r')
+        for line in f:
+            line = line.strip()
+            if line:
+                history.append(tuple(line.split('\t')))
+        f.close()
+
+        return history
+
+    def read(self, digest):
+        """Return the page stored under digest, or None."""
+
+        path = self.object_path(digest)
+        if not os.path.isfile(path):
+            return None
+
+        f = gzip.open(path, 'rb')
+        html = f.read()
+        f.close()
+
+        return html
+
+    def latest(self, nzaa_id, before=None):
+        """Return the most recent page stored for nzaa_id, or None.
+
+        Given before, a timestamp string in the form used by the
+        index, return the most recent page fetched before it.
+
+        """
+
+        for (fetched, digest) in reversed(self.history(nzaa_id)):
+            if before and fetched >= before:
+                continue
+            return self.read(digest)
+
+        return None
+
+    def identifiers(self, sheets=None):
+        """Return a list of the nzaa_ids with pages in the store.
+
+        Sorted by sheet and ordinal. Given a list of sheets, only
+        return identifiers on those sheets.
+
+        """
+
+        identifiers = []
+        index = os.path.join(self.root, 'index')
+        if not os.path.isdir(index):
+            return identifiers
+
+        for sheet in sorted(os.listdir(index)):
+            if sheets and sheet not in sheets:
+                continue
+
+            ordinals = []
+            for fname in os.listdir(os.path.join(index, sheet)):
+                (ordinal, ext) = os.path.splitext(fname)
+                if ext == '.idx':
+                    ordinals.append(int(ordinal))
+
+            for ordinal in sorted(ordinals):
+                identifiers.append(sheet + '/' + str(ordinal))
+
+        return identifiers
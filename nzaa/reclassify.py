@@ -0,0 +1,200 @@
+"""Re-run datamap over the stored ArchSite values of every site.
+
+Site type, subtype, period and ethnicity are set by the datamap
+functions when a site is scraped, from the type, short description,
+period and ethnicity ArchSite gives, which are kept in the site's
+lgcy_type, lgcy_shortdesc, lgcy_period and lgcy_ethnicity fields.
+After a change to the datamap vocabularies, reclassify() sets them
+again from those fields, without a scrape:
+
+    import nzaa.reclassify as reclassify
+    reclassify.reclassify()
+
+or ./manage.py reclassify.
+
+As with a scrape, the values are written to each site's update0
+record. With sites set, they are written to the site record too,
+replacing any values edited since it was created.
+
+The work is split by NZMS 260 sheet over a pool of processes. Each
+reads its sheet's values with one query a table, and writes only the
+records whose values have changed, with utils.bulk_update().
+
+"""
+
+import collections
+import multiprocessing
+
+from django import db
+from django.db.models import Count
+
+import datamap
+import density
+import models
+import sitestats
+import utils
+
+
+FIELDS = ('site_type', 'site_subtype', 'period', 'ethnicity')
+
+
+def classify(lgcy_type, lgcy_shortdesc, lgcy_period, lgcy_ethnicity):
+    """Return the FIELDS values for a site's stored ArchSite values."""
+
+    data = {
+        'type': lgcy_type or '',
+        'short_desc': lgcy_shortdesc or '',
+        'period': lgcy_period or '',
+        'ethnicity': lgcy_ethnicity or '',
+    }
+    (site_type, site_subtype) = datamap.map_type(data)
+
+    return (site_type, site_subtype, datamap.map_period(data),
+            datamap.map_ethnicity(data))
+
+
+def distribution(counter, record, values):
+    """Count a record's FIELDS values into counter.
+
+    Type and subtype are counted together, as "type / subtype".
+
+    """
+
+    (site_type, site_subtype, period, ethnicity) = values
+    display_type = site_type or ''
+    if site_subtype:
+        display_type += ' / ' + site_subtype
+
+    counter[(record, 'type', display_type)] += 1
+    counter[(record, 'period', period or '')] += 1
+    counter[(record, 'ethnicity', ethnicity or '')] += 1
+
+
+def reclassify_sheet(sheet, sites=False, save=True):
+    """Reclassify the sites on one sheet.
+
+    Return (before, after, changed): Counters of the values before and
+    after, and a dictionary of record: number of records changed.
+
+    """
+
+    before = collections.Counter()
+    after = collections.Counter()
+    changed = {'update0': 0, 'site': 0}
+
+    rows = models.Site.objects.filter(nzms_sheet=sheet).values_list(
+        'nzaa_id', 'lgcy_type', 'lgcy_shortdesc', 'lgcy_period',
+        'lgcy_ethnicity', *FIELDS)
+
+    classes = {}
+    site_objs = []
+    for row in rows.iterator():
+        nzaa_id = row[0]
+        if row[1] is None and row[2] is None:
+            # Never scraped from ArchSite.
+            continue
+
+        values = classify(*row[1:5])
+        classes[nzaa_id] = values
+
+        if sites:
+            distribution(before, 'site', row[5:])
+            distribution(after, 'site', values)
+            if tuple(row[5:]) != values:
+                site_objs.append(
+                    models.Site(nzaa_id=nzaa_id, **dict(zip(FIELDS, values))))
+
+    update_objs = []
+    rows = models.Update.objects.filter(
+        site__nzms_sheet=sheet, ordinal=0).values_list(
+        'update_id', 'site', *FIELDS)
+
+    for row in rows.iterator():
+        values = classes.get(row[1])
+        if values is None:
+            continue
+
+        distribution(before, 'update0', row[2:])
+        distribution(after, 'update0', values)
+        if tuple(row[2:]) != values:
+            update_objs.append(
+                models.Update(update_id=row[0], **dict(zip(FIELDS, values))))
+
+    changed['update0'] = len(update_objs)
+    changed['site'] = len(site_objs)
+
+    if save:
+        utils.bulk_update(models.Update, update_objs, FIELDS)
+        utils.bulk_update(models.Site, site_objs, FIELDS)
+        if site_objs:
+            sitestats.update_sheets([sheet])
+            density.update_sheets([sheet])
+
+    return (before, after, changed)
+
+
+def _reclassify_sheet(args):
+    """reclassify_sheet() for Pool.imap_unordered()."""
+
+    return reclassify_sheet(*args)
+
+
+def reclassify(sheets=None, workers=None, sites=False, save=True):
+    """Reclassify the sites on sheets, or on all sheets.
+
+    Sheets are shared among workers processes, one per CPU by default,
+    largest first. Without save, nothing is written.
+
+    Return (before, after, changed), summed over the sheets, as for
+    reclassify_sheet().
+
+    """
+
+    counts = models.Site.objects.all()
+    if sheets:
+        counts = counts.filter(nzms_sheet__in=sheets)
+    counts = counts.values_list('nzms_sheet').annotate(
+        n=Count('nzaa_id')).order_by('-n')
+    tasks = [(sheet, sites, save) for (sheet, n) in counts]
+
+    before = collections.Counter()
+    after = collections.Counter()
+    changed = {'update0': 0, 'site': 0}
+
+    def add(result):
+        before.update(result[0])
+        after.update(result[1])
+        for (record, n) in result[2].items():
+            changed[record] += n
+
+    if workers == 1:
+        for task in tasks:
+            add(_reclassify_sheet(task))
+        return (before, after, changed)
+
+    # The workers are forked, and must each open their own connection.
+    db.connections.close_all()
+    pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+    try:
+        for result in pool.imap_unordered(_reclassify_sheet, tasks):
+            add(result)
+    finally:
+        pool.close()
+        pool.join()
+
+    return (before, after, changed)
+
+
+def diff(before, after):
+    """Return a list of (record, field, value, before, after) which differ.
+
+    Sorted by record, field and value.
+
+    """
+
+    rows = []
+    for key in sorted(set(before.keys()) | set(after.keys())):
+        if before[key] != after[key]:
+            rows.append(key + (before[key], after[key]))
+
+    return rows
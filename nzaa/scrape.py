@@ -2,20 +2,120 @@
 
 import datetime
 import hashlib
+import json
 import mechanize
 import os
 import pytz
 import re
+import urlparse
 
 from bs4 import BeautifulSoup
 
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
 from django.contrib.gis.geos import Point
 
 import settings
 import models
 from geolib.models import Region, TerritorialAuthority
+import coords
+import density
+import footprint
 import datamap
+import enrich
+import frontier
+from metrics import Metrics, timed
+import neighbours
+import pagecache
+import sitecontext
+import sitestats
+import utils
+
+# Entity substitutions made before digesting extracted values. Each
+# character is replaced by its HTML entity, or removed where None.
+DIGEST_ENTITIES = {
+    ord(u'\u0101'): u'&#x0101;',
+    ord(u'\u012b'): u'&#x012b;',
+    ord(u'\u016b'): u'&#x016b;',
+    ord(u'\u02bc'): u'&#x02bc;',
+    ord(u'\u02c6'): u'&circ;',
+    ord(u'\u02da'): u'&#x02da; ',
+    ord(u'\u2013'): u'&ndash;',
+    ord(u'\u2014'): u'&mdash;',
+    ord(u'\u2018'): u'&lsquo;',
+    ord(u'\u2019'): u'&rsquo;',
+    ord(u'\u201c'): u'&ldquo;',
+    ord(u'\u201d'): u'&rdquo;',
+    ord(u'\u2022'): u'&bull;',
+    ord(u'\u2026'): u'&hellip;',
+    ord(u'\u20a4'): u'&#x20a4;',
+    ord(u'\u2154'): u'&#x2154;',
+    ord(u'\uf644'): None,
+    ord(u'\uf64b'): None,
+    ord(u'\uf64c'): None,
+    ord(u'\xa0'): u'&nbsp;',
+    ord(u'\xa3'): u'&pound;',
+    ord(u'\xa9'): u'&copy;',
+    ord(u'\xac'): u'&not;',
+    ord(u'\xad'): u'&shy;',
+    ord(u'\xb0'): u'&deg;',
+    ord(u'\xb1'): u'&plusmn;',
+    ord(u'\xb2'): u'&sup2;',
+    ord(u'\xb3'): u'&sup3;',
+    ord(u'\xb4'): u'&acute;',
+    ord(u'\xb7'): u'&middot;',
+    ord(u'\xba'): u'&ordm;',
+    ord(u'\xbc'): u'&frac14;',
+    ord(u'\xbd'): u'&frac12;',
+    ord(u'\xbe'): u'&frac34;',
+    ord(u'\xe6'): u'&aelig;',
+    ord(u'\xe7'): u'&ccedil;',
+    ord(u'\xe8'): u'&egrave;',
+    ord(u'\xe9'): u'&eacute;',
+}
+
+# The dt labels read from an ArchSite site page by extract_values().
+EXTRACT_LABELS = (
+    'Evidence site destroyed',
+    'Site inspected by',
+    'NZTM Coordinates',
+    'Source of spatial data',
+    'Finder Aid',
+    'Site Type',
+    'Features',
+    'Description',
+    'Name',
+    'Ethnicity',
+    'Period',
+    'Associated Sites',
+    'Condition',
+    'Condition Notes',
+    'Land Use',
+    'Threats',
+)
+
+# BeautifulSoup backend for extract_values(). Fall back to the parser
+# in the standard library if lxml isn't installed.
+PARSER = settings.SCRAPE_PARSER
+if PARSER == 'lxml':
+    try:
+        import lxml
+    except ImportError:
+        PARSER = 'html.parser'
+
+
+def archsite_pages(base):
+    """Return the login and site page URLs for an ArchSite at base.
+
+    Base is a scheme and host, like 'http://localhost:8001'.
+
+    """
+
+    login = urlparse.urlparse(settings.LOGIN_PAGE)
+    site = urlparse.urlparse(settings.SITE_PAGE)
+
+    return (base.rstrip('/') + login.path,
+            base.rstrip('/') + site.path + '?' + site.query)
 
 
 class Scrape(BaseCommand):
@@ -28,7 +128,15 @@ class Scrape(BaseCommand):
     input list.
 
     The method scrape_site() does everything else for an individual
-    record. This is documented in its docstring.
+    record. This is documented in its docstring. It is split into
+    fetching (fetch_extract: login, visit_site, extract_values) and
+    saving (save_extract), so the two halves can run in separate
+    threads. Extracts are saved in batches by save_batch(). See
+    nzaa.scrapepool for the concurrent version.
+
+    A sheet identifier is expanded by a SheetFrontier (nzaa.frontier)
+    into the known sites and gaps due for a fetch. New sites on the
+    sheet are then found by probing past its highest ordinal.
 
     """
 
@@ -39,6 +147,7 @@ class Scrape(BaseCommand):
     # secrets.py. See the comment in nzaa/settings.py.
     USERNAME = settings.LOGIN_ARCHSITE['default'][0]
     PASSWORD = settings.LOGIN_ARCHSITE['default'][1]
+    ACCOUNT = 'default'
 
     DOWNLOADS = settings.BASE_FILESPACE
     LOCALOG = os.path.join(settings.BASE_DIR, 'etc')
@@ -46,14 +155,29 @@ class Scrape(BaseCommand):
     LOGFILE += str(datetime.datetime.date(datetime.datetime.now()))[:7]
     LOGFILE += '.log'
     LOGFILENAME = os.path.join(LOCALOG, LOGFILE)
+    DUMPFILE = "/home/malcolm/tmp/scrape_dumps.txt"
     RECORD_PRESENT = False
     VERBOSE = False
 
+    REPLAY = False
+
+    class FetchError(Exception):
+        def __init__(self, value, transient=True):
+            self.value = value
+            self.transient = transient
+
+        def __str__(self):
+            return repr(self.value)
+
     browser = None
     connection = False
+    cookiejar = None
     extract = None
+    frontiers = []
 
-    def __init__(self, identifiers=False, files=False, verbose=False):
+    def __init__(self, identifiers=False, files=False, verbose=False,
+                 account='default', replay=False, metrics=None,
+                 archsite=None, worker=None):
         """Accept a list of NZAA identifier strings.
 
         The files flag, when set True, will force the use of the
@@ -64,12 +188,55 @@ class Scrape(BaseCommand):
         files associated with a record. This function hasn't been
         written yet!
 
+        The account is a key in settings.LOGIN_ARCHSITE. Each account
+        keeps its session cookies in a file under LOCALOG, so a later
+        run can reuse the session without logging in again. Worker is
+        the number of a ScrapePool worker, which keeps a cookie file of
+        its own, so that each worker has a session of its own.
+
+        Every page fetched is kept in the page cache (see
+        nzaa.pagecache). With replay set True, pages are read back
+        from the cache instead of ArchSite, and the extract, process
+        and save steps are run on them with no network access.
+
+        Timings and counts go to metrics, a nzaa.metrics.Metrics object,
+        which may be shared with other Scrape objects. A new one is made
+        if none is given. At the end of a run its summary table is
+        logged, and its file closed.
+
+        Archsite is the base URL of another server to scrape in place of
+        ArchSite, such as the stand-in in nzaa.standin. Its pages are
+        not kept in the page cache.
+
         """
 
         self.identifiers = identifiers
         self.VERBOSE = verbose
         self.files = files
 
+        self.ACCOUNT = account
+        self.USERNAME = settings.LOGIN_ARCHSITE[account][0]
+        self.PASSWORD = settings.LOGIN_ARCHSITE[account][1]
+        cookies = 'archsite_' + account
+
+        self.CACHE_PAGES = settings.SCRAPE_CACHE_PAGES
+        if archsite:
+            (self.LOGIN_PAGE, self.SITE_PAGE) = archsite_pages(archsite)
+            self.CACHE_PAGES = False
+            host = urlparse.urlparse(archsite).netloc.replace(':', '_')
+            cookies += '_' + host
+
+        if worker is not None:
+            cookies += '_' + str(worker)
+        self.COOKIEFILE = os.path.join(self.LOCALOG, cookies + '.cookies')
+
+        self.REPLAY = replay
+        self.pagecache = pagecache.PageCache()
+
+        self.metrics = metrics
+        if not self.metrics:
+            self.metrics = Metrics()
+
         targets = []
         if not os.path.isdir(self.LOCALOG):
             os.makedirs(self.LOCALOG)
@@ -78,8 +245,23 @@ class Scrape(BaseCommand):
             targets = self.scrape_this(identifiers, verbose)
 
         self.f = open(self.LOGFILENAME, 'a')
-        for target in targets:
-            self.scrape_site(target)
+        self.save_all(self.fetch_all(targets))
+        for sheet in self.frontiers:
+            self.save_all(sheet.probe(self.probe_extract))
+            self.logging(sheet.summary())
+            if sheet.failed:
+                self.logging("Failed to probe " +
+                             ", ".join(sorted(sheet.failed)))
+            if self.VERBOSE:
+                print sheet.summary()
+
+        if identifiers:
+            table = self.metrics.report()
+            for line in table.split('\n'):
+                self.logging(line)
+            if self.VERBOSE:
+                print table
+            self.metrics.close()
         self.f.close()
 
     def logging(self, log):
@@ -112,16 +294,26 @@ class Scrape(BaseCommand):
         sending it to functions until you are reduced to a list of
         individual nzaa identifiers.
 
+        The SheetFrontier for each sheet is kept in self.frontiers,
+        to be probed once the targets have been fetched.
+
         """
 
         if verbose:
             print "Scrape this", identifiers
 
         targets = []
+        self.frontiers = []
         p = re.compile(r'^([A-Za-z]\d{2}/\d+)')
 
         for item in identifiers:
-            if item in settings.NZMS260:
+            if item in settings.NZMS260 and self.REPLAY:
+                targets.extend(self.pagecache.identifiers([item]))
+            elif item in settings.NZMS260 and settings.SCRAPE_FRONTIER:
+                sheet = frontier.SheetFrontier(item, cache=self.pagecache)
+                self.frontiers.append(sheet)
+                targets.extend(sheet.targets())
+            elif item in settings.NZMS260:
                 if verbose:
                     print "Scraping sheet", item
                 targets.extend(self.find_sheet_members(item))
@@ -171,23 +363,45 @@ class Scrape(BaseCommand):
 
         """
 
+        extract = self.fetch_extract(nzaa_id)
+        if not extract:
+            return None
+
+        return self.save_extract(nzaa_id, extract)
+
+    def fetch_all(self, targets):
+        """Fetch each target in turn, yielding (nzaa_id, extract)."""
+
+        for nzaa_id in targets:
+            extract = self.fetch_extract(nzaa_id)
+            if extract:
+                yield (nzaa_id, extract)
+
+    def save_all(self, extracts):
+        """Save (nzaa_id, extract) tuples in batches of SCRAPE_BATCH."""
+
+        batch = []
+        for item in extracts:
+            batch.append(item)
+            if len(batch) >= settings.SCRAPE_BATCH:
+                self.save_batch(batch)
+                batch = []
+
+        if batch:
+            self.save_batch(batch)
+
+    def fetch_extract(self, nzaa_id):
+        """Fetch the page for a site and return its extract, or None."""
+
         message = "Scraping site " + nzaa_id
         if self.VERBOSE:
             print message
 
-        s = None
-        u = None
-        update_id = nzaa_id + '-0'
-        html = None
         extract = None
 
-        now = datetime.datetime.now(pytz.timezone('NZ'))
-        unchanged = False
-
-        if self.login():
-            html = self.visit_site(nzaa_id)
-            if html:
-                extract = self.extract_values(html)
+        html = self.visit_site(nzaa_id)
+        if html:
+            extract = self.extract_values(html)
 
         if not extract:
             message = "No site record found for " + nzaa_id
@@ -195,188 +409,345 @@ class Scrape(BaseCommand):
                 print message
             return None
 
-        self.extract = extract
+        return extract
+
+    def probe_extract(self, nzaa_id):
+        """fetch_extract() for SheetFrontier.probe().
+
+        A request which fails raises its FetchError, rather than giving
+        None, so that it isn't taken for a missing site.
+
+        """
+
+        if self.REPLAY:
+            return self.fetch_extract(nzaa_id)
+
+        if self.VERBOSE:
+            print "Probing site " + nzaa_id
+
+        extract = self.extract_values(self.fetch_page(nzaa_id))
+        if not extract and self.VERBOSE:
+            print "No site record found for " + nzaa_id
+
+        return extract
+
+    def save_extract(self, nzaa_id, extract):
+        """Save an extract from ArchSite into the site and update0 records.
+
+        This is the database half of scrape_site(). It makes no
+        connection to ArchSite, so it can be called from a thread
+        other than the one which fetched the page. It is a batch of
+        one; see save_batch().
+
+        """
+
+        self.save_batch([(nzaa_id, extract)])
+
+    def digest_extract(self, nzaa_id, extract):
+        """Return the MD5 hex digest of the values in an extract."""
+
+        return self.digest_fields(nzaa_id, extract)[0]
+
+    @timed('digest')
+    def digest_fields(self, nzaa_id, extract):
+        """Return the record digest, and a dictionary of field digests.
+
+        Each value is passed through DIGEST_ENTITIES and given a
+        newline. The record digest is the MD5 of these lines in key
+        order, as it has always been, so stored digests stay valid. A
+        value which still holds a character with no ASCII encoding is
+        left out of the record digest, and noted in the dump file.
+
+        The field digests are MD5s of each line on its own, encoded as
+        UTF-8, so every field has one.
+
+        """
 
-#       Create MD5 checksum of extracted values, replacing unknown
-#       unicode characters.
         hash = hashlib.md5()
-        checksum = ''
+        fields = {}
         for k in sorted(extract.keys()):
+            line = unicode(extract[k]).translate(DIGEST_ENTITIES) + "\n"
+            fields[k] = hashlib.md5(line.encode('utf-8')).hexdigest()
             try:
-                hash.update(
-                    unicode(extract[k])
-                    .replace(u'\u0101', '&#x0101;')
-                    .replace(u'\u012b', '&#x012b;')
-                    .replace(u'\u016b', '&#x016b;')
-                    .replace(u'\u02bc', '&#x02bc;')
-                    .replace(u'\u02c6', '&circ;')
-                    .replace(u'\u02da', '&#x02da; ')
-                    .replace(u'\u2013', '&ndash;')
-                    .replace(u'\u2014', '&mdash;')
-                    .replace(u'\u2018', '&lsquo;')
-                    .replace(u'\u2019', '&rsquo;')
-                    .replace(u'\u201c', '&ldquo;')
-                    .replace(u'\u201d', '&rdquo;')
-                    .replace(u'\u2022', '&bull;')
-                    .replace(u'\u2026', '&hellip;')
-                    .replace(u'\u20a4', '&#x20a4;')
-                    .replace(u'\u2154', '&#x2154;')
-                    .replace(u'\uf644', '')
-                    .replace(u'\uf64b', '')
-                    .replace(u'\uf64c', '')
-                    .replace(u'\xa0', '&nbsp;')
-                    .replace(u'\xa3', '&pound;')
-                    .replace(u'\xa9', '&copy;')
-                    .replace(u'\xac', '&not;')
-                    .replace(u'\xad', '&shy;')
-                    .replace(u'\xb0', '&deg;')
-                    .replace(u'\xb1', '&plusmn;')
-                    .replace(u'\xb2', '&sup2;')
-                    .replace(u'\xb3', '&sup3;')
-                    .replace(u'\xb4', '&acute;')
-                    .replace(u'\xb7', '&middot;')
-                    .replace(u'\xba', '&ordm;')
-                    .replace(u'\xbc', '&frac14;')
-                    .replace(u'\xbd', '&frac12;')
-                    .replace(u'\xbe', '&frac34;')
-                    .replace(u'\xe6', '&aelig;')
-                    .replace(u'\xe7', '&ccedil;')
-                    .replace(u'\xe8', '&egrave;')
-                    .replace(u'\xe9', '&eacute;') +
-                    "\n"
-                )
+                hash.update(line.encode('ascii'))
             except UnicodeEncodeError as e:
                 line = nzaa_id + " " + str(e) + "\n"
-                dumpfile = "/home/malcolm/tmp/scrape_dumps.txt"
-                f = open(dumpfile, "a")
+                f = open(self.DUMPFILE, "a")
                 f.write(line)
-                f.close
+                f.close()
 
-        digest = hash.hexdigest()
+        return (hash.hexdigest(), fields)
 
-#       Build the structures necessary to affect database tables.
-        (new_site, site, update0) = self.process_extract(extract)
+    def save_batch(self, batch):
+        """Save a list of (nzaa_id, extract) tuples to the database.
 
-#       Try finding a site record.
-        try:
-            s = models.Site.objects.get(nzaa_id=nzaa_id)
-            if digest == s.digest:
-                unchanged = True
-                s.extracted = now
+        Compare the digest of each extract with the stored digest. An
+        unchanged site only has its extracted time and log updated. A
+        changed or new site is written with its update0 record, and
+        linked to its actors, features and periods. New sites are
+        given a region, TLA and island by nzaa.enrich. The field digests
+        of a changed site are compared with the stored ones, to record
+        which fields changed, and links are only remade for those.
+
+        In replay mode, every site is processed and written again, as
+        the point of a replay is to apply changes to process_extract()
+        or the datamap to pages already fetched. The digest and last
+        change of an unchanged page are kept, and the extracted time
+        of every site is left alone, as the pages were not fetched now.
+
+        The whole batch is written in one transaction, with a fixed
+        number of queries however many sites it holds: one lookup each
+        for existing sites and update0 records, a bulk insert and a
+        bulk update for each table, and an insert for each of the
+        actor, feature and period tables and their links.
+
+        A site listed more than once is saved once, from its last
+        extract.
+
+        Return the number of sites created or changed.
+
+        """
+
+        now = datetime.datetime.now(pytz.timezone('NZ'))
+        log_update = (
+            '127.0.0.1', 'scrape', "Updating record from from ArchSite.")
+        log_create = (
+            '127.0.0.1', 'scrape', "Creating record from from ArchSite.")
+        log_replay = (
+            '127.0.0.1', 'scrape', "Processing record again from the cache.")
+
+#       A site listed twice would be created twice. Keep its last
+#       extract, in the place of its first.
+        latest = dict(batch)
+        batch = [(nzaa_id, latest.pop(nzaa_id))
+                 for (nzaa_id, extract) in batch if nzaa_id in latest]
+
+        nzaa_ids = [nzaa_id for (nzaa_id, extract) in batch]
+        update_ids = [nzaa_id + '-0' for nzaa_id in nzaa_ids]
+
+        sites = models.Site.objects.in_bulk(nzaa_ids)
+        updates = models.Update.objects.in_bulk(update_ids)
+
+        site_fields = set([
+            'digest', 'field_digests', 'changed_fields', 'last_change',
+            'log', 'geom'] + list(coords.FIELDS))
+        update_fields = set(['site', 'log', 'geom'])
+
+        unchanged_sites = []
+        changed_sites = []
+        new_sites = []
+        changed_updates = []
+        new_updates = []
+
+        for (nzaa_id, extract) in batch:
+            self.extract = extract
+            (digest, fields) = self.digest_fields(nzaa_id, extract)
+            field_digests = json.dumps(fields, sort_keys=True)
+            update_id = nzaa_id + '-0'
+
+#           Build the structures necessary to affect database tables.
+            (new_site, site, update0) = self.process_extract(extract)
+
+#           A page replayed from the cache was not fetched now, so its
+#           site keeps the time it was last extracted.
+            if self.REPLAY:
+                for values in (new_site, site, update0):
+                    values.pop('extracted', None)
+
+            site_fields.update(site.keys())
+            update_fields.update(update0.keys())
+
+#           An unchanged page is not processed again, unless it is
+#           replayed, which is done to process pages again.
+            s = sites.get(nzaa_id)
+            if s and digest == s.digest and not self.REPLAY:
                 message = ("Record unchanged since " +
                            unicode(s.last_change.replace(microsecond=0))
                            )
-                log = (
-                    '127.0.0.1', 'scrape',
-                    message,
-                )
                 if self.VERBOSE:
                     print message
+                s.extracted = now
+                if not s.field_digests:
+                    s.field_digests = field_digests
+                s.stamp(log=('127.0.0.1', 'scrape', message),
+                        coordinates=False)
+                unchanged_sites.append(s)
+                continue
+
+            if s and digest == s.digest:
+                message = "Processing site record again for " + nzaa_id
+                self.logging(message)
+                if self.VERBOSE:
+                    print message
+                if not s.field_digests:
+                    s.field_digests = field_digests
+                s.__dict__.update(**site)
+                s.stamp(log=log_replay, coordinates=False)
+                changed_sites.append(s)
+                log = log_replay
 
-            else:
+            elif s:
                 message = "Updating existing site record for " + nzaa_id
-                s.digest = digest
-                s.last_change = now
                 self.logging(message)
                 if self.VERBOSE:
                     print message
+                previous = s.get_field_digests()
+                s.changed_fields = None
+                if previous:
+                    s.changed_fields = ','.join(sorted(
+                        [k for k in fields if previous.get(k) != fields[k]]))
+                    message = "Changed fields " + s.changed_fields
+                    self.logging(message)
+                    if self.VERBOSE:
+                        print message
 
-                log = (
-                    '127.0.0.1', 'scrape',
-                    "Updating record from from ArchSite."
-                )
+                s.digest = digest
+                s.field_digests = field_digests
+                s.last_change = now
                 s.__dict__.update(**site)
+                s.stamp(log=log_update, coordinates=False)
+                changed_sites.append(s)
+                log = log_update
 
-        except models.Site.DoesNotExist:
-            message = "Creating site record for " + nzaa_id
-            self.logging(message)
-            if self.VERBOSE:
-                print message
-            data = new_site.copy()
-            data.update(new_site)
-            s = models.Site(**data)
-
-            s.created = datetime.datetime.now(pytz.utc)
-            s.created_by = 'scrape'
-            s.digest = digest
-            s.last_change = now
-
-            log = (
-                '127.0.0.1', 'scrape',
-                "Creating record from from ArchSite.",
-            )
-
-            point = Point(s.easting, s.northing, 2913)
-            if not s.region:
-                s.region = s.get_region()
+            else:
+                message = "Creating site record for " + nzaa_id
+                self.logging(message)
+                if self.VERBOSE:
+                    print message
+                s = models.Site(**new_site)
+                s.created = datetime.datetime.now(pytz.utc)
+                s.created_by = 'scrape'
+                s.digest = digest
+                s.field_digests = field_digests
+                s.last_change = now
 
-            if not s.tla:
-                s.tla = s.get_tla()
+                if self.VERBOSE:
+                    print "Saving site record", s
 
-            if not s.island:
-                s.island = s.get_island()
+                s.stamp(log=log_create, coordinates=False)
+                new_sites.append(s)
+                log = log_create
 
-            if self.VERBOSE:
-                print "Saving site record", s
+            update0['update_id'] = update_id
+            u = updates.get(update_id)
+            if u:
+                message = "Updating existing record for " + update_id
+                self.logging(message)
+                if self.VERBOSE:
+                    print message
+                u.__dict__.update(**update0)
+                u.site = s
+                u.stamp(log=log)
+                changed_updates.append(u)
 
-        s.save(log=log)
+            else:
+                message = "Creating update record for " + update_id
+                self.logging(message)
+                if self.VERBOSE:
+                    print message
+                u = models.Update(**update0)
+                u.site = s
+                u.created = datetime.datetime.now(pytz.utc)
+                u.created_by = 'scrape'
+                u.stamp(log=log)
+                new_updates.append(u)
+
+        update_fields.discard('update_id')
+        saved = changed_sites + new_sites
+
+#       Convert the coordinates of all the sites together.
+        coords.fill(unchanged_sites + saved)
+
+        with self.metrics.timer('save'), transaction.atomic():
+            utils.bulk_update(
+                models.Site, unchanged_sites,
+                ['extracted', 'field_digests', 'log', 'geom'] +
+                list(coords.FIELDS))
+            utils.bulk_update(models.Site, changed_sites, list(site_fields))
+            models.Site.objects.bulk_create(new_sites)
+
+#           Fill region, TLA and island for the new sites together.
+            with self.metrics.timer('enrich'):
+                enrich.enrich([s.nzaa_id for s in new_sites])
+
+#           Footprints for the new and changed sites, in one query.
+            footprint.generate([s.nzaa_id for s in saved])
+
+#           Count the sheets of the new and changed sites again.
+            sitestats.update_sheets([s.nzms_sheet for s in saved])
+            density.update_sheets([s.nzms_sheet for s in saved])
+
+            utils.bulk_update(
+                models.Update, changed_updates, list(update_fields))
+            models.Update.objects.bulk_create(new_updates)
+
+#           Only relink the sites whose source values have changed.
+            self.link_terms(
+                models.Actor, 'sourcename',
+                dict([(s.nzaa_id, s.list_actors()) for s in saved
+                      if s.has_changed('inspected')]))
+            self.link_terms(
+                models.Feature, 'name',
+                dict([(s.nzaa_id, s.list_features()) for s in saved
+                      if s.has_changed('features')]))
+            self.link_terms(
+                models.Periods, 'name',
+                dict([(s.nzaa_id, s.list_periods()) for s in saved
+                      if s.has_changed('period')]))
+
+#       Refresh the contexts of the new and changed sites, and of the
+#       sites near them. Bulk writes send no signals, so the tree of
+#       nearest sites is marked out of date first. A failure here is
+#       logged, and leaves the saved batch alone.
+        if saved:
+            neighbours.changed()
+            try:
+                with self.metrics.timer('context'), transaction.atomic():
+                    sitecontext.refresh([s.nzaa_id for s in saved])
+            except Exception as e:
+                self.logging("Failed to refresh site contexts: " + str(e))
 
-#       If there are no changes, then we have done all we have to do.
-        if unchanged:
-            return None
+        self.metrics.count('unchanged', len(unchanged_sites))
+        self.metrics.count('updated', len(changed_sites))
+        self.metrics.count('created', len(new_sites))
 
-#       Deal with actors.
-        sourcenames = s.list_actors()
-        for sourcename in sourcenames:
-            try:
-                a = models.Actor.objects.get(sourcename=sourcename)
-            except:
-                a = models.Actor(sourcename=sourcename)
-                a.save()
-            a.sites.add(s)
-#       Deal with features.
-        features = s.list_features()
-        if features:
-            for feature in features:
-                try:
-                    f = models.Feature.objects.get(name=feature)
-                except:
-                    f = models.Feature(name=feature)
-                    f.save()
-                f.sites.add(s)
-#       Deal with period.
-        periods = s.list_periods()
-        for period in periods:
-            try:
-                p = models.Periods.objects.get(name=period)
-            except models.Periods.DoesNotExist:
-                p = models.Periods(name=period)
-                p.save()
-            p.sites.add(s)
+        return len(saved)
 
-        update0['site'] = s
-        update0['update_id'] = update_id
+    def link_terms(self, model, field, terms):
+        """Link sites to the terms of a vocabulary model.
 
-        try:
-            u = models.Update.objects.get(update_id=update_id)
-            u.nzaa_id = s
-            message = "Updating existing record for " + update_id
-            self.logging(message)
-            if self.VERBOSE:
-                print message
-            u.__dict__.update(**update0)
+        Model is one of Actor, Feature or Periods, each of which has a
+        sites relation. Field is the name of its text field, which is
+        unique. Terms is a dictionary of nzaa_id: list of values.
+        Missing terms are created, and missing links added, with one
+        INSERT each. Both skip rows already there, so that concurrent
+        scrapes linking the same terms do not make duplicates.
 
-        except models.Update.DoesNotExist:
-            message = "Creating update record for " + update_id
-            self.logging(message)
-            if self.VERBOSE:
-                print message
-            u = models.Update(**update0)
-            u.nzaa_id_id = s
-            u.created = datetime.datetime.now(pytz.utc)
-            u.created_by = 'scrape'
+        """
 
-        u.save(log=log)
+        pairs = set()
+        for (nzaa_id, names) in terms.items():
+            for value in names or []:
+                pairs.add((nzaa_id, value))
+        if not pairs:
+            return
+
+        table = model._meta.db_table
+        through = model.sites.through._meta.db_table
+        owner = model._meta.model_name + '_id'
+        (site_ids, values) = zip(*sorted(pairs))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO ' + table + ' ("' + field + '") '
+                'SELECT DISTINCT unnest(%s::text[]) ON CONFLICT DO NOTHING',
+                [list(values)])
+            cursor.execute(
+                'INSERT INTO ' + through + ' ("' + owner + '", "site_id") '
+                'SELECT t."id", v.site_id '
+                'FROM unnest(%s::text[], %s::text[]) AS v(site_id, value) '
+                'JOIN ' + table + ' t ON t."' + field + '" = v.value '
+                'ON CONFLICT DO NOTHING',
+                [list(site_ids), list(values)])
 
     def login(self):
         """Provide an authenticated browser session.
@@ -385,16 +756,53 @@ class Scrape(BaseCommand):
         need to be downloaeds, the selenium module to command a
         Firefix browser will be required.
 
+        Session cookies are kept in COOKIEFILE. If a cookie file from
+        an earlier run is found, the session is taken to be live, and
+        the login form is skipped. fetch_page() will log in again if
+        ArchSite has expired the session.
+
         """
 
-        if self.connection:
+        if self.connection or self.REPLAY:
             return True
 
+        browser = mechanize.Browser()
+        self.cookiejar = mechanize.LWPCookieJar(self.COOKIEFILE)
+        browser.set_cookiejar(self.cookiejar)
+
+        if os.path.isfile(self.COOKIEFILE):
+            try:
+                self.cookiejar.load(ignore_discard=True)
+                self.connection = True
+                self.browser = browser
+                message = "Reusing saved session for " + self.USERNAME
+                self.logging(message)
+                if self.VERBOSE:
+                    print message
+                return True
+
+            except (IOError, mechanize.LoadError):
+                self.cookiejar.clear()
+
+        return self.login_form(browser)
+
+    @timed('login')
+    def login_form(self, browser=None):
+        """Log in to ArchSite through the login form.
+
+        Save the session cookies to COOKIEFILE on success.
+
+        """
+
         message = "Attempting to login to archsite"
         if self.VERBOSE:
             print message
 
-        browser = mechanize.Browser()
+        if not browser:
+            browser = mechanize.Browser()
+            self.cookiejar = mechanize.LWPCookieJar(self.COOKIEFILE)
+            browser.set_cookiejar(self.cookiejar)
+
         browser.open(self.LOGIN_PAGE)
 
         browser.select_form(nr=0)
@@ -417,42 +825,180 @@ class Scrape(BaseCommand):
         if self.VERBOSE:
             print message
 
+        try:
+            self.cookiejar.save(ignore_discard=True)
+        except IOError:
+            self.logging("Unable to save session cookies " + self.COOKIEFILE)
+
         self.browser = browser
         return True
 
     def visit_site(self, nzaa_id):
-        """Return the HTML code for site page on ArchSite.
+        """Return the HTML code for site page on ArchSite, or None.
+
+        The page is stored in the page cache. In replay mode, it is
+        read from there instead. See fetch_page(), which raises a
+        FetchError where this returns None.
+
         """
 
         message = "Visiting " + nzaa_id
         if self.VERBOSE:
             print message
 
-        if not self.connection:
-            self.login()
+        if self.REPLAY:
+            return self.pagecache.latest(nzaa_id)
 
-        if not self.connection:
-            message = "No connection found. Exiting site page."
+        try:
+            return self.fetch_page(nzaa_id)
+        except self.FetchError as e:
+            message = "Internal error " + nzaa_id + ": " + str(e)
             self.logging(message)
             if self.VERBOSE:
                 print message
-
             return None
 
-        browser = self.browser
+    def fetch_page(self, nzaa_id):
+        """Return the HTML code for site page on ArchSite.
+
+        If ArchSite answers with its login page, the saved session has
+        expired. Log in again and retry once.
+
+        Raise a FetchError if there is no connection, logging in or the
+        request fails. The error is transient if the request might
+        succeed later: a failure to connect, a timeout, or an HTTP
+        status of 429 or 5xx.
+
+        """
+
         url = self.SITE_PAGE + nzaa_id
 
         try:
-            page = browser.open(url)
+            if not self.connection:
+                self.login()
+            if not self.connection:
+                raise self.FetchError("No connection to ArchSite.")
+
+            with self.metrics.timer('fetch'):
+                html = self.browser.open(url).read()
+
+            if "<h2>Log in</h2>" in html:
+                self.logging("Session expired for " + self.USERNAME)
+                self.connection = False
+                if not self.login_form():
+                    raise self.FetchError("Failed to log in again.")
+                with self.metrics.timer('fetch'):
+                    html = self.browser.open(url).read()
+
+        except self.FetchError:
+            self.metrics.count('errors')
+            raise
+        except Exception as e:
+            self.metrics.count('errors')
+            code = getattr(e, 'code', None)
+            transient = code is None or code == 429 or code >= 500
+            raise self.FetchError(
+                url + " " + e.__class__.__name__ + " " + str(e), transient)
+
+        self.metrics.count('bytes', len(html))
+
+        if self.CACHE_PAGES:
+            self.pagecache.store(nzaa_id, html)
+
+        return html
+
+    @timed('parse')
+    def extract_values(self, html):
+        """Return a dictionary of field: value items from an ArchSite page.
+
+        The page is parsed with the SCRAPE_PARSER backend, and walked
+        once, collecting the headings and the dd following each dt
+        label. (A plain walk over the descendants is much quicker than
+        find_all() with a list of names, which tests every element
+        through a SoupStrainer.) The record is the same as that from
+        extract_values_legacy(), which searches the whole page once for
+        each label. As there, the first dt with a label wins, and a
+        missing label (other than the evidence field) raises an
+        AttributeError.
+
+        """
+
+        if "No data was found for the site" in html:
+            self.metrics.count('missing')
+            return None
 
-            return page.read()
+        soup = BeautifulSoup(html, PARSER)
+
+        h3 = []
+        h4 = None
+        dd = {}
+        for tag in soup.descendants:
+            if tag.name == 'dt':
+                label = tag.string
+                if label in EXTRACT_LABELS and label not in dd:
+                    dd[label] = tag.findNextSibling('dd')
+            elif tag.name == 'h3':
+                h3.append(tag)
+            elif tag.name == 'h4' and h4 is None:
+                h4 = tag
 
+        try:
+            nzaa_id = h3[1].contents[1].strip()
         except:
-            self.logging("Internal error" + url)
+            self.metrics.count('missing')
             return None
 
-    def extract_values(self, html):
-        """Return a dictionary of field: value items from an ArchSite page.
+        try:
+            nzms_id = h3[1].contents[3].strip()
+        except:
+            nzms_id = None
+
+        try:
+            evidence = dd.get('Evidence site destroyed').text.strip()
+        except:
+            evidence = None
+
+#       The extracted values. Adding or removing fields, from this
+#       structure will affect the MD5 checksum used to determine if a
+#       site record has changed.
+        record = {
+            "nzaa_id": nzaa_id,
+            "nzms_id": nzms_id,
+            "evidence": unicode(evidence),
+            "status": unicode(h4.text),
+            "short_desc": unicode(h4.findNextSibling('p').text),
+            "inspected": unicode(dd.get('Site inspected by').text),
+            "nztm_coords": unicode(dd.get('NZTM Coordinates').text),
+            "source": unicode(dd.get('Source of spatial data').text.strip()),
+            "finder_aid": unicode(dd.get('Finder Aid').text.strip()),
+            "type": unicode(dd.get('Site Type').text.strip()[:254]),
+            "features": unicode(dd.get('Features').text.strip()[:2048]),
+            "description": unicode(dd.get('Description').prettify()),
+            "site_name": unicode(dd.get('Name').text.strip()[:254]),
+            "ethnicity": unicode(dd.get('Ethnicity').text.strip()[:254]),
+            "period": unicode(dd.get('Period').text.strip()[:254]),
+            "assoc_sites": unicode(
+                dd.get('Associated Sites').text.strip()[:2048]),
+            "condition": unicode(dd.get('Condition').text.strip()),
+            "condition_notes": unicode(dd.get('Condition Notes').prettify()),
+            "landuse": unicode(dd.get('Land Use').text.strip()[:254]),
+            "threats": unicode(dd.get('Threats').text.strip()[:254]),
+        }
+        if record['inspected'] == ' on ':
+            record['inspected'] = None
+
+        message = "Parsed ArchSite page content for " + record['nzaa_id']
+        if self.VERBOSE:
+            print message
+
+        return record
+
+    def extract_values_legacy(self, html):
+        """The original version of extract_values().
+
+        Kept as the reference for nzaa.management.commands.benchmark_parse,
+        which checks that extract_values() returns the same record.
+
         """
 
         if "No data was found for the site" in html:
@@ -525,6 +1071,7 @@ class Scrape(BaseCommand):
 
         return record
 
+    @timed('classify')
     def process_extract(self, extract):
         """Process the extracted dictionary into fields for db injection
 
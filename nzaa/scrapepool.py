@@ -0,0 +1,341 @@
+"""Concurrent scraping of ArchSite.
+
+A ScrapePool runs several fetch workers, each with its own logged-in
+mechanize session and cookie file, under the accounts listed in
+settings.LOGIN_ARCHSITE. Workers fetch and parse site pages, and hand
+the extracts to a single writer thread, which saves them in batches of
+settings.SCRAPE_BATCH through Scrape.save_batch().
+
+All the workers share one RateLimiter, so the total request rate to
+ArchSite stays at or below settings.SCRAPE_RATE, however many workers
+are running. Below that limit, throughput grows with the number of
+workers, since most of the time taken by a single scrape is spent
+waiting on the network.
+
+Use it from the shell:
+
+    import nzaa.scrapepool as scrapepool
+    p = scrapepool.ScrapePool(['S14', 'S15'], workers=4, verbose=True)
+
+or with the management command:
+
+    ./manage.py scrape S14 S15 --workers 4
+
+"""
+
+import Queue
+import threading
+import time
+
+from django.db import connection
+
+import settings
+import frontier
+import scrape
+from metrics import Metrics
+
+
+class RateLimiter():
+    """Space requests evenly, at no more than rate requests per second.
+
+    A rate of zero or None means no limit.
+
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 0
+        if rate:
+            self.interval = 1.0 / rate
+
+        self.lock = threading.Lock()
+        self.next_slot = time.time()
+
+    def wait(self):
+        """Block until this caller may make its request."""
+
+        if not self.interval:
+            return
+
+        with self.lock:
+            now = time.time()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class ScrapePool():
+    """Scrape a list of identifiers with a pool of fetch workers.
+
+    Initialise with the same identifiers accepted by Scrape (NZAA ids
+    or NZMS260 sheets). The number of workers and the request rate
+    default to settings.SCRAPE_WORKERS and settings.SCRAPE_RATE.
+
+    Accounts is a list of keys into settings.LOGIN_ARCHSITE. Workers
+    are given accounts in turn, so with three accounts and six
+    workers, each account holds two sessions.
+
+    Archsite is passed to each fetching Scrape object; see Scrape. With
+    save set False, extracts are counted but not written, to time
+    fetching and parsing alone.
+
+    """
+
+    STOP = None
+
+    counts = None
+    elapsed = 0
+
+    def __init__(self, identifiers=False, workers=None, rate=None,
+                 accounts=None, verbose=False, archsite=None, save=True,
+                 metrics=None):
+
+        self.workers = workers or settings.SCRAPE_WORKERS
+        self.rate = settings.SCRAPE_RATE
+        if rate is not None:
+            self.rate = rate
+
+        self.accounts = accounts
+        if not self.accounts:
+            self.accounts = sorted(settings.LOGIN_ARCHSITE.keys())
+
+        self.VERBOSE = verbose
+        self.archsite = archsite
+        self.save = save
+        self.limiter = RateLimiter(self.rate)
+        self.lock = threading.Lock()
+
+        self.fetch_queue = Queue.Queue()
+        self.write_queue = Queue.Queue(maxsize=self.workers * 10)
+
+        self.counts = {
+            'targets': 0,
+            'fetched': 0,
+            'missing': 0,
+            'saved': 0,
+            'errors': 0,
+        }
+
+        # All the Scrape objects in the pool share one set of metrics.
+        self.metrics = metrics
+        if not self.metrics:
+            self.metrics = Metrics()
+
+        # The writer's Scrape object expands identifiers, and saves
+        # extracts to the database.
+        self.writer = scrape.Scrape(verbose=verbose, metrics=self.metrics)
+
+        if identifiers:
+            self.run(identifiers)
+
+    def count(self, key, n=1):
+        with self.lock:
+            self.counts[key] += n
+
+    def run(self, identifiers):
+        """Scrape all the targets found in identifiers.
+
+        Return the dictionary of counts.
+
+        """
+
+        start = time.time()
+
+        targets = self.writer.scrape_this(identifiers, self.VERBOSE)
+        self.counts['targets'] = len(targets)
+        for target in targets:
+            self.fetch_queue.put(target)
+
+        # Each sheet is probed for new sites by one worker, as probing
+        # goes one ordinal at a time. Different sheets are probed in
+        # parallel.
+        for sheet in self.writer.frontiers:
+            self.fetch_queue.put(sheet)
+
+        fetchers = []
+        for n in range(0, self.workers):
+            account = self.accounts[n % len(self.accounts)]
+            session = scrape.Scrape(
+                verbose=self.VERBOSE, account=account, metrics=self.metrics,
+                archsite=self.archsite, worker=n)
+            t = threading.Thread(
+                target=self.fetch_worker, args=(session,),
+                name='fetch-' + str(n))
+            t.daemon = True
+            fetchers.append(t)
+            self.fetch_queue.put(self.STOP)
+
+        writer = threading.Thread(target=self.write_worker, name='write')
+        writer.daemon = True
+
+        writer.start()
+        for t in fetchers:
+            t.start()
+
+        for t in fetchers:
+            t.join()
+
+        self.write_queue.put(self.STOP)
+        writer.join()
+
+        self.elapsed = time.time() - start
+        for sheet in self.writer.frontiers:
+            self.writer.logging(sheet.summary())
+            if self.VERBOSE:
+                print sheet.summary()
+        self.writer.logging(self.summary())
+        if self.VERBOSE:
+            print self.summary()
+
+        table = self.metrics.report()
+        for line in table.split('\n'):
+            self.writer.logging(line)
+        self.metrics.close()
+
+        return self.counts
+
+    def fetch_worker(self, session):
+        """Fetch and parse pages until a STOP is taken from the queue.
+
+        An item on the queue is an nzaa_id, or a SheetFrontier to probe.
+
+        An exception while fetching an item is counted as an error and
+        logged, and the worker goes on to the next item. If the first
+        login fails, fetch_page() tries again for each page.
+
+        """
+
+        self.limiter.wait()
+        try:
+            session.login()
+        except Exception as e:
+            self.count('errors')
+            session.logging("Failed to log in as " + session.USERNAME +
+                            ": " + e.__class__.__name__ + " " + str(e))
+
+        def fetch(nzaa_id):
+            self.limiter.wait()
+            html = session.visit_site(nzaa_id)
+
+            extract = None
+            if html:
+                self.count('fetched')
+                extract = session.extract_values(html)
+
+            if not extract:
+                self.count('missing')
+                if session.VERBOSE:
+                    print "No site record found for", nzaa_id
+
+            return extract
+
+        def probe(nzaa_id):
+            self.limiter.wait()
+            extract = session.probe_extract(nzaa_id)
+            self.count('fetched')
+            if not extract:
+                self.count('missing')
+            return extract
+
+        while True:
+            item = self.fetch_queue.get()
+            if item is self.STOP:
+                break
+
+            try:
+                if isinstance(item, frontier.SheetFrontier):
+                    for found in item.probe(probe):
+                        self.write_queue.put(found)
+                    if item.failed:
+                        self.count('errors', len(item.failed))
+                        session.logging("Failed to probe " +
+                                        ", ".join(sorted(item.failed)))
+                    continue
+
+                extract = fetch(item)
+                if extract:
+                    self.write_queue.put((item, extract))
+
+            except Exception as e:
+                self.count('errors')
+                name = item
+                if isinstance(item, frontier.SheetFrontier):
+                    name = "sheet " + item.sheet
+                message = ("Failed to fetch " + name + ": " +
+                           e.__class__.__name__ + " " + str(e))
+                session.logging(message)
+                if session.VERBOSE:
+                    print message
+
+    def write_worker(self):
+        """Save extracts until a STOP is taken from the queue.
+
+        Extracts are saved in batches of settings.SCRAPE_BATCH. A batch
+        is also saved whenever the queue runs dry, so the writer never
+        sits on extracts while the fetchers are waiting on ArchSite.
+
+        Django opens a database connection for each thread. Close this
+        one when the queue is finished.
+
+        """
+
+        batch = []
+        try:
+            while True:
+                if batch and self.write_queue.empty():
+                    self.write_batch(batch)
+                    batch = []
+
+                item = self.write_queue.get()
+                if item is self.STOP:
+                    break
+
+                batch.append(item)
+                if len(batch) >= settings.SCRAPE_BATCH:
+                    self.write_batch(batch)
+                    batch = []
+
+            if batch:
+                self.write_batch(batch)
+        finally:
+            connection.close()
+
+    def write_batch(self, batch):
+        """Save a list of (nzaa_id, extract) tuples in one transaction.
+
+        If the batch fails, it is rolled back, and its extracts are
+        counted as errors.
+
+        """
+
+        try:
+            if self.save:
+                self.writer.save_batch(batch)
+            self.count('saved', len(batch))
+        except Exception as e:
+            self.count('errors', len(batch))
+            nzaa_ids = ", ".join([nzaa_id for (nzaa_id, extract) in batch])
+            self.writer.logging("Failed to save " + nzaa_ids + ": " + str(e))
+
+    def rate_per_minute(self):
+        """Records saved per minute over the last run."""
+
+        if not self.elapsed:
+            return 0
+        return self.counts['saved'] / self.elapsed * 60
+
+    def summary(self):
+        """One line describing the last run."""
+
+        line = "Scrape pool: " + str(self.workers) + " workers, "
+        line += str(self.counts['targets']) + " targets, "
+        line += str(self.counts['saved']) + " saved, "
+        line += str(self.counts['missing']) + " missing, "
+        line += str(self.counts['errors']) + " errors, "
+        line += str(sum([f.saved() for f in self.writer.frontiers]))
+        line += " requests saved, in "
+        line += str(int(self.elapsed)) + " s ("
+        line += str(int(self.rate_per_minute())) + " records/minute)"
+
+        return line
@@ -20,6 +20,53 @@ SITE_PAGE = "https://archsite.eaglegis.co.nz/NZAA/Site/?id="
 EDIT_SITE = "https://archsite.eaglegis.co.nz/NZAA/Site/Edit/?id="
 CREATE_SITE = "https://archsite.eaglegis.co.nz/NZAA/Site/Create"
 
+# Concurrent scraping. Number of fetch workers, and the most requests
+# per second made to ArchSite by all workers together.
+SCRAPE_WORKERS = 4
+SCRAPE_RATE = 2.0
+
+# Extracts are saved to the database in batches of this many sites,
+# each batch in one transaction. See Scrape.save_batch().
+SCRAPE_BATCH = 50
+
+# BeautifulSoup backend used to parse ArchSite pages: 'lxml' or
+# 'html.parser'. Check a change with ./manage.py benchmark_parse, as
+# the backends may build different trees from badly formed pages.
+SCRAPE_PARSER = 'lxml'
+
+# Sheets are scraped with a SheetFrontier (see nzaa.frontier) unless
+# SCRAPE_FRONTIER is False. Known sites, and gaps in the numbering,
+# are fetched again after SCRAPE_REFRESH_DAYS. Probing for new sites
+# past the highest ordinal goes one at a time until
+# SCRAPE_FRONTIER_MISSES misses in a row, then gallops on, filling in
+# only before a site it finds.
+SCRAPE_FRONTIER = True
+SCRAPE_REFRESH_DAYS = 28
+SCRAPE_FRONTIER_MISSES = 6
+
+# The scrape job queue (see nzaa.jobqueue). A claim on a job expires
+# after SCRAPE_JOB_LEASE seconds. A job which fails transiently waits
+# SCRAPE_JOB_BACKOFF seconds, doubling with each attempt, and fails
+# for good after SCRAPE_JOB_ATTEMPTS attempts.
+SCRAPE_JOB_LEASE = 900
+SCRAPE_JOB_BACKOFF = 60
+SCRAPE_JOB_ATTEMPTS = 6
+
+# Raw pages fetched from ArchSite are kept here. See nzaa.pagecache.
+PAGE_CACHE = os.path.join(BASE_DIR, 'etc', 'archsite')
+SCRAPE_CACHE_PAGES = True
+
+# Timings and counts from scrape runs. See nzaa.metrics.
+SCRAPE_METRICS = os.path.join(BASE_DIR, 'etc', 'metrics')
+
+# The k-d tree of site locations (see nzaa.neighbours) is built again
+# when the site table has changed, looked at most this many seconds
+# apart.
+NEIGHBOURS_CHECK = 60
+
+# Columnar snapshots of the site records. See nzaa.snapshot.
+SNAPSHOT_DIR = os.path.join(BASE_DIR, 'etc', 'snapshots')
+
 CONDITION = (
     'Destroyed',
     'Not a site',
@@ -0,0 +1,396 @@
+"""The geographic context of each site, kept in the SiteContext table.
+
+The geographic panel of a site page shows the closest place names,
+road and other sites, the map sheets, land parcel, aerial photographs
+and orthophoto tiles at the site: a dozen or more spatial queries a
+view when made from the Record methods. Instead, they are worked out
+for many sites at a time, with one query for a batch of sites, and
+stored as JSON in SiteContext, so a page reads them in one query.
+
+    import nzaa.sitecontext as sitecontext
+    sitecontext.refresh()
+
+or ./manage.py sitecontext, run after a change to a geolib layer,
+brings the table up to date. A site's context is worked out again if
+it has none, if it is marked stale, or if the site has moved. A new,
+moved or deleted site marks stale the sites which have it (or would
+now have it) among their closest sites, and their contexts are worked
+out again too. A change to one of the geolib LAYERS, seen by its
+PostgreSQL row count (see LayerVersion), marks every context stale.
+
+Site.save() and delete() refresh a site which is new, has moved or is
+deleted, once the transaction commits, and Scrape.save_batch() the
+sites it writes, so the table follows changes to the sites as they
+are made. A change made any other way needs refresh(), or the command.
+
+Site.geo_context() only reads: a missing or stale context is worked
+out from the Record methods for the page, and not stored.
+
+"""
+
+import datetime
+import json
+
+import pytz
+from django.db import connection, transaction
+
+import geolib.models
+import geolib.spatialindex
+import models
+import neighbours
+
+
+# Geolib layers the context is drawn from.
+LAYERS = ('PlaceName', 'Topo50_Road', 'TopoMap', 'NZMSgrid', 'Cadastre',
+          'AerialFrame', 'OrthoTile')
+
+PLACE_DISTANCE = 10000
+PLACE_COUNT = 3
+ROAD_DISTANCE = 10000
+SITE_DISTANCE = 100000
+SITE_COUNT = 3
+
+
+def describe(obj, label=None):
+    """Return {'label': ..., 'url': ...} for a geolib object, or None."""
+
+    if obj is None:
+        return None
+    if label is None:
+        label = unicode(obj)
+    return {'label': label, 'url': getattr(obj, 'url', '')}
+
+
+def make_context(places, road, sites, topomaps, nzmsgrids, parcels,
+                 airphotos, orthotiles):
+    """Return the context dictionary.
+
+    Places and sites are lists of (name, distance), road is one or
+    None, and the rest lists of geolib objects in their model's order.
+
+    """
+
+    topo50 = None
+    nzms = None
+    for sheet in topomaps:
+        if sheet.series_id == 'TOPO50' and not topo50:
+            topo50 = sheet
+        if sheet.series_id == 'NZMS260' and not nzms:
+            nzms = sheet
+    if not nzms and nzmsgrids:
+        nzms = nzmsgrids[0]
+
+    parcel = None
+    if parcels:
+        parcel = describe(parcels[0], parcels[0].appellation)
+
+    mapsheets = []
+    for sheet in topomaps:
+        d = describe(sheet)
+        d['series'] = unicode(sheet.series)
+        mapsheets.append(d)
+
+    return {
+        'places': [list(place) for place in places],
+        'road': road and list(road),
+        'sites': [list(site) for site in sites],
+        'topo50': describe(topo50),
+        'nzms': describe(nzms),
+        'parcel': parcel,
+        'mapsheets': mapsheets,
+        'airphotos': [describe(frame) for frame in airphotos],
+        'orthotiles': [describe(tile) for tile in orthotiles],
+    }
+
+
+def live_context(record):
+    """Return the context of a record, from the Record methods.
+
+    For records without a SiteContext, such as new sites.
+
+    """
+
+    nzmsgrids = []
+    nzms = record.get_nzms_sheet()
+    if isinstance(nzms, geolib.models.NZMSgrid):
+        nzmsgrids = [nzms]
+
+    return make_context(
+        record.closest_placenames(), record.closest_road(),
+        record.closest_sites(), list(record.mapsheets()), nzmsgrids,
+        list(record.parcels()[:1]), record.airphotos(),
+        record.ortho_tiles())
+
+
+def batch_query():
+    """Return the SQL finding the context of a list of sites."""
+
+    site = models.Site._meta.db_table
+    place = geolib.models.PlaceName._meta.db_table
+    road = geolib.models.Topo50_Road._meta.db_table
+
+    def intersecting(model, column='id'):
+        return ('ARRAY(SELECT "' + column + '" FROM ' +
+                model._meta.db_table + ' WHERE ST_Intersects("geom", '
+                's."geom"))')
+
+    return (
+        'SELECT s."nzaa_id", '
+
+        '(SELECT json_agg(json_build_array(t.name, t.d) ORDER BY t.d) '
+        'FROM (SELECT "name" AS name, ST_Distance("geom", s."geom") AS d '
+        'FROM ' + place + ' WHERE ST_DWithin("geom", s."geom", %s) '
+        'ORDER BY d LIMIT %s) t), '
+
+        '(SELECT json_build_array(t.name, t.d) '
+        'FROM (SELECT "name" AS name, ST_Distance("geom", s."geom") AS d '
+        'FROM ' + road + ' WHERE ST_DWithin("geom", s."geom", %s) '
+        'ORDER BY d LIMIT 1) t), ' +
+
+        intersecting(geolib.models.TopoMap) + ', ' +
+        intersecting(geolib.models.NZMSgrid, 'identifier') + ', ' +
+        intersecting(geolib.models.Cadastre) + ', ' +
+        intersecting(geolib.models.AerialFrame) + ', ' +
+        intersecting(geolib.models.OrthoTile) + ' '
+
+        'FROM ' + site + ' s '
+        'WHERE s."nzaa_id" = ANY(%s) AND s."geom" IS NOT NULL'
+    )
+
+
+def ordered(model, pks, *related):
+    """Return a dictionary of pk: (position, object) for pks.
+
+    Position is the object's place in the model's ordering, or in
+    order of primary key for a model without one.
+
+    """
+
+    if not pks:
+        return {}
+
+    objs = model.objects.filter(pk__in=pks).select_related(*related)
+    if not model._meta.ordering:
+        objs = objs.order_by('pk')
+
+    return dict([(obj.pk, (n, obj)) for n, obj in enumerate(objs)])
+
+
+def pick(objects, pks):
+    """Return the objects for pks, in the model's order."""
+
+    found = [objects[pk] for pk in pks if pk in objects]
+    return [obj for (n, obj) in sorted(found)]
+
+
+def compute(nzaa_ids):
+    """Return a dictionary of nzaa_id: context for the sites.
+
+    Sites without a location are left out. The closest sites come
+    from the k-d tree of site locations, checked first for changes to
+    the site table (see nzaa.neighbours).
+
+    """
+
+    if not nzaa_ids:
+        return {}
+
+    with connection.cursor() as cursor:
+        cursor.execute(batch_query(), [
+            PLACE_DISTANCE, PLACE_COUNT, ROAD_DISTANCE, list(nzaa_ids)])
+        rows = cursor.fetchall()
+
+    closest = neighbours.get_tree(check=True).nearest_all(
+        [row[0] for row in rows], SITE_COUNT, SITE_DISTANCE)
+
+    pks = [set(), set(), set(), set(), set()]
+    for row in rows:
+        for n in range(5):
+            pks[n].update(row[3 + n])
+
+    topomaps = ordered(geolib.models.TopoMap, pks[0], 'series')
+    nzmsgrids = ordered(geolib.models.NZMSgrid, pks[1])
+    parcels = ordered(geolib.models.Cadastre, pks[2])
+    airphotos = ordered(geolib.models.AerialFrame, pks[3], 'run__survey')
+    orthotiles = ordered(geolib.models.OrthoTile, pks[4], 'series')
+
+    contexts = {}
+    for row in rows:
+        contexts[row[0]] = make_context(
+            row[1] or [], row[2], closest.get(row[0], []),
+            pick(topomaps, row[3]), pick(nzmsgrids, row[4]),
+            pick(parcels, row[5])[:1], pick(airphotos, row[6]),
+            pick(orthotiles, row[7]))
+
+    return contexts
+
+
+def sites_radius(context):
+    """Return the distance within which another site would be listed.
+
+    A site closer than this, moving or being added or deleted, changes
+    the context's closest sites.
+
+    """
+
+    if len(context['sites']) < SITE_COUNT:
+        return SITE_DISTANCE
+    return context['sites'][-1][1]
+
+
+def store(nzaa_ids):
+    """Work out and store the contexts of the sites.
+
+    Return the number stored.
+
+    """
+
+    contexts = compute(nzaa_ids)
+    geoms = dict(models.Site.objects.filter(
+        nzaa_id__in=list(contexts.keys())).values_list('nzaa_id', 'geom'))
+
+    now = datetime.datetime.now(pytz.utc)
+    rows = []
+    for (nzaa_id, context) in contexts.items():
+        rows.append(models.SiteContext(
+            nzaa_id=nzaa_id, geom=geoms[nzaa_id],
+            context=json.dumps(context), sites_radius=sites_radius(context),
+            stale=False, refreshed=now))
+
+    with transaction.atomic():
+        models.SiteContext.objects.filter(nzaa_id__in=nzaa_ids).delete()
+        models.SiteContext.objects.bulk_create(rows)
+
+    return len(rows)
+
+
+def check_layers():
+    """Mark every context stale if a geolib layer has changed.
+
+    Return the list of tables which have changed.
+
+    """
+
+    now = datetime.datetime.now(pytz.utc)
+    changed = []
+    for name in LAYERS:
+        layer = getattr(geolib.models, name)
+        table = layer._meta.db_table
+        version = geolib.spatialindex.table_version(layer)
+        (row, created) = models.LayerVersion.objects.get_or_create(
+            table=table, defaults={'version': version, 'checked': now})
+        if not created and row.version != version:
+            changed.append(table)
+            row.version = version
+        row.checked = now
+        row.save()
+
+    if changed:
+        models.SiteContext.objects.update(stale=True)
+
+    return changed
+
+
+def refresh(nzaa_ids=None, batch_size=500, verbose=False):
+    """Bring the stored contexts up to date.
+
+    Given nzaa_ids, only those sites are looked at, with the sites
+    near them which they make stale; otherwise all, after checking
+    the layers for changes. Return a dictionary of counts.
+
+    """
+
+    counts = {'layers': 0, 'neighbours': 0, 'removed': 0, 'stored': 0}
+    site = models.Site._meta.db_table
+    table = models.SiteContext._meta.db_table
+
+    if nzaa_ids is None:
+        counts['layers'] = len(check_layers())
+
+    where = ''
+    params = []
+    if nzaa_ids is not None:
+        where = ' AND s."nzaa_id" = ANY(%s)'
+        params = [list(nzaa_ids)]
+
+    with connection.cursor() as cursor:
+        # Sites which are new, or have moved or gone, since their
+        # contexts were stored: their old and new locations.
+        cursor.execute(
+            'WITH changed AS ('
+            'SELECT s."geom" FROM ' + site + ' s '
+            'LEFT JOIN ' + table + ' c ON c."nzaa_id" = s."nzaa_id" '
+            'WHERE s."geom" IS NOT NULL AND (c."nzaa_id" IS NULL OR '
+            'NOT ST_Equals(c."geom", s."geom"))' + where + ' '
+            'UNION ALL '
+            'SELECT c."geom" FROM ' + table + ' c '
+            'LEFT JOIN ' + site + ' s ON s."nzaa_id" = c."nzaa_id" '
+            'WHERE (s."nzaa_id" IS NULL OR s."geom" IS NULL OR '
+            'NOT ST_Equals(c."geom", s."geom"))' +
+            where.replace('s."nzaa_id"', 'c."nzaa_id"') + ') '
+            'UPDATE ' + table + ' c SET "stale" = TRUE FROM changed '
+            'WHERE NOT c."stale" '
+            'AND ST_DWithin(c."geom", changed."geom", %s) '
+            'AND ST_Distance(c."geom", changed."geom") <= c."sites_radius" '
+            'RETURNING c."nzaa_id"',
+            params + params + [SITE_DISTANCE])
+        neighbours = set([row[0] for row in cursor.fetchall()])
+        counts['neighbours'] = len(neighbours)
+
+        cursor.execute(
+            'DELETE FROM ' + table + ' c WHERE NOT EXISTS ('
+            'SELECT 1 FROM ' + site + ' s WHERE s."nzaa_id" = c."nzaa_id" '
+            'AND s."geom" IS NOT NULL)' +
+            where.replace('s."nzaa_id"', 'c."nzaa_id"'), params)
+        counts['removed'] = cursor.rowcount
+
+        cursor.execute(
+            'SELECT s."nzaa_id" FROM ' + site + ' s '
+            'LEFT JOIN ' + table + ' c ON c."nzaa_id" = s."nzaa_id" '
+            'WHERE s."geom" IS NOT NULL AND (c."nzaa_id" IS NULL OR '
+            'c."stale" OR NOT ST_Equals(c."geom", s."geom"))' + where + ' '
+            'ORDER BY s."nzaa_id"', params)
+        due = [row[0] for row in cursor.fetchall()]
+
+    due = sorted(set(due) | neighbours)
+
+    for n in range(0, len(due), batch_size):
+        counts['stored'] += store(due[n:n + batch_size])
+        if verbose:
+            print ("Site context: " + str(counts['stored']) + " of " +
+                   str(len(due)) + " stored")
+
+    return counts
+
+
+def refresh_on_commit(nzaa_ids):
+    """Refresh the sites once the current transaction commits.
+
+    The tree of nearest sites is marked out of date first. For
+    Site.save() and delete(), which send no batch of their own.
+
+    """
+
+    nzaa_ids = list(nzaa_ids)
+
+    def run():
+        neighbours.changed()
+        with transaction.atomic():
+            refresh(nzaa_ids)
+
+    transaction.on_commit(run)
+
+
+def context(site):
+    """Return the context of a site, from SiteContext.
+
+    A missing, stale or moved context is worked out with
+    live_context(), but not stored, so a page view writes nothing.
+
+    """
+
+    row = models.SiteContext.objects.filter(nzaa_id=site.nzaa_id).first()
+    if row and not row.stale and site.geom and row.geom.equals(site.geom):
+        return row.get_context()
+
+    return live_context(site)
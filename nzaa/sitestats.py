@@ -0,0 +1,126 @@
+"""Counts of sites, kept in the SiteStatistic table.
+
+The home page, the NZAA region list and the site list pages count
+sites by region, TLA, sheet and type. Instead of counting the site
+table on every request, SiteStatistic holds a count of the sites for
+each combination of the KEY fields that occurs, a few thousand rows,
+which these pages add up:
+
+    import nzaa.sitestats as sitestats
+    sitestats.total()
+    sitestats.total(region='Auckland')
+    sitestats.breakdown('lgcy_type', tla='Far North District')
+    sitestats.counts('nzms_sheet')
+
+Every key includes the sheet, so a sheet's rows can be counted again
+on their own. update_sheets() does so, and is called by scrapes for
+the sheets of each batch, and by reclassify and enrich for the sheets
+they change. A site saved with a change to a KEY field, or deleted,
+has its old and new sheets counted again once the transaction
+commits, by update_sheets_on_commit(). A change made any
+other way needs update_sheets() or rebuild(), which counts every
+sheet, or ./manage.py sitestats.
+
+"""
+
+from django.db import connection, transaction
+from django.db.models import Sum
+
+import models
+
+
+KEY = ('nzms_sheet', 'region', 'tla', 'site_type', 'lgcy_type', 'period',
+       'record_quality')
+
+
+def count_query(where=''):
+    """Return the SQL counting sites into the SiteStatistic table."""
+
+    columns = ', '.join(['"' + field + '"' for field in KEY])
+
+    return (
+        'INSERT INTO ' + models.SiteStatistic._meta.db_table + ' (' +
+        columns + ', "count") SELECT ' + columns + ', count(*) '
+        'FROM ' + models.Site._meta.db_table + where + ' '
+        'GROUP BY ' + columns)
+
+
+def rebuild():
+    """Count every site again. Return the number of rows made."""
+
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(
+            'LOCK TABLE ' + models.SiteStatistic._meta.db_table +
+            ' IN EXCLUSIVE MODE')
+        cursor.execute(
+            'DELETE FROM ' + models.SiteStatistic._meta.db_table)
+        cursor.execute(count_query())
+        return cursor.rowcount
+
+
+def update_sheets(sheets):
+    """Count the sites on the sheets again.
+
+    Each sheet is locked while it is counted, so two processes
+    counting the same sheet don't both add its rows.
+
+    """
+
+    sheets = sorted(set([sheet for sheet in sheets if sheet]))
+    if not sheets:
+        return
+
+    table = models.SiteStatistic._meta.db_table
+    with transaction.atomic(), connection.cursor() as cursor:
+        for sheet in sheets:
+            cursor.execute(
+                "SELECT pg_advisory_xact_lock(hashtext(%s))",
+                ['sitestats ' + sheet])
+        cursor.execute(
+            'DELETE FROM ' + table + ' WHERE "nzms_sheet" = ANY(%s)',
+            [sheets])
+        cursor.execute(
+            count_query(' WHERE "nzms_sheet" = ANY(%s)'), [sheets])
+
+
+def update_sheets_on_commit(sheets):
+    """Count the sites on the sheets again once the transaction commits."""
+
+    sheets = list(sheets)
+    transaction.on_commit(lambda: update_sheets(sheets))
+
+
+def total(**filters):
+    """Return the number of sites, of those matching filters.
+
+    Filters are on the KEY fields, as in filter().
+
+    """
+
+    n = models.SiteStatistic.objects.filter(**filters).aggregate(
+        n=Sum('count'))['n']
+    return n or 0
+
+
+def counts(field, **filters):
+    """Return a list of (value, count) of sites by a KEY field.
+
+    Of the sites matching filters, in order of value, with None last.
+
+    """
+
+    rows = models.SiteStatistic.objects.filter(**filters).order_by(
+        ).values_list(field).annotate(n=Sum('count'))
+
+    return sorted(rows, key=lambda row: (row[0] is None, row[0]))
+
+
+def breakdown(field, **filters):
+    """Return counts() as dictionaries of field: value and 'cnt': count.
+
+    As made by analyse.Site.count_by_type() and its kind.
+
+    """
+
+    return [{field: value, 'cnt': n} for (value, n) in
+            counts(field, **filters)]
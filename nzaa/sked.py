@@ -4,10 +4,18 @@ Generates lists of NZAA site record identifiers, given an NZMS 260
 sheet identifier and a maximum number.
 
 Will be called from command line.
+
+The lists can be read by Scrape.parse_listfile(). For runs which need
+to survive a crash, put the identifiers in the scrape job queue with
+enqueue() instead, and work it with nzaa.jobqueue.
 """
 
 import datetime
 
+from django.utils import timezone
+
+import models
+
 
 def sked(sheet, ordinal, fname=None):
     now = datetime.datetime.now()
@@ -27,3 +35,30 @@ def sked(sheet, ordinal, fname=None):
         f = open(fname, 'w')
         f.write(output)
     return output
+
+
+def enqueue(identifiers, requeue=False):
+    """Add nzaa_ids to the scrape job queue. Return the number added.
+
+    Identifiers already in the queue are left alone, unless requeue
+    is set, when finished or failed jobs are queued again with their
+    attempts reset. Jobs claimed by a worker are never touched.
+
+    """
+
+    identifiers = set(identifiers)
+    existing = set(models.ScrapeJob.objects.filter(
+        nzaa_id__in=identifiers).values_list('nzaa_id', flat=True))
+
+    jobs = [models.ScrapeJob(nzaa_id=nzaa_id)
+            for nzaa_id in sorted(identifiers - existing)]
+    models.ScrapeJob.objects.bulk_create(jobs)
+    added = len(jobs)
+
+    if requeue and existing:
+        added += models.ScrapeJob.objects.filter(
+            nzaa_id__in=existing, state__in=['done', 'missing', 'failed']
+        ).update(state='queued', attempts=0, last_error=None,
+                 next_eligible=timezone.now(), finished=None)
+
+    return added
@@ -0,0 +1,285 @@
+"""Columnar snapshots of the site records, for analysis in memory.
+
+write() copies the sites, their update records, the actor, feature
+and period vocabularies and their links to sites, into a new version
+directory under settings.SNAPSHOT_DIR, one NumPy array a column. Rows
+are read from the database and written in chunks of CHUNK rows, each
+chunk of a table a compressed .npz file, so the whole collection is
+never held in memory at once:
+
+    import nzaa.snapshot as snapshot
+    snapshot.write()
+
+or ./manage.py snapshot. load() reads the latest version, or a given
+one, back a table at a time:
+
+    snap = snapshot.load()
+    sites = snap.table('site')
+    sites['nzaa_id'][sites['site_type'] == 'Pa']
+    snap.table('update', ['site', 'updated'])
+
+Text is a unicode array, with an empty string for None. Dates are
+datetime64[D] and times datetime64[s] in UTC, with NaT for None.
+Integers are int64, or float64 with NaN where there are Nones. A
+site's location is its NZTM easting and northing, radius, WGS84 and
+NZMG coordinates. Long text fields, geometries and logs are left out.
+
+A version is named for the UTC time it was begun. It is written to a
+.partial directory, renamed when complete, so a reader never sees half
+a snapshot; versions() and load() pass over .partial directories.
+manifest.json in each version lists its tables, columns, rows and
+chunks.
+
+"""
+
+import datetime
+import json
+import os
+import shutil
+
+import numpy
+import pytz
+
+import models
+import settings
+
+
+FORMAT = 1
+CHUNK = 50000
+
+SITE_COLUMNS = (
+    'nzaa_id', 'nzms_sheet', 'ordinal', 'site_name', 'site_type',
+    'site_subtype', 'period', 'ethnicity', 'region', 'tla', 'island',
+    'record_quality', 'lgcy_type', 'lgcy_period', 'lgcy_ethnicity',
+    'status', 'recorded', 'recorded_by', 'updated', 'updated_by',
+    'visited', 'visited_by', 'easting', 'northing', 'radius',
+    'wgs84_lon', 'wgs84_lat', 'nzmg_easting', 'nzmg_northing', 'created',
+    'modified', 'last_change')
+
+UPDATE_COLUMNS = (
+    'update_id', 'site', 'ordinal', 'update_type', 'site_type',
+    'site_subtype', 'period', 'ethnicity', 'updated', 'updated_by',
+    'visited', 'visited_by', 'easting', 'northing', 'status', 'opstatus',
+    'created', 'modified')
+
+
+def tables():
+    """Return a list of (name, model, columns) to write."""
+
+    return [
+        ('site', models.Site, SITE_COLUMNS),
+        ('update', models.Update, UPDATE_COLUMNS),
+        ('actor', models.Actor, ('id', 'sourcename', 'fullname')),
+        ('feature', models.Feature, ('id', 'name')),
+        ('periods', models.Periods, ('id', 'name')),
+        ('actor_sites', models.Actor.sites.through, ('actor', 'site')),
+        ('feature_sites', models.Feature.sites.through, ('feature', 'site')),
+        ('periods_sites', models.Periods.sites.through, ('periods', 'site')),
+    ]
+
+
+def kind(model, column):
+    """Return how a column is stored: text, int, float, date or time."""
+
+    field = model._meta.get_field(column)
+    if field.is_relation:
+        field = field.target_field
+
+    internal = field.get_internal_type()
+    if internal in ('AutoField', 'BigAutoField', 'BigIntegerField',
+                    'IntegerField', 'PositiveIntegerField',
+                    'PositiveSmallIntegerField', 'SmallIntegerField'):
+        return 'int'
+    if internal in ('FloatField', 'DecimalField'):
+        return 'float'
+    if internal == 'DateField':
+        return 'date'
+    if internal == 'DateTimeField':
+        return 'time'
+    return 'text'
+
+
+def to_array(values, kind):
+    """Return a list of column values as a NumPy array of kind."""
+
+    if kind == 'int':
+        if None not in values:
+            return numpy.array(values, dtype=numpy.int64)
+        kind = 'float'
+
+    if kind == 'float':
+        return numpy.array(
+            [numpy.nan if v is None else v for v in values],
+            dtype=numpy.float64)
+
+    if kind == 'date':
+        return numpy.array(values, dtype='datetime64[D]')
+
+    if kind == 'time':
+        return numpy.array(
+            [v and v.astimezone(pytz.utc).replace(tzinfo=None)
+             for v in values], dtype='datetime64[s]')
+
+    return numpy.array([v or u'' for v in values], dtype=unicode)
+
+
+def write_table(path, name, model, columns, chunk_size=CHUNK):
+    """Write a table's chunks to the directory path.
+
+    Return the table's manifest entry.
+
+    """
+
+    kinds = [kind(model, column) for column in columns]
+    rows = model.objects.order_by('pk').values_list(*columns)
+
+    entry = {
+        'columns': list(columns),
+        'kinds': kinds,
+        'rows': 0,
+        'chunks': 0,
+    }
+
+    def flush(chunk):
+        data = {}
+        for (n, column) in enumerate(columns):
+            data[column] = to_array([row[n] for row in chunk], kinds[n])
+        filename = '%s.%04d.npz' % (name, entry['chunks'])
+        numpy.savez_compressed(os.path.join(path, filename), **data)
+        entry['rows'] += len(chunk)
+        entry['chunks'] += 1
+
+    chunk = []
+    for row in rows.iterator():
+        chunk.append(row)
+        if len(chunk) >= chunk_size:
+            flush(chunk)
+            chunk = []
+    if chunk or not entry['chunks']:
+        flush(chunk)
+
+    return entry
+
+
+def write(directory=None, chunk_size=CHUNK, verbose=False):
+    """Write a new snapshot version. Return its path."""
+
+    directory = directory or settings.SNAPSHOT_DIR
+    now = datetime.datetime.now(pytz.utc)
+    version = now.strftime('%Y%m%dT%H%M%SZ')
+    path = os.path.join(directory, version)
+    partial = path + '.partial'
+
+    if os.path.isdir(partial):
+        shutil.rmtree(partial)
+    os.makedirs(partial)
+
+    manifest = {
+        'format': FORMAT,
+        'version': version,
+        'created': now.isoformat(),
+        'tables': {},
+    }
+
+    try:
+        for (name, model, columns) in tables():
+            manifest['tables'][name] = write_table(
+                partial, name, model, columns, chunk_size)
+            if verbose:
+                print ("Snapshot " + name + ": " +
+                       str(manifest['tables'][name]['rows']) + " rows")
+
+        with open(os.path.join(partial, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+    except Exception:
+        shutil.rmtree(partial, ignore_errors=True)
+        raise
+
+    os.rename(partial, path)
+    return path
+
+
+def versions(directory=None):
+    """Return the names of the complete versions, oldest first.
+
+    A .partial directory is still being written, or was left by a
+    failed write, even if its manifest is there.
+
+    """
+
+    directory = directory or settings.SNAPSHOT_DIR
+    if not os.path.isdir(directory):
+        return []
+
+    return sorted([
+        name for name in os.listdir(directory)
+        if not name.endswith('.partial') and
+        os.path.isfile(os.path.join(directory, name, 'manifest.json'))])
+
+
+class Snapshot():
+    """One version of a snapshot, read a table at a time.
+
+    Tables are kept once read.
+
+    """
+
+    class NotFound(Exception):
+        pass
+
+    def __init__(self, path):
+        self.path = path
+        try:
+            with open(os.path.join(path, 'manifest.json')) as f:
+                self.manifest = json.load(f)
+        except IOError:
+            raise self.NotFound("No snapshot at " + path)
+
+        self.version = self.manifest['version']
+        self.tables = {}
+
+    def names(self):
+        return sorted(self.manifest['tables'].keys())
+
+    def rows(self, name):
+        return self.manifest['tables'][name]['rows']
+
+    def table(self, name, columns=None):
+        """Return a dictionary of column: array for a table.
+
+        Of the given columns, or all of them.
+
+        """
+
+        if name not in self.manifest['tables']:
+            raise self.NotFound("No table " + name + " in " + self.version)
+
+        entry = self.manifest['tables'][name]
+        columns = columns or entry['columns']
+        cached = self.tables.setdefault(name, {})
+        wanted = [column for column in columns if column not in cached]
+
+        if wanted:
+            parts = dict([(column, []) for column in wanted])
+            for n in range(entry['chunks']):
+                filename = '%s.%04d.npz' % (name, n)
+                with numpy.load(os.path.join(self.path, filename)) as data:
+                    for column in wanted:
+                        parts[column].append(data[column])
+            for column in wanted:
+                cached[column] = numpy.concatenate(parts[column])
+
+        return dict([(column, cached[column]) for column in columns])
+
+
+def load(version=None, directory=None):
+    """Return the Snapshot of a version, or of the latest."""
+
+    directory = directory or settings.SNAPSHOT_DIR
+    if version is None:
+        found = versions(directory)
+        if not found:
+            raise Snapshot.NotFound("No snapshots in " + directory)
+        version = found[-1]
+
+    return Snapshot(os.path.join(directory, version))
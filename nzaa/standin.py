@@ -0,0 +1,336 @@
+"""A local stand-in for ArchSite, for testing and timing the scraper.
+
+The stand-in answers the two kinds of request the scraper makes: the
+login form at /NZAA/Account/Login/, and site pages at
+/NZAA/Site/?id=<nzaa_id>. A site page is the latest copy in the page
+cache (see nzaa.pagecache) if there is one, or else is made from
+SITE_TEMPLATE, with values derived from the nzaa_id.
+
+Requests for site pages can be slowed and made to fail:
+
+    latency     Mean seconds before each answer.
+    jitter      Latency varies uniformly by up to this many seconds.
+    errors      Fraction of requests answered with a 503.
+    missing     Fraction of sites answered with ArchSite's "No data
+                was found for the site" page.
+    expire      Fraction of requests answered with the login page, as
+                if the session had expired.
+
+The choices are made by a random generator seeded from the seed, the
+nzaa_id and the number of times that id has been asked for, so a run
+of the same requests always meets the same latencies and failures,
+whatever order the requests arrive in. A missing site is always
+missing.
+
+Run it from the command line, and point the scraper at it:
+
+    ./manage.py standin --port 8001 --latency 0.2 --errors 0.05
+    ./manage.py scrape S14/1 S14/2 --archsite http://localhost:8001
+
+or time the scraper against it, with no network, with
+./manage.py benchmark_scrape.
+
+"""
+
+import BaseHTTPServer
+import Cookie
+import SocketServer
+import cgi
+import hashlib
+import random
+import threading
+import time
+import urlparse
+
+import pagecache
+
+
+LOGIN_PATH = '/NZAA/Account/Login/'
+SITE_PATH = '/NZAA/Site/'
+
+LOGIN_TEMPLATE = """<html><head><title>Log in</title></head><body>
+<h2>Log in</h2>
+<form method="post" action="%(path)s">
+<input type="text" name="UserName" value="" />
+<input type="password" name="Password" value="" />
+<input type="submit" value="Log in" />
+</form>
+</body></html>
+"""
+
+LOGGED_IN_TEMPLATE = """<html><head><title>ArchSite</title></head><body>
+<h2>Welcome %(username)s</h2>
+</body></html>
+"""
+
+MISSING_TEMPLATE = """<html><head><title>Site</title></head><body>
+<h3>Site</h3>
+<p>No data was found for the site %(nzaa_id)s</p>
+</body></html>
+"""
+
+SITE_TEMPLATE = """<html><head><title>Site %(nzaa_id)s</title></head><body>
+<div class="site">
+<h3>ArchSite</h3>
+<h3><span>NZAA</span> %(nzaa_id)s <span>NZMS</span> %(nzms_id)s</h3>
+<h4>Status %(status)s</h4>
+<p>%(short_desc)s</p>
+<dl>
+<dt>Name</dt><dd>%(site_name)s</dd>
+<dt>Site Type</dt><dd>%(site_type)s</dd>
+<dt>Features</dt><dd>%(features)s</dd>
+<dt>Period</dt><dd>%(period)s</dd>
+<dt>Ethnicity</dt><dd>%(ethnicity)s</dd>
+<dt>Evidence site destroyed</dt><dd>No</dd>
+<dt>Description</dt><dd>%(description)s</dd>
+<dt>Associated Sites</dt><dd></dd>
+<dt>Finder Aid</dt><dd>%(finder_aid)s</dd>
+<dt>NZTM Coordinates</dt><dd>E %(easting)d N %(northing)d</dd>
+<dt>Source of spatial data</dt><dd>GPS</dd>
+<dt>Site inspected by</dt><dd>%(inspected_by)s on %(inspected)s</dd>
+<dt>Condition</dt><dd>%(condition)s</dd>
+<dt>Condition Notes</dt><dd>%(condition_notes)s</dd>
+<dt>Land Use</dt><dd>Pastoral</dd>
+<dt>Threats</dt><dd>Stock</dd>
+</dl>
+</div>
+</body></html>
+"""
+
+SITE_TYPES = ('Pa', 'Pit/terrace', 'Midden/oven', 'Historic - domestic',
+              'Burial/cemetery', 'Garden soil', 'Findspot')
+PERIODS = ('Maori', 'Historic', 'Maori, Historic', 'Unknown')
+CONDITIONS = ('Good', 'Fair', 'Poor', 'Destroyed', 'Not known')
+
+
+def site_values(nzaa_id):
+    """Return a dictionary of values for SITE_TEMPLATE.
+
+    The values depend only on the nzaa_id, so a site's page is the
+    same from one run to the next.
+
+    """
+
+    r = random.Random(nzaa_id)
+    sheet, ordinal = nzaa_id.split('/')
+    easting = 1570000 + r.randint(0, 500000)
+    northing = 5170000 + r.randint(0, 1000000)
+
+    return {
+        'nzaa_id': nzaa_id,
+        'nzms_id': sheet + '/' + str(easting // 100 % 1000) + '/' +
+        str(northing // 100 % 1000),
+        'status': 'Visible',
+        'short_desc': 'Stand-in record ' + nzaa_id + '.',
+        'site_name': '',
+        'site_type': r.choice(SITE_TYPES),
+        'features': ', '.join(
+            r.sample(('pit', 'terrace', 'midden', 'ditch', 'bank'), 2)),
+        'period': r.choice(PERIODS),
+        'ethnicity': 'Maori',
+        'description': 'Recorded by the stand-in server.<br/>'
+                       'Line two of the description.',
+        'finder_aid': 'On the ridge above the stream.',
+        'easting': easting,
+        'northing': northing,
+        'inspected_by': 'A. Tester',
+        'inspected': '%02d/%02d/%d' % (
+            r.randint(1, 28), r.randint(1, 12), r.randint(1970, 2019)),
+        'condition': r.choice(CONDITIONS),
+        'condition_notes': 'Grazed.<br/>Some erosion.',
+    }
+
+
+class StandIn():
+    """The behaviour of the stand-in: pages, latency and failures.
+
+    With use_cache set, pages are taken from the page cache where they
+    can be.
+
+    """
+
+    SESSION = 'ASP.NET_SessionId'
+
+    def __init__(self, latency=0, jitter=0, errors=0, missing=0, expire=0,
+                 seed=0, use_cache=True):
+        self.latency = latency
+        self.jitter = jitter
+        self.errors = errors
+        self.missing = missing
+        self.expire = expire
+        self.seed = seed
+
+        self.pagecache = None
+        if use_cache:
+            self.pagecache = pagecache.PageCache()
+
+        self.lock = threading.Lock()
+        self.asked = {}
+        self.sessions = set()
+        self.counts = {
+            'logins': 0,
+            'pages': 0,
+            'missing': 0,
+            'errors': 0,
+            'expired': 0,
+        }
+
+    def count(self, key):
+        with self.lock:
+            self.counts[key] += 1
+
+    def random(self, nzaa_id):
+        """Return the random generator for this request for nzaa_id."""
+
+        with self.lock:
+            n = self.asked.get(nzaa_id, 0)
+            self.asked[nzaa_id] = n + 1
+
+        return random.Random(str(self.seed) + ':' + nzaa_id + ':' + str(n))
+
+    def is_missing(self, nzaa_id):
+        """True if nzaa_id is one of the missing sites."""
+
+        if not self.missing:
+            return False
+        r = random.Random(str(self.seed) + ':missing:' + nzaa_id)
+        return r.random() < self.missing
+
+    def login(self, username, password):
+        """Start a session. Return its identifier."""
+
+        session = hashlib.sha1(
+            str(self.seed) + username + str(time.time()) +
+            str(random.random())).hexdigest()
+        with self.lock:
+            self.sessions.add(session)
+        self.count('logins')
+        return session
+
+    def site(self, nzaa_id, session):
+        """Return (status, html) for a request for a site page."""
+
+        if session not in self.sessions:
+            return (200, LOGIN_TEMPLATE % {'path': LOGIN_PATH})
+
+        r = self.random(nzaa_id)
+        delay = self.latency + r.uniform(-self.jitter, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        if r.random() < self.errors:
+            self.count('errors')
+            return (503, 'Service Unavailable')
+
+        if r.random() < self.expire:
+            self.count('expired')
+            with self.lock:
+                self.sessions.discard(session)
+            return (200, LOGIN_TEMPLATE % {'path': LOGIN_PATH})
+
+        if self.is_missing(nzaa_id):
+            self.count('missing')
+            return (200, MISSING_TEMPLATE % {'nzaa_id': nzaa_id})
+
+        self.count('pages')
+        html = None
+        if self.pagecache:
+            html = self.pagecache.latest(nzaa_id)
+        if not html:
+            html = SITE_TEMPLATE % site_values(nzaa_id)
+
+        return (200, html)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer requests with the server's StandIn."""
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+    def session(self):
+        cookie = Cookie.SimpleCookie(self.headers.get('Cookie', ''))
+        if StandIn.SESSION in cookie:
+            return cookie[StandIn.SESSION].value
+        return None
+
+    def reply(self, status, html, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(html)))
+        for (key, value) in (headers or []):
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(html)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+
+        if url.path == LOGIN_PATH:
+            self.reply(200, LOGIN_TEMPLATE % {'path': LOGIN_PATH})
+
+        elif url.path == SITE_PATH:
+            query = urlparse.parse_qs(url.query)
+            nzaa_id = query.get('id', [''])[0]
+            (status, html) = self.server.standin.site(
+                nzaa_id, self.session())
+            self.reply(status, html)
+
+        else:
+            self.reply(404, 'Not Found')
+
+    def do_POST(self):
+        url = urlparse.urlparse(self.path)
+        if url.path != LOGIN_PATH:
+            self.reply(404, 'Not Found')
+            return
+
+        length = int(self.headers.get('Content-Length', 0))
+        form = cgi.parse_qs(self.rfile.read(length))
+        username = form.get('UserName', [''])[0]
+        password = form.get('Password', [''])[0]
+
+        if not username or not password:
+            self.reply(200, LOGIN_TEMPLATE % {'path': LOGIN_PATH})
+            return
+
+        session = self.server.standin.login(username, password)
+        cookie = StandIn.SESSION + '=' + session + '; Path=/'
+        self.reply(200, LOGGED_IN_TEMPLATE % {'username': username},
+                   [('Set-Cookie', cookie)])
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """A threaded HTTP server for a StandIn.
+
+    Port 0 picks a free port; see base_url().
+
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, standin, host='localhost', port=8001, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, (host, port), Handler)
+        self.standin = standin
+        self.verbose = verbose
+        self.thread = None
+
+    def base_url(self):
+        return 'http://' + self.server_address[0] + ':' + str(
+            self.server_address[1])
+
+    def start(self):
+        """Serve from a background thread. Return the base URL."""
+
+        self.thread = threading.Thread(
+            target=self.serve_forever, name='standin')
+        self.thread.daemon = True
+        self.thread.start()
+        return self.base_url()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -1,3 +1,940 @@
-from django.test import TestCase
+"""Tests for the nzaa application.
 
-# Create your tests here.
+    ./manage.py test nzaa
+
+The parser, digest and classifier tests check the rewritten code against
+the _legacy versions they replaced, and need no database. The analyse
+tests count the queries made by the site list summaries, and the
+save tests those made in saving a batch of scraped sites. The site
+context tests commit, as contexts are refreshed when a save commits.
+
+"""
+
+import datetime
+import hashlib
+import os
+import shutil
+import tempfile
+
+import numpy
+import pytz
+from django.contrib.auth.models import Group, User
+from django.contrib.gis.geos import LineString, Point
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext
+
+import geolib.models
+import nzaa.analyse as analyse
+import nzaa.datamap as datamap
+import nzaa.density as density
+import nzaa.footprint as footprint
+import nzaa.frontier as frontier
+import nzaa.gaps as gaps
+import nzaa.models as models
+import nzaa.normalise as normalise
+import nzaa.pagecache as pagecache
+import nzaa.scrape as scrape
+import nzaa.sitecontext as sitecontext
+import nzaa.sitestats as sitestats
+import nzaa.snapshot as snapshot
+import nzaa.standin as standin
+from nzaa.management.commands import benchmark_datamap
+from nzaa.metrics import Metrics
+
+
+def sample_pages():
+    """Return a list of (nzaa_id, html) of ArchSite pages to parse.
+
+    Stand-in pages for a run of sites, and variations of one: with
+    entities and line breaks in the values, without the evidence
+    field, with a label missing, missing, and with no heading.
+
+    """
+
+    pages = []
+    for ordinal in range(1, 41):
+        nzaa_id = 'S14/' + str(ordinal)
+        pages.append(
+            (nzaa_id, standin.SITE_TEMPLATE % standin.site_values(nzaa_id)))
+
+    values = standin.site_values('T11/7')
+    values['site_name'] = 'Pa &amp; kainga'
+    values['description'] = 'Terraces &lt;3 m wide.<br/>\n  Pits.  '
+    values['features'] = ''
+    pages.append(('T11/7', standin.SITE_TEMPLATE % values))
+
+    html = standin.SITE_TEMPLATE % standin.site_values('T11/8')
+    pages.append(('T11/8', html.replace(
+        '<dt>Evidence site destroyed</dt><dd>No</dd>\n', '')))
+    pages.append(('T11/9', html.replace('<dt>Period</dt>', '<dt>Era</dt>')))
+    pages.append(('T11/10', standin.MISSING_TEMPLATE % {'nzaa_id': 'T11/10'}))
+    pages.append(('T11/11', html.replace('<h3>ArchSite</h3>', '')))
+
+    return pages
+
+
+class ExtractValuesTest(SimpleTestCase):
+    """extract_values() reads pages as extract_values_legacy() did."""
+
+    def setUp(self):
+        self.scrape = scrape.Scrape(metrics=Metrics(directory=False))
+
+    def parse(self, method, html):
+        """The record, or the class name of the exception raised."""
+
+        try:
+            return method(html)
+        except Exception as e:
+            return e.__class__.__name__
+
+    def test_same_records(self):
+        for (nzaa_id, html) in sample_pages():
+            legacy = self.parse(self.scrape.extract_values_legacy, html)
+            current = self.parse(self.scrape.extract_values, html)
+            self.assertEqual(legacy, current, nzaa_id)
+
+    def test_same_digests(self):
+        found = 0
+        for (nzaa_id, html) in sample_pages():
+            legacy = self.parse(self.scrape.extract_values_legacy, html)
+            if not isinstance(legacy, dict):
+                continue
+            current = self.scrape.extract_values(html)
+            self.assertEqual(
+                self.scrape.digest_extract(nzaa_id, legacy),
+                self.scrape.digest_extract(nzaa_id, current), nzaa_id)
+            found += 1
+
+        self.assertTrue(found > 40)
+
+
+def digest_extract_legacy(extract):
+    """The record digest as made before DIGEST_ENTITIES."""
+
+    hash = hashlib.md5()
+    for k in sorted(extract.keys()):
+        try:
+            hash.update(
+                unicode(extract[k])
+                .replace(u'\u0101', '&#x0101;')
+                .replace(u'\u012b', '&#x012b;')
+                .replace(u'\u016b', '&#x016b;')
+                .replace(u'\u02bc', '&#x02bc;')
+                .replace(u'\u02c6', '&circ;')
+                .replace(u'\u02da', '&#x02da; ')
+                .replace(u'\u2013', '&ndash;')
+                .replace(u'\u2014', '&mdash;')
+                .replace(u'\u2018', '&lsquo;')
+                .replace(u'\u2019', '&rsquo;')
+                .replace(u'\u201c', '&ldquo;')
+                .replace(u'\u201d', '&rdquo;')
+                .replace(u'\u2022', '&bull;')
+                .replace(u'\u2026', '&hellip;')
+                .replace(u'\u20a4', '&#x20a4;')
+                .replace(u'\u2154', '&#x2154;')
+                .replace(u'\uf644', '')
+                .replace(u'\uf64b', '')
+                .replace(u'\uf64c', '')
+                .replace(u'\xa0', '&nbsp;')
+                .replace(u'\xa3', '&pound;')
+                .replace(u'\xa9', '&copy;')
+                .replace(u'\xac', '&not;')
+                .replace(u'\xad', '&shy;')
+                .replace(u'\xb0', '&deg;')
+                .replace(u'\xb1', '&plusmn;')
+                .replace(u'\xb2', '&sup2;')
+                .replace(u'\xb3', '&sup3;')
+                .replace(u'\xb4', '&acute;')
+                .replace(u'\xb7', '&middot;')
+                .replace(u'\xba', '&ordm;')
+                .replace(u'\xbc', '&frac14;')
+                .replace(u'\xbd', '&frac12;')
+                .replace(u'\xbe', '&frac34;')
+                .replace(u'\xe6', '&aelig;')
+                .replace(u'\xe7', '&ccedil;')
+                .replace(u'\xe8', '&egrave;')
+                .replace(u'\xe9', '&eacute;') +
+                "\n"
+            )
+        except UnicodeEncodeError:
+            pass
+
+    return hash.hexdigest()
+
+
+class DigestTest(SimpleTestCase):
+    """digest_extract() gives the digests stored before DIGEST_ENTITIES."""
+
+    def setUp(self):
+        self.scrape = scrape.Scrape(metrics=Metrics(directory=False))
+        (handle, self.scrape.DUMPFILE) = tempfile.mkstemp()
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.scrape.DUMPFILE)
+
+    def test_entities(self):
+        entities = u''.join(
+            [unichr(n) for n in sorted(scrape.DIGEST_ENTITIES)])
+        extracts = [
+            {'description': entities, 'site_name': u'Pa'},
+            dict([('field%02d' % n, u'a' + unichr(c) + u'b')
+                  for (n, c) in enumerate(scrape.DIGEST_ENTITIES)]),
+            {'description': entities + u' &amp; ' + entities[::-1],
+             'features': u'pit, terrace', 'easting': 1750000},
+        ]
+        for extract in extracts:
+            self.assertEqual(
+                digest_extract_legacy(extract),
+                self.scrape.digest_extract('S14/1', extract), extract)
+
+    def test_non_ascii(self):
+        # Macrons other than a, i and u have no entity, and leave their
+        # values out of the record digest.
+        extracts = [
+            {'site_name': u'\u014ct\u0101huhu', 'description': u'Pa'},
+            {'site_name': u'Te \u014ch\u0101k\u012b',
+             'features': u'p\u0101 \u2013 pit'},
+            {'site_name': u'\u0113', 'description': u'\ufffd'},
+        ]
+        for extract in extracts:
+            self.assertEqual(
+                digest_extract_legacy(extract),
+                self.scrape.digest_extract('S14/1', extract), extract)
+
+        with open(self.scrape.DUMPFILE) as f:
+            self.assertEqual(len(f.readlines()), 4)
+
+
+class MetricsTest(SimpleTestCase):
+    """The metrics file, and the summary table."""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.directory = os.path.join(self.root, 'metrics')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_lazy_file(self):
+        with Metrics(directory=self.directory) as metrics:
+            self.assertFalse(os.path.exists(self.directory))
+            metrics.observe('fetch', 0.5)
+            self.assertFalse(metrics.jsonl.closed)
+            jsonl = metrics.jsonl
+        self.assertTrue(jsonl.closed)
+        self.assertEqual(metrics.jsonl, None)
+
+        metrics.observe('fetch', 0.25)
+        metrics.report()
+        metrics.close()
+        with open(os.path.join(self.directory, 'scrape.jsonl')) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+    def test_nested_total(self):
+        metrics = Metrics(directory=False)
+        metrics.observe('fetch', 1.0)
+        metrics.observe('save', 2.0)
+        metrics.observe('enrich', 1.5)
+
+        table = metrics.table()
+        rows = dict([(line[:10].strip(), line.split())
+                     for line in table.split('\n')])
+        self.assertIn('\n  enrich ', table)
+        self.assertEqual(rows['enrich'][2], '1.50')
+        self.assertEqual(rows['Total'][1], '3.00')
+
+
+class DatamapTest(SimpleTestCase):
+    """The compiled classifier agrees with the legacy one."""
+
+    def test_generated_extracts(self):
+        extracts = benchmark_datamap.Command().generate(5000, 0)
+        for extract in extracts:
+            self.assertEqual(
+                datamap.map_type_legacy(extract),
+                datamap.map_type(extract), extract)
+            self.assertEqual(
+                datamap.map_period_legacy(extract),
+                datamap.map_period(extract), extract)
+            self.assertEqual(
+                datamap.map_ethnicity_legacy(extract),
+                datamap.map_ethnicity(extract), extract)
+
+
+class SuggestTest(SimpleTestCase):
+    """normalise.suggest() picks the latest dated update and visit."""
+
+    def update(self, date, actor, visited=False, visited_by=False):
+        """Return an update as analyse.find_updates() gives it."""
+
+        return {
+            'index': 0, 'date': date, 'actor': actor,
+            'description': 'Updated ' + str(date), 'condition': '',
+            'visited': visited, 'visited_by': visited_by}
+
+    def test_latest(self):
+        updates = [
+            self.update('2015-04-09', ' A. Tester '),
+            self.update('2011-02-01', 'B. Earlier',
+                        '2016-05-06', 'C. Visitor'),
+            self.update('2013-07-08', 'D. Between',
+                        '2012-01-01', 'E. Visitor'),
+        ]
+        self.assertEqual(normalise.suggest(updates), {
+            'updated': datetime.date(2015, 4, 9),
+            'updated_by': 'A. Tester',
+            'visited': datetime.date(2016, 5, 6),
+            'visited_by': 'C. Visitor'})
+
+    def test_visited_without_date(self):
+        updates = [self.update('2015-04-09', 'B. Visitor', True, 'B. Visitor')]
+        self.assertEqual(normalise.suggest(updates), {
+            'updated': datetime.date(2015, 4, 9),
+            'updated_by': 'B. Visitor'})
+
+    def test_not_dates(self):
+        updates = [
+            self.update('09/04/2015', 'A. Tester'),
+            self.update('2015-13-40', 'A. Tester', 'Unknown', 'C. Visitor'),
+            self.update(None, None, '2016-05-06', ''),
+        ]
+        self.assertEqual(normalise.suggest(updates), {
+            'visited': datetime.date(2016, 5, 6)})
+        self.assertEqual(normalise.suggest([]), {})
+
+
+class GridTest(SimpleTestCase):
+    """Bounds are binned into density cells by floor(), below 0 too."""
+
+    def test_span(self):
+        self.assertEqual(density.span((0, 0, 250, 250), 250), (0, 0, 1, 1))
+        self.assertEqual(
+            density.span((0, 0, 249.9, 249.9), 250), (0, 0, 0, 0))
+        self.assertEqual(
+            density.span((-1, -1, 0, 0), 250), (-1, -1, 0, 0))
+        self.assertEqual(
+            density.span((-250, -250.1, -0.1, 0), 250), (-1, -2, -1, 0))
+
+    def test_resolution(self):
+        self.assertEqual(density.resolution((0, 0, 24999, 24999)), 250)
+        self.assertEqual(density.resolution((0, 0, 25000, 25000)), 1000)
+        self.assertEqual(
+            density.resolution((-24999.9, -24999.9, -0.1, -0.1)), 250)
+        self.assertEqual(density.resolution((-25000, -25000, 0, 0)), 1000)
+        self.assertEqual(
+            density.resolution((0, 0, 1e7, 1e7)), density.SIZES[-1])
+        self.assertEqual(density.resolution((0, 0, 0, 0), limit=0), 25000)
+
+    def test_bad_size(self):
+        self.assertRaises(ValueError, density.cells, (0, 0, 1000, 1000), 500)
+
+
+class AnalyseSiteTest(TestCase):
+    """The analyse.Site summaries, and the queries they make."""
+
+    def setUp(self):
+        rows = [
+            ('Pa', 'comprehensive', datetime.date(1962, 3, 1), 'Not updated'),
+            ('Pa', 'adequate', datetime.date(1975, 6, 1), None),
+            ('Pit/terrace', 'thin', datetime.date(1978, 1, 9), 'A. Tester'),
+            ('Pit/terrace', None, None, None),
+            ('Midden/oven', 'adequate', datetime.date(2004, 12, 31), None),
+        ]
+        sites = []
+        for (n, (site_type, quality, recorded, updated_by)) in enumerate(
+                rows):
+            sites.append(models.Site(
+                nzaa_id='S14/' + str(n + 1), nzms_sheet='S14',
+                ordinal=n + 1, easting=1750000, northing=5910000,
+                site_type=site_type, record_quality=quality,
+                recorded=recorded, updated_by=updated_by))
+        models.Site.objects.bulk_create(sites)
+
+        self.analysis = analyse.Site(models.Site.objects.all())
+
+    def test_assessment(self):
+        with self.assertNumQueries(1):
+            assessment = self.analysis.assessment()
+
+        self.assertEqual(assessment['total'], 5)
+        self.assertEqual(assessment['assessed'], 4)
+        self.assertEqual(assessment['remaining'], 1)
+        self.assertEqual(assessment['pc_assd'], 80)
+        self.assertEqual(assessment['comp'], 1)
+        self.assertEqual(assessment['adequate'], 2)
+        self.assertEqual(assessment['thin'], 1)
+        self.assertEqual(assessment['sparse'], 0)
+        self.assertEqual(assessment['trivial'], 0)
+        self.assertEqual(assessment['pc_adequate'], 50)
+
+    def test_assessment_empty(self):
+        analysis = analyse.Site(models.Site.objects.none())
+        self.assertEqual(analysis.assessment(), None)
+
+    def test_by_date(self):
+        with self.assertNumQueries(3):
+            dates = self.analysis.by_date()
+
+        self.assertEqual(dates['dated'], 4)
+        self.assertEqual(dates['undated'], 1)
+        self.assertEqual(dates['no_recorded'], 1)
+        self.assertEqual(dates['no_updated'], 5)
+        self.assertEqual(dates['no_updated_by'], 3)
+        self.assertEqual(dates['not_updated'], 1)
+        self.assertEqual(dates['no_quality'], 1)
+        self.assertEqual(dates['earliest'].nzaa_id, 'S14/1')
+        self.assertEqual(dates['latest'].nzaa_id, 'S14/5')
+
+    def test_by_decade(self):
+        with self.assertNumQueries(2):
+            (years, decades) = self.analysis.by_decade()
+
+        self.assertEqual(years[0], (1962, 1))
+        self.assertEqual(years[-1], (2004, 1))
+        self.assertEqual(len(years), 2004 - 1962 + 1)
+        self.assertEqual(
+            decades, [(1960, 1), (1970, 2), (1980, 0), (1990, 0),
+                      (2000, 1)])
+
+    def test_by_type(self):
+        with self.assertNumQueries(1):
+            types = self.analysis.by_type()
+
+        self.assertEqual(
+            types, [(2, 'Pit/terrace'), (2, 'Pa'), (1, 'Midden/oven')])
+
+
+class ReplayTest(TestCase):
+    """A page replayed from the cache is processed and written again."""
+
+    def test_replay_rewrites(self):
+        s = scrape.Scrape(metrics=Metrics(directory=False))
+        html = standin.SITE_TEMPLATE % standin.site_values('S14/1')
+        extract = s.extract_values(html)
+        s.save_batch([('S14/1', extract)])
+
+        first = models.Update.objects.get(update_id='S14/1-0')
+        digest = models.Site.objects.get(nzaa_id='S14/1').digest
+
+        # As if saved before a change to the classifier.
+        extracted = datetime.datetime(2001, 1, 1, tzinfo=pytz.utc)
+        models.Site.objects.filter(nzaa_id='S14/1').update(
+            extracted=extracted, lgcy_type='Old')
+        models.Update.objects.filter(update_id='S14/1-0').update(
+            site_type='Old', period='Old')
+
+        s.REPLAY = True
+        self.assertEqual(s.save_batch([('S14/1', extract)]), 1)
+
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        update0 = models.Update.objects.get(update_id='S14/1-0')
+        self.assertEqual(update0.site_type, first.site_type)
+        self.assertEqual(update0.period, first.period)
+        self.assertEqual(site.lgcy_type, extract['type'])
+        self.assertEqual(site.extracted, extracted)
+        self.assertEqual(site.digest, digest)
+
+
+class SaveBatchTest(TestCase):
+    """save_batch() writes any batch in the same number of queries."""
+
+    def setUp(self):
+        self.scrape = scrape.Scrape(metrics=Metrics(directory=False))
+        self.scrape.save_batch([self.extract(n) for n in range(1, 5)])
+
+    def extract(self, ordinal, feature=None):
+        """A stand-in site's (nzaa_id, extract), with an added feature."""
+
+        nzaa_id = 'S14/' + str(ordinal)
+        extract = self.scrape.extract_values(
+            standin.SITE_TEMPLATE % standin.site_values(nzaa_id))
+        if feature:
+            extract['features'] += ', ' + feature
+        return (nzaa_id, extract)
+
+    def test_fixed_queries(self):
+        # New, changed, unchanged, and a new site listed twice.
+        batch = [self.extract(5), self.extract(1, 'wall'), self.extract(2),
+                 self.extract(5, 'wall')]
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.scrape.save_batch(batch), 2)
+
+        batch = [self.extract(6), self.extract(7), self.extract(8),
+                 self.extract(3, 'wall'), self.extract(4, 'drain'),
+                 self.extract(1, 'wall'), self.extract(2),
+                 self.extract(6, 'drain'), self.extract(8, 'wall')]
+        with self.assertNumQueries(len(queries)):
+            self.assertEqual(self.scrape.save_batch(batch), 5)
+
+        self.assertEqual(models.Site.objects.count(), 8)
+        self.assertEqual(models.Update.objects.count(), 8)
+        for (nzaa_id, feature) in [('S14/1', 'wall'), ('S14/5', 'wall'),
+                                   ('S14/6', 'drain'), ('S14/7', None)]:
+            site = models.Site.objects.get(nzaa_id=nzaa_id)
+            names = set(site.feature_set.values_list('name', flat=True))
+            self.assertEqual(names, set(site.list_features()), nzaa_id)
+            self.assertEqual(feature in names, feature is not None)
+
+    def test_unique_terms(self):
+        self.scrape.save_batch([self.extract(n, 'wall') for n in range(1, 9)])
+
+        for (model, field) in [(models.Actor, 'sourcename'),
+                               (models.Feature, 'name'),
+                               (models.Periods, 'name')]:
+            self.assertEqual(
+                model.objects.values(field).distinct().count(),
+                model.objects.count())
+        actor = models.Actor.objects.get(sourcename='A. Tester')
+        self.assertEqual(actor.sites.count(), 8)
+
+
+class FrontierTest(TestCase):
+    """The requests a SheetFrontier makes for a sheet."""
+
+    def setUp(self):
+        now = datetime.datetime.now(pytz.utc)
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id='S14/' + str(n), nzms_sheet='S14', ordinal=n,
+                easting=1750000, northing=5910000, extracted=now)
+            for n in range(1, 201) if n not in (50, 60)])
+
+        # S14/50 was fetched, and found missing, today.
+        self.root = tempfile.mkdtemp()
+        self.cache = pagecache.PageCache(self.root)
+        self.cache.store(
+            'S14/50', standin.MISSING_TEMPLATE % {'nzaa_id': 'S14/50'})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def probe(self, sites):
+        """Probe S14, holding sites. Return the frontier, finds, requests."""
+
+        sheet = frontier.SheetFrontier(
+            'S14', refresh_days=28, misses=6, plus=50, cache=self.cache)
+        requests = []
+
+        def fetch(nzaa_id):
+            requests.append(nzaa_id)
+            if nzaa_id in sites:
+                return {'nzaa_id': nzaa_id}
+            return None
+
+        found = [nzaa_id for (nzaa_id, extract) in sheet.probe(fetch)]
+        return (sheet, found, requests)
+
+    def test_targets(self):
+        sheet = frontier.SheetFrontier('S14', cache=self.cache)
+        self.assertEqual(sheet.targets(), ['S14/60'])
+        self.assertEqual(sheet.requests, 1)
+
+    def test_gallop_misses(self):
+        (sheet, found, requests) = self.probe(
+            ['S14/201', 'S14/202', 'S14/230'])
+        self.assertEqual(found, ['S14/201', 'S14/202'])
+        self.assertEqual(len(requests), 13)
+        self.assertEqual(sheet.requests, 13)
+        self.assertEqual(
+            requests[-5:],
+            ['S14/210', 'S14/214', 'S14/222', 'S14/238', 'S14/252'])
+        self.assertEqual(sheet.highest, 202)
+
+    def test_gallop_hit(self):
+        (sheet, found, requests) = self.probe(
+            ['S14/201', 'S14/202', 'S14/222', 'S14/230'])
+        self.assertEqual(
+            found, ['S14/201', 'S14/202', 'S14/222', 'S14/230'])
+        self.assertEqual(len(requests), 37)
+        self.assertEqual(
+            requests[10:18], ['S14/222'] +
+            ['S14/' + str(n) for n in range(215, 222)])
+        self.assertEqual(sheet.highest, 230)
+
+
+class SiteContextTest(TransactionTestCase):
+    """Stored contexts follow sites which move, and are read otherwise.
+
+    Contexts are refreshed once a save commits, so these tests commit.
+
+    """
+
+    def setUp(self):
+        self.old = datetime.datetime(2001, 1, 1, tzinfo=pytz.utc)
+
+        # S14/2 has S14/1 among its closest sites, S14/3 is far away.
+        places = [(1, 1750000), (2, 1755000), (3, 1950000)]
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id='S14/' + str(n), nzms_sheet='S14', ordinal=n,
+                easting=x, northing=5910000,
+                geom=Point(x, 5910000, srid=2193))
+            for (n, x) in places])
+        models.SiteContext.objects.bulk_create([
+            models.SiteContext(
+                nzaa_id='S14/' + str(n), geom=Point(x, 5910000, srid=2193),
+                context='{"stored": true}', sites_radius=6000,
+                refreshed=self.old)
+            for (n, x) in places])
+
+    def refreshed(self, n):
+        context = models.SiteContext.objects.get(nzaa_id='S14/' + str(n))
+        return context.refreshed
+
+    def test_moved(self):
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        site.easting += 1000
+        site.save()
+
+        self.assertTrue(self.refreshed(1) > self.old)
+        self.assertTrue(self.refreshed(2) > self.old)
+        self.assertEqual(self.refreshed(3), self.old)
+
+    def test_not_moved(self):
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        site.site_name = 'Pa'
+        site.save()
+
+        for n in (1, 2, 3):
+            self.assertEqual(self.refreshed(n), self.old)
+
+    def test_context(self):
+        site = models.Site.objects.get(nzaa_id='S14/2')
+        self.assertEqual(sitecontext.context(site), {'stored': True})
+
+        models.SiteContext.objects.filter(nzaa_id='S14/2').update(stale=True)
+        self.assertEqual(
+            sitecontext.context(site), sitecontext.live_context(site))
+
+        models.SiteContext.objects.filter(nzaa_id='S14/2').update(stale=False)
+        site.geom = Point(1756000, 5910000, srid=2193)
+        self.assertEqual(
+            sitecontext.context(site), sitecontext.live_context(site))
+
+
+class WaterwaysTest(TestCase):
+    """find_primary_waterways() agrees with the site by site version."""
+
+    def setUp(self):
+        lines = [
+            # Both 100 m from S14/1, which takes the first by name.
+            ('Brook', 5909900, 1750000),
+            ('Awa', 5910100, 1750000),
+            # Both 300 m from S14/2. An unnamed waterway comes first.
+            ('Creek', 5920000, 1760000),
+            (None, 5920600, 1760000),
+        ]
+        geolib.models.Waterways.objects.bulk_create([
+            geolib.models.Waterways(
+                base_name=name, geom=LineString(
+                    (x, y), (x + 1000, y), srid=2193))
+            for (name, y, x) in lines])
+
+        sites = [(1, 1750500, 5910000), (2, 1760500, 5920300),
+                 (3, None, None)]
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id='S14/' + str(n), nzms_sheet='S14', ordinal=n,
+                easting=x or 0, northing=y or 0,
+                geom=x and Point(x, y, srid=2193))
+            for (n, x, y) in sites])
+
+    def test_same_waterways(self):
+        with self.assertNumQueries(1):
+            current = analyse.Site(
+                models.Site.objects.all()).find_primary_waterways()
+        legacy = analyse.Site(models.Site.objects.exclude(
+            geom=None)).find_primary_waterways_legacy()
+
+        self.assertEqual(sorted(current.keys()), ['S14/1', 'S14/2'])
+        self.assertEqual(sorted(legacy.keys()), ['S14/1', 'S14/2'])
+        for nzaa_id in legacy:
+            self.assertAlmostEqual(current[nzaa_id][0], legacy[nzaa_id][0])
+            self.assertEqual(current[nzaa_id][1], legacy[nzaa_id][1])
+
+        self.assertEqual(current['S14/1'], (100.0, 'Awa'))
+        self.assertEqual(current['S14/2'], (300.0, None))
+
+
+class FootprintTest(TestCase):
+    """generate() writes the footprints compute_footprint() gives."""
+
+    def setUp(self):
+        # A grid reference, a metre short in the northing, and a point
+        # which is not one.
+        sites = [(1, 2667400.3, 6479399.6), (2, 2667437.0, 6479452.0)]
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id='S14/' + str(n), nzms_sheet='S14', ordinal=n,
+                easting=1750000 + n * 1000, northing=5910000,
+                geom=Point(1750000 + n * 1000, 5910000, srid=2193),
+                wgs84_lon=174.75, wgs84_lat=-36.85,
+                nzmg_easting=x, nzmg_northing=y)
+            for (n, x, y) in sites])
+
+    def test_same_footprints(self):
+        self.assertEqual(footprint.generate(['S14/1', 'S14/2']), 2)
+
+        for nzaa_id in ('S14/1', 'S14/2'):
+            site = models.Site.objects.get(nzaa_id=nzaa_id)
+            self.assertTrue(site.geom_poly.equals_exact(
+                site.compute_footprint(), 0.01), nzaa_id)
+
+        square = models.Site.objects.get(nzaa_id='S14/1').geom_poly
+        self.assertEqual(square.num_points, 5)
+
+
+class GapsTest(TestCase):
+    """Missing ordinals, as found by gaps.missing() and shown by selector."""
+
+    def setUp(self):
+        ordinals = [('S14', [3, 4, 5, 9, 10, 12]), ('S15', [1, 2, 3]),
+                    ('T11', [2, 4])]
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id=sheet + '/' + str(n), nzms_sheet=sheet, ordinal=n,
+                easting=1750000, northing=5910000)
+            for (sheet, numbers) in ordinals for n in numbers])
+
+    def test_one_sheet(self):
+        with self.assertNumQueries(1):
+            missing = gaps.missing(['S14'])
+        self.assertEqual(missing, {'S14': [(1, 2), (6, 8), (11, 11)]})
+
+    def test_sheets(self):
+        expected = {
+            'S14': [(1, 2), (6, 8), (11, 11)],
+            'T11': [(1, 1), (3, 3)],
+        }
+        with self.assertNumQueries(1):
+            self.assertEqual(gaps.missing(['S14', 'S15', 'T11']), expected)
+        self.assertEqual(gaps.missing(), expected)
+        self.assertEqual(gaps.missing(['S15']), {})
+
+    def test_display(self):
+        ranges = gaps.missing(['S14'])['S14']
+        self.assertEqual(
+            gaps.display('S14', ranges), 'S14/1-2, S14/6-8, S14/11')
+        self.assertEqual(gaps.count(ranges), 6)
+        self.assertEqual(
+            gaps.identifiers('S14', ranges),
+            ['S14/1', 'S14/2', 'S14/6', 'S14/7', 'S14/8', 'S14/11'])
+
+        ranges = gaps.missing(['S15']).get('S15', [])
+        self.assertEqual(gaps.display('S15', ranges), '')
+        self.assertEqual(gaps.count(ranges), 0)
+
+
+class SiteStatsTest(TransactionTestCase):
+    """A saved site has its sheets counted again only if a KEY changed."""
+
+    def setUp(self):
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id='S14/' + str(n), nzms_sheet='S14', ordinal=n,
+                easting=1750000, northing=5910000, site_type='Pa')
+            for n in (1, 2)])
+        sitestats.rebuild()
+
+    def test_moved_sheet(self):
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        site.nzms_sheet = 'S15'
+        site.save()
+
+        self.assertEqual(sitestats.total(nzms_sheet='S14'), 1)
+        self.assertEqual(sitestats.total(nzms_sheet='S15'), 1)
+
+        site.site_type = 'Midden/oven'
+        site.save()
+        self.assertEqual(sitestats.total(site_type='Pa'), 1)
+
+    def test_other_field(self):
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        site.site_name = 'Pa'
+        with CaptureQueriesContext(connection) as queries:
+            site.save()
+
+        table = models.SiteStatistic._meta.db_table
+        self.assertEqual(
+            [q['sql'] for q in queries if table in q['sql']], [])
+        self.assertEqual(sitestats.total(nzms_sheet='S14'), 2)
+
+    def test_delete(self):
+        models.Site.objects.get(nzaa_id='S14/1').delete()
+        self.assertEqual(sitestats.total(nzms_sheet='S14'), 1)
+
+
+class SnapshotTest(TestCase):
+    """A snapshot reads back what was written, Nones included."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        changed = datetime.datetime(2019, 10, 21, 11, 36, 2, tzinfo=pytz.utc)
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id='S14/1', nzms_sheet='S14', ordinal=1,
+                easting=1750000, northing=5910000, radius=50,
+                site_type='Pa', recorded=datetime.date(1962, 3, 1),
+                last_change=changed),
+            models.Site(
+                nzaa_id='S14/2', nzms_sheet='S14', ordinal=2,
+                easting=1750000, northing=5910000, radius=None,
+                site_type=None, recorded=None, last_change=None),
+        ])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        path = snapshot.write(self.directory)
+        snap = snapshot.load(directory=self.directory)
+        self.assertEqual(snap.path, path)
+        self.assertEqual(snap.rows('site'), 2)
+
+        sites = snap.table('site')
+        self.assertEqual(list(sites['nzaa_id']), [u'S14/1', u'S14/2'])
+        self.assertEqual(list(sites['ordinal']), [1, 2])
+        self.assertEqual(sites['ordinal'].dtype, numpy.int64)
+        self.assertEqual(list(sites['site_type']), [u'Pa', u''])
+
+        self.assertEqual(sites['radius'].dtype, numpy.float64)
+        self.assertEqual(sites['radius'][0], 50)
+        self.assertTrue(numpy.isnan(sites['radius'][1]))
+
+        self.assertEqual(
+            sites['recorded'][0], numpy.datetime64('1962-03-01'))
+        self.assertTrue(numpy.isnat(sites['recorded'][1]))
+
+        self.assertEqual(
+            sites['last_change'][0], numpy.datetime64('2019-10-21T11:36:02'))
+        self.assertTrue(numpy.isnat(sites['last_change'][1]))
+
+    def test_partial(self):
+        path = snapshot.write(self.directory)
+        shutil.copytree(path, os.path.join(
+            self.directory, '29991231T000000Z.partial'))
+
+        self.assertEqual(
+            snapshot.versions(self.directory), [os.path.basename(path)])
+        self.assertEqual(snapshot.load(directory=self.directory).path, path)
+
+
+class NormaliseTest(TestCase):
+    """A dry run reports the changes normalise would make, and writes none."""
+
+    def setUp(self):
+        models.Site.objects.bulk_create([models.Site(
+            nzaa_id='S14/1', nzms_sheet='S14', ordinal=1,
+            easting=1750000, northing=5910000, site_type='Pa')])
+        models.Update.objects.bulk_create([models.Update(
+            update_id='S14/1-0', site_id='S14/1', ordinal=0,
+            update_type='Legacy',
+            description='Pa on the ridge.\n\n'
+                        'Updated 09/04/2015, Updated by: A. Tester.',
+            condition='Grazed.')])
+
+    def test_dry_run(self):
+        with CaptureQueriesContext(connection) as queries:
+            (counts, changes) = normalise.normalise_sheet('S14', save=False)
+
+        self.assertEqual(counts['sites'], 1)
+        self.assertEqual(counts['changed'], 1)
+        self.assertEqual(sorted(changes), [
+            ('S14/1', 'updated', None, datetime.date(2015, 4, 9)),
+            ('S14/1', 'updated_by', None, 'A. Tester')])
+        self.assertEqual(
+            [q['sql'] for q in queries
+             if not q['sql'].lstrip().upper().startswith('SELECT')], [])
+
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        self.assertEqual((site.updated, site.updated_by), (None, None))
+
+    def test_save(self):
+        normalise.normalise_sheet('S14')
+
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        self.assertEqual(site.updated, datetime.date(2015, 4, 9))
+        self.assertEqual(site.updated_by, 'A. Tester')
+
+
+class DensityTest(TransactionTestCase):
+    """Density cells are read by bounds, and counted when sites change."""
+
+    def setUp(self):
+        models.Site.objects.bulk_create([
+            models.Site(
+                nzaa_id='S14/' + str(n), nzms_sheet='S14', ordinal=n,
+                easting=1750000, northing=5910000, site_type='Pa',
+                geom=Point(1750000, 5910000, srid=2193))
+            for n in (1, 2)])
+        density.rebuild()
+
+    def counts(self, sheet):
+        return dict(models.SiteDensity.objects.filter(
+            nzms_sheet=sheet, size=1000).values_list('site_type', 'count'))
+
+    def test_cells(self):
+        models.SiteDensity.objects.all().delete()
+        models.SiteDensity.objects.bulk_create([
+            models.SiteDensity(
+                size=250, cell_x=x, cell_y=y, nzms_sheet='S14',
+                site_type=site_type, count=n)
+            for (x, y, site_type, n) in [
+                (-1, -1, 'Pa', 2), (-1, -1, 'Midden/oven', 1),
+                (0, 0, 'Pa', 1), (1, 0, 'Pa', 5)]])
+
+        cells = density.cells((-1, -1, 0, 0), 250)
+        self.assertEqual(
+            [(c['x'], c['y'], c['count']) for c in cells],
+            [(-250, -250, 3), (0, 0, 1)])
+        self.assertEqual(cells[0]['types'], {'Pa': 2, 'Midden/oven': 1})
+        self.assertEqual(cells[0]['density'], 48.0)
+
+        cells = density.cells((-250, -250, -0.1, -0.1), 250)
+        self.assertEqual([(c['x'], c['y']) for c in cells], [(-250, -250)])
+
+        cells = density.cells((0, 0, 250, 0), 250, 'Pa')
+        self.assertEqual(
+            [(c['x'], c['y'], c['count']) for c in cells],
+            [(0, 0, 1), (250, 0, 5)])
+
+    def test_other_field(self):
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        site.site_name = 'Pa'
+        with CaptureQueriesContext(connection) as queries:
+            site.save()
+
+        table = models.SiteDensity._meta.db_table
+        self.assertEqual(
+            [q['sql'] for q in queries if table in q['sql']], [])
+
+    def test_changed(self):
+        site = models.Site.objects.get(nzaa_id='S14/1')
+        site.site_type = 'Midden/oven'
+        site.save()
+        self.assertEqual(self.counts('S14'), {'Pa': 1, 'Midden/oven': 1})
+
+        site.nzms_sheet = 'S15'
+        site.save()
+        self.assertEqual(self.counts('S14'), {'Pa': 1})
+        self.assertEqual(self.counts('S15'), {'Midden/oven': 1})
+
+    def test_delete(self):
+        models.Site.objects.get(nzaa_id='S14/1').delete()
+        self.assertEqual(self.counts('S14'), {'Pa': 1})
+
+    def test_bad_bbox(self):
+        user = User.objects.create_user('tester', password='secret')
+        user.groups.add(Group.objects.create(name='nzaa'))
+        self.client.force_login(user)
+
+        for bbox in ('', '1740000,5900000,1770000', 'a,b,c,d',
+                     '1740000,5900000,1770000,5930000,1'):
+            response = self.client.get('/nzaa/density/', {'bbox': bbox})
+            self.assertEqual(response.status_code, 400, bbox)
+
+        response = self.client.get(
+            '/nzaa/density/', {'bbox': '1740000,5900000,1770000,5930000'})
+        self.assertEqual(response.status_code, 200)
@@ -35,6 +35,9 @@ urlpatterns = [
     url(r'^boundary/([0-9]*)/$', views.boundary_report),
     url(r'^boundary/upload/$', views.boundary_upload),
 
+    #   Site density grid, as JSON.
+    url(r'^density/$', views.density_cells),
+
     #   Documents and files.
     url(r'^document/([0-9]*)/$', views.document),
     url(r'normalise/([A-Za-z]\d{2}/\d+)/$', views.normaliseUpdates),
@@ -2,6 +2,8 @@
 
 """
 
+from django.db.models import Case, F, Value, When
+
 import nzaa.settings as settings
 
 
@@ -57,3 +59,46 @@ def thousands_dep(x):
         c += 1
 
     return o[::-1]
+
+
+def bulk_update(model, objs, fields, batch_size=100):
+    """Write fields from a list of model instances in few queries.
+
+    Django 1.11 has bulk_create(), but no bulk_update(). Each batch of
+    objects is written with one UPDATE, setting each field to a CASE
+    on the primary key:
+
+        UPDATE nzaa_site SET digest = CASE
+            WHEN nzaa_id = 'S14/22' THEN '3f2a...'
+            WHEN nzaa_id = 'S14/23' THEN '9b07...'
+            ELSE digest END, ...
+        WHERE nzaa_id IN ('S14/22', 'S14/23')
+
+    Fields is a list of field names. No save() method or signal is
+    called. Return the number of rows updated.
+
+    """
+
+    pk = model._meta.pk
+    fields = [model._meta.get_field(name) for name in fields]
+
+    updated = 0
+    for n in range(0, len(objs), batch_size):
+        batch = objs[n:n + batch_size]
+
+        changes = {}
+        for field in fields:
+            whens = []
+            for obj in batch:
+                value = getattr(obj, field.attname)
+                whens.append(When(**{
+                    pk.attname: obj.pk,
+                    'then': Value(value, output_field=field),
+                }))
+            changes[field.attname] = Case(
+                *whens, default=F(field.attname), output_field=field)
+
+        pks = [obj.pk for obj in batch]
+        updated += model.objects.filter(pk__in=pks).update(**changes)
+
+    return updated
@@ -38,6 +38,7 @@ Session variables - site record lists
 
 """
 import datetime
+import json
 import os
 import locale
 import markdown2 as markdown
@@ -51,7 +52,7 @@ from django.db import IntegrityError
 
 from django.db.models import F
 from django.forms import formset_factory, modelformset_factory
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest
 from django.shortcuts import render, redirect, get_object_or_404
 from django.views.decorators.csrf import csrf_protect
 from django.db.models import F
@@ -64,11 +65,15 @@ from django.db import transaction
 from geolib.models import Region, TerritorialAuthority, NZMSgrid, Topo50grid
 import analyse
 import authority
+import coords
+import density
 import forms
+import gaps
 import home.views
 import models
 import scrape
 import settings
+import sitestats
 
 import utils
 
@@ -324,7 +329,7 @@ def changes(request):
     transaction.set_autocommit(True)
 
     tunit = 'day'
-    query = 'SELECT "nzaa_id" '
+    query = 'SELECT "nzaa_id", "changed_fields" '
     query += "FROM nzaa_site WHERE "
     query += "date_trunc('" + tunit + "', last_change) = "
     query += "date_trunc('" + tunit + "', extracted) "
@@ -362,6 +367,54 @@ def changes(request):
     return render(request, template, context)
 
 
+@user_passes_test(authority.nzaa_member)
+def density_cells(request):
+    """Return the site counts of grid cells in a bounding box, as JSON.
+
+    density/?bbox=xmin,ymin,xmax,ymax in NZTM, or in the srid given,
+    such as srid=4326 for longitude and latitude. Size is the side of
+    the cells in metres, one of density.SIZES, chosen for the box if
+    not given, and type a site type to count alone. See nzaa.density.
+
+    """
+
+    try:
+        bounds = [float(v) for v in request.GET.get('bbox', '').split(',')]
+        (xmin, ymin, xmax, ymax) = bounds
+        srid = int(request.GET.get('srid', coords.NZTM))
+        size = request.GET.get('size')
+        if size:
+            size = int(size)
+    except ValueError:
+        return HttpResponseBadRequest(
+            "bbox=xmin,ymin,xmax,ymax, with srid and size as integers.")
+
+    if srid != coords.NZTM:
+        corners = coords.transform(
+            [(xmin, ymin), (xmin, ymax), (xmax, ymin), (xmax, ymax)],
+            srid, coords.NZTM)
+        xs = [x for (x, y) in corners]
+        ys = [y for (x, y) in corners]
+        (xmin, ymin, xmax, ymax) = (min(xs), min(ys), max(xs), max(ys))
+
+    bounds = (xmin, ymin, xmax, ymax)
+    size = size or density.resolution(bounds)
+    try:
+        cells = density.cells(
+            bounds, size, request.GET.get('type') or None)
+    except ValueError as e:
+        return HttpResponseBadRequest(str(e))
+
+    result = {
+        'bbox': bounds,
+        'srid': coords.NZTM,
+        'size': size,
+        'count': sum([cell['count'] for cell in cells]),
+        'cells': cells,
+    }
+    return HttpResponse(json.dumps(result), content_type='application/json')
+
+
 @user_passes_test(authority.nzaa_member)
 def document(request, doc_id):
     URL = 'document/'
@@ -455,7 +508,7 @@ def homepage(request):
     context['title'] = context['h1'] + " | archaeography.nz"
     context['subhead'] = 'Modelling the Site Recording Scheme (SRS)'
     context['jsortable'] = True
-    context['total_records'] = models.Site.objects.all().count()
+    context['total_records'] = sitestats.total()
     context['total_documents'] = models.Document.objects.all().count()
 
     context['user_groups'] = authority.group_memberships(request)
@@ -776,10 +829,11 @@ def nzaa_regions(request, command=None):
     setlist = None
     siteset = None
 
+    by_sheet = dict(sitestats.counts('nzms_sheet'))
     nzaaregions = []
     for reg in sorted(settings.NZAA_REGION.keys()):
         sheets = settings.NZAA_REGION_SHEETS[reg]
-        count = models.Site.objects.filter(nzms_sheet__in=sheets).count()
+        count = sum([by_sheet.get(sheet, 0) for sheet in sheets])
         line = (reg, reg.replace('file', ' file'), count)
         nzaaregions.append(line)
 
@@ -988,6 +1042,7 @@ def selector(request, command, option=None):
     request.session['siteset'] = None
     listtype = None
     sites = None
+    filters = None
     template = 'nzaa/SitesList.html'
     h1 = "Sorry, I don't know what you are asking for."
     first = None
@@ -1022,6 +1077,7 @@ def selector(request, command, option=None):
         tla = settings.TLA[command][0]
         h1 = tla
         sites = models.Site.objects.filter(tla=tla)
+        filters = {'tla': tla}
         listtype = 'tla'
         siteset['setname'] = tla
 
@@ -1029,6 +1085,7 @@ def selector(request, command, option=None):
         region = settings.REGION[command][0]
         h1 = region
         sites = models.Site.objects.filter(region=region)
+        filters = {'region': region}
         listtype = 'region'
         siteset['setname'] = region
 
@@ -1037,6 +1094,7 @@ def selector(request, command, option=None):
         h1 = region
         sheets = settings.NZAA_REGION_SHEETS[command]
         sites = models.Site.objects.filter(nzms_sheet__in=sheets)
+        filters = {'nzms_sheet__in': sheets}
         context['sheets'] = sheets
         listtype = 'nzaa'
         siteset['setname'] = region
@@ -1046,25 +1104,20 @@ def selector(request, command, option=None):
         h1 = command + " NZMS260 sheet"
         context['sheet'] = command
         sites = models.Site.objects.filter(nzms_sheet=command)
+        filters = {'nzms_sheet': command}
         listtype = 'nzms_sheet'
         siteset['setname'] = h1
 
-    if sites:
-        analysis = analyse.Site(sites)
-        context['sites_by_lgcy_type'] = analysis.count_by_lgcy_type()
+#   Site types of the whole set, from the site counts.
+    if filters is not None:
+        context['sites_by_lgcy_type'] = sitestats.breakdown(
+            'lgcy_type', **filters)
 
 #   Find unfilled ordinals in a NZMS260 sheet.
     if listtype == "nzms_sheet":
-        missing = ""
-        count = 0
-        ordinals = list(sites.values_list('ordinal', flat=True))
-        for n in range(1, sites[len(sites)-1].ordinal + 1):
-            if n not in ordinals:
-                count += 1
-                missing += command + "/" + str(n) + ", "
-        missing = missing[:-2]
-        context['missing_records'] = missing
-        context['count_missing'] = count
+        missing = gaps.missing([command]).get(command, [])
+        context['missing_records'] = gaps.display(command, missing)
+        context['count_missing'] = gaps.count(missing)
 
 #   Create a new site list object from checked records (depreciated).
     if request.POST: